@@ -4,20 +4,49 @@
 # -----------------
 
 import functools
-from typing import Dict, Any
-from langchain_openai import ChatOpenAI
+import re
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Union
 from logging_util import logger
-from langchain_util import createAgent, createRouter, agent_node, createBookworm
+from langchain_util import createAgent, createRouter, createPreRouter, agent_node, fan_out_node, createBookworm, default_token_budget, LazyAgent, resolve_llm
+from session_state import get_session
 from langgraph.graph import END
 from util import db_path, llm_model
-from agent_tools import tavily_search_tool, scrape_recipe_info, generate_recipe, clear_pot, create_recipe_graph, get_recipe, get_recipe_from_pot, examine_pot, add_node, get_foundational_recipe, set_foundational_recipe, get_graph, suggest_mod, get_mods_list, apply_mod, rank_mod, remove_mod, pop_url_from_pot, add_url_to_pot
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+from agent_tools import cached_search, scrape_recipe_info, scrape_recipes_batch, generate_recipe, clear_pot, create_recipe_graph, get_recipe, get_recipe_from_pot, examine_pot, add_node, get_foundational_recipe, set_foundational_recipe, get_graph, suggest_mod, get_mods_list, apply_mod, rank_mod, remove_mod, pop_url_from_pot, add_url_to_pot, add_urls_to_pot, search_recipe_corpus, find_recipes_by_ingredients, get_corpus_recipe, measure_recipe, analyze_nutrition, compare_mods_nutrition
+
+## Fan-out Tasks
+_url_pattern = re.compile(r"https?://\S+")
+
+def split_pot_urls(state) -> List[str]:
+    """Claim every URL in the Pot so that each parallel Sleuth branch handles exactly one."""
+    urls = []
+    with get_session() as session:
+        while (url := session.pot.pop_url()) is not None:
+            urls.append(url)
+            session.record("delete_pot_url", url)
+    return [
+        f"Scrape this URL with the scrape_recipe_info tool and add the result to the Pot with the generate_recipe tool: {url}"
+        for url in urls
+    ]
+
+def requeue_pot_urls(tasks: List[str]) -> None:
+    """Return the URLs of failed Sleuth branches to the Pot, so the next Sleuth visit retries them."""
+    urls = [match.group(0) for task in tasks if (match := _url_pattern.search(task))]
+    with get_session() as session:
+        added = session.pot.add_urls(urls)
+        if added:
+            session.record("save_pot_urls", added)
+    logger.info(f"Returned {len(added)} URLs of failed Sleuth branches to the Pot.")
 
 prompts_dict = {
     "Frontman": {
         "type": "agent",
         "label": "User\nRep",
         "prompt": "You are Caldron, an intelligent assistant for recipe development. You will be friendly and chipper in your responses. Through the use of other agents in the architecture, you are capable of finding recipe information, aiding in ideation, adapting recipes given specific constraints, and integrating recipe feedback. Your task is primarily to handle interactions with the user and to summarize the entirety of the given message chain from other agents to deliver a concise explanation of changes to the user.\nQuestions that come up that require user feedback will be sent to you. Please pose them to the user. Assume the user has no information beyond what they explicitly give to you.\nYou will make no mention of the tools used to do so such as the names of agents, the names of tools, or the Pot. Prior to completing, run the clear_pot tool to ensure that all recent recipes are cleared from short-term memory.",
-        "tools": [clear_pot]
+        "tools": [clear_pot],
+        "token_budget": 10000 # Summarizes the whole turn for the user
     },
     "Caldron\nPostman": {
         "type": "supervisor",
@@ -31,6 +60,7 @@ prompts_dict = {
         - KnowItAll: Answers general questions about the recipe. Has access to the foundational recipe and the Recipe Graph.\n
         When all tasks are complete and Spinnaret has been called, respond with FINISH. Ensure that all changes are recorded by Spinnaret before completing.
         """,
+        "token_budget": 3000, # Routing only needs recent context
         "members":["Research\nPostman", "ModSquad", "Spinnaret", "Frontman", "KnowItAll"] # TODO - "Critic" & "Jimmy"
     },
     "Research\nPostman": {
@@ -43,6 +73,7 @@ prompts_dict = {
         Your task is to coordinate their efforts to ensure seamless recipe information retrieval.\n 
         When a message is received, you may assign tasks to the appropriate agents based on their specializations. Collect and review the results from each agent, giving follow-up tasks as needed and resolving any detected looping issues or requests for additional input. Once all agents have completed their tasks, direct this back to the Caldron\nPostman.
         """,
+        "token_budget": 3000, # Routing only needs recent context
         "members": ["Tavily", "Sleuth", "Caldron\nPostman"] #TODO - "Bookworm", "Remy", "HealthNut", "MrKrabs" 
     },
     #"Remy": { TODO
@@ -53,7 +84,7 @@ prompts_dict = {
     #"HealthNut": { TODO
     #    "type": "agent",
     #    "prompt": "You are HealthNut, the Nutritional Analysis agent. Your task is to evaluate the nutritional content of the ingredients provided and ensure the recipe meets specific nutritional guidelines. Make suggestions for ingredient adjustments to achieve a balanced nutrient profile. Format all outputs according to Pydantic standards and forward your results to the relevant nodes (e.g., Flavor Profiling, Recipe Modification Manager). Address any looping issues or additional input needs clearly and concisely.",
-    #    "tools": [get_foundational_recipe, suggest_mod],
+    #    "tools": [get_foundational_recipe, analyze_nutrition, compare_mods_nutrition, suggest_mod],
     #},
     #"MrKrabs": { TODO
     #    "type": "agent",
@@ -67,6 +98,7 @@ prompts_dict = {
     #},
     #"Bookworm": {
     #    "type": "sql",
+    #    "tools": [search_recipe_corpus, find_recipes_by_ingredients, get_corpus_recipe],
     #    "prompt": "In the event that a simple statement is received, you may reframe this statement as a question. For example, 'I want to make gluten-free bread with xanthan gum' could be reframed as 'What are common recipes for gluten-free bread with xanthan gum?'"
     #},
     "Tavily": {
@@ -74,11 +106,11 @@ prompts_dict = {
         "label": "Web\nSearch",
         "prompt": """
         You are Tavily. Your task is to search the internet for relevant recipes that match the user's request. Some actions may be:\n
-        1. Search the internet. Use the tavily_search_tool to find a recipe that matches the user's request.\n
-        2. Add a URL to the Pot. Use the add_url_to_pot tool to add a URL to the Pot for further examination.\n
+        1. Search the internet. Use the cached_search tool to find a recipe that matches the user's request. The search_recipe_corpus tool searches Caldron's own recipe collection by keyword, and find_recipes_by_ingredients finds recipes in it by required and excluded ingredients; their results also have URLs.\n
+        2. Add URLs to the Pot. Use the add_urls_to_pot tool to add all URLs from a search to the Pot at once, or the add_url_to_pot tool for a single URL.\n
         Make sure all URLs are added to the Pot for further examination by the Sleuth. Once all URLs have been identified, pass your results to the Research\nPostman.
         """,
-        "tools": [tavily_search_tool, add_url_to_pot]
+        "tools": [cached_search, search_recipe_corpus, find_recipes_by_ingredients, add_urls_to_pot, add_url_to_pot]
     },
     "Sleuth": {
         "type": "agent",
@@ -86,13 +118,15 @@ prompts_dict = {
         "prompt": """
         You are Sleuth. Your task is to scrape recipe data from the internet. Some actions may be:\n
         1. Grab URLs from the Pot. Use the pop_url_from_pot tool to retrieve a URL from the Pot.\n
-        2. Get recipe information. Use the scrape_recipe_info tool to find information about a specific recipe given its URL.\n
+        2. Get recipe information. Use the scrape_recipes_batch tool to scrape every URL in the Pot at once, or the scrape_recipe_info tool to find information about a specific recipe given its URL.\n
         3. Generate a recipe. Use the generate_recipe tool to summarize the recipe found and add it to the Pot.\n
         4. Examine short-term memory. Use the examine_pot tool to view all recipes and URLs in the Pot or get_recipe_from_pot to examine a specific recipe.\n\n
-        You MUST use the scrape_recipe_info tool on URLs in the Pot given to you. You will then use generate_recipe with that information. Esnure that you have examined all recipe URLs identified before proceeding. Once all recipes have been assessed, pass your results to the Research\nPostman.
+        You MUST scrape the URLs in the Pot given to you, preferably with a single scrape_recipes_batch call. You will then use generate_recipe with that information. Esnure that you have examined all recipe URLs identified before proceeding. Once all recipes have been assessed, pass your results to the Research\nPostman.
         """,
-        "tools": [pop_url_from_pot, scrape_recipe_info, generate_recipe, get_recipe_from_pot, examine_pot],
-        "tool_choice": {"type": "function", "function": {"name": "generate_recipe"}}
+        "tools": [scrape_recipes_batch, pop_url_from_pot, scrape_recipe_info, generate_recipe, get_recipe_from_pot, examine_pot],
+        "tool_choice": {"type": "function", "function": {"name": "generate_recipe"}},
+        "fan_out": split_pot_urls,
+        "retry": requeue_pot_urls,
     },
     "ModSquad": {
         "type": "agent",
@@ -111,8 +145,8 @@ prompts_dict = {
     "KnowItAll": {
         "type": "agent",
         "label": "Q&A\nExpert",
-        "prompt": "You are KnowItAll. Your task is to answer general questions about the recipe. You have access to the foundational recipe and the Recipe Graph. Use the get_foundational_recipe tool to retrieve information on the current foundational recipe. Use the get_graph tool to retrieve the current recipe graph. You may also use the set_foundational_recipe tool to change the foundational recipe. You will be asked to provide information about the recipe and the Recipe Graph.",
-        "tools": [get_foundational_recipe, get_graph, get_recipe],
+        "prompt": "You are KnowItAll. Your task is to answer general questions about the recipe. You have access to the foundational recipe and the Recipe Graph. Use the get_foundational_recipe tool to retrieve information on the current foundational recipe. Use the get_graph tool to retrieve the current recipe graph. You may also use the set_foundational_recipe tool to change the foundational recipe. Use the measure_recipe tool to convert the recipe's amounts to grams, scale it, or give baker's percentages, and the analyze_nutrition tool to estimate its nutrients. You will be asked to provide information about the recipe and the Recipe Graph.",
+        "tools": [get_foundational_recipe, get_graph, get_recipe, measure_recipe, analyze_nutrition],
     },
     "Spinnaret": {
         "type": "agent",
@@ -162,35 +196,88 @@ direct_edges = [
     ("Frontman", END)
 ]
 
-def create_all_agents(llm: ChatOpenAI, prompts_dict: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+## Deterministic Routes
+# Obvious hand-offs are decided from the AgentState and the session state, skipping the
+# supervisor LLM call. Each rule returns the next member or None when the route is ambiguous.
+def _used(state, *tools: str) -> bool:
+    return any(tool in (state.get("last_tools") or []) for tool in tools)
+
+def route_urls_to_sleuth(state) -> Optional[str]:
+    if state.get("sender") == "Tavily" and _used(state, "add_urls_to_pot", "add_url_to_pot"):
+        with get_session() as session:
+            if session.pot.get_all_urls():
+                return "Sleuth"
+    return None
+
+def route_research_done(state) -> Optional[str]:
+    if state.get("sender") == "Sleuth" and _used(state, "generate_recipe"):
+        with get_session() as session:
+            if not session.pot.get_all_urls() and session.pot.get_all_recipes():
+                return "Caldron\nPostman"
+    return None
+
+def route_applied_mod_to_spinnaret(state) -> Optional[str]:
+    # last_tools omits an apply_mod that reported "success": False, leaving that case to the LLM router
+    if state.get("sender") == "ModSquad" and _used(state, "apply_mod"):
+        return "Spinnaret"
+    return None
+
+fast_routes = {
+    "Caldron\nPostman": [route_applied_mod_to_spinnaret],
+    "Research\nPostman": [route_urls_to_sleuth, route_research_done],
+}
+
+def _build_agent(name: str, d: Dict[str, Any], llm: Union[str, 'ChatOpenAI']):
+    if d["type"] == "supervisor":
+        logger.info(f"Creating supervisor agent: {name}")
+        if name == "Caldron\nPostman":
+            agent = createRouter(name, d["prompt"], resolve_llm(llm), members=d["members"], exit=True)
+        else:
+            agent = createRouter(name, d["prompt"], resolve_llm(llm), members=d["members"])
+        if name in fast_routes:
+            agent = createPreRouter(name, agent, fast_routes[name])
+
+    elif d["type"] == "sql":
+        logger.info(f"Creating SQL agent: {name}")
+        agent = createBookworm(name, d["prompt"], llm_model, db_path, verbose=True, extra_tools=d.get("tools", []))
+
+    elif d["type"] == "agent":
+        logger.info(f"Creating agent: {name}")
+        if "tool_choice" in d:
+            agent = createAgent(name, d["prompt"], resolve_llm(llm), d["tools"]) #TODO - add tool_choice
+        else:
+            agent = createAgent(name, d["prompt"], resolve_llm(llm), d["tools"])
+
+    logger.info(f"Agent {name} created.")
+    return agent
+
+def create_all_agents(llm: Union[str, 'ChatOpenAI'], prompts_dict: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Create a graph node for every agent. `llm` is a chat model or a model name.
+
+    The executors and routers behind the nodes are only built when the graph first
+    reaches them (or when `warm_agents` is called), which keeps startup fast.
+    """
     logger.info("Creating all agents.")
     agents = {}
 
     for name, d in prompts_dict.items():
-        if d["type"] == "supervisor":
-            logger.info(f"Creating supervisor agent: {name}")
-            if name == "Caldron\nPostman":
-                agent = createRouter(name, d["prompt"], llm, members=d["members"], exit=True)
-            else:
-                agent = createRouter(name, d["prompt"], llm, members=d["members"])
-
-        elif d["type"] == "sql":
-            logger.info(f"Creating SQL agent: {name}")
-            agent = createBookworm(name, d["prompt"], llm_model, db_path, verbose=True)
-
-        elif d["type"] == "agent":
-            logger.info(f"Creating agent: {name}")
-            if "tool_choice" in d:
-                agent = createAgent(name, d["prompt"], llm, d["tools"]) #TODO - add tool_choice
-            else:
-                agent = createAgent(name, d["prompt"], llm, d["tools"])
-
-        agents[name] = functools.partial(agent_node, agent=agent, name=name)
-        logger.info(f"Agent {name} created.")
+        agent = LazyAgent(name, functools.partial(_build_agent, name, d, llm))
+        token_budget = d.get("token_budget", default_token_budget)
+        if "fan_out" in d:
+            agents[name] = functools.partial(fan_out_node, agent=agent, name=name, split=d["fan_out"], retry=d.get("retry"), token_budget=token_budget)
+        else:
+            agents[name] = functools.partial(agent_node, agent=agent, name=name, token_budget=token_budget)
 
     logger.info("All agents created.")
     return agents
 
+def warm_agents(agents: Dict[str, Any]) -> None:
+    """Build every lazily created agent now, e.g. on a background thread during startup."""
+    for node in agents.values():
+        agent = node.keywords.get("agent")
+        if isinstance(agent, LazyAgent):
+            agent.warm()
+
 def form_edges(flow_graph):
     for source, target in direct_edges:
         flow_graph.add_edge(source, target)
@@ -1,19 +1,78 @@
 from langchain_core.tools import tool
 from typing import Dict, List, Optional, Annotated, Any
-from langchain_community.tools.tavily_search import TavilySearchResults
 import os
 import json
+import sqlite3
 from dotenv import load_dotenv
-from recipe_scrapers import scrape_me
 from langchain_core.messages import HumanMessage
-from class_defs import load_graph_from_file, save_graph_to_file, default_graph_file, default_mods_list_file, load_mods_list_from_file, save_mods_list_to_file, load_pot_from_file, save_pot_to_file, Recipe, Ingredient, RecipeModification, RecipeGraph
+from class_defs import Recipe, Ingredient, RecipeModification, RecipeGraph
+from session_state import get_session
+from page_cache import get_page_cache
+from search_cache import get_search_cache
+from recipe_db import get_recipe_db
+from ingredient_parser import parse_ingredient_lines
+from cassette import through_cassette
 from logging_util import logger
 from datetime import datetime
 
 load_dotenv()
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 
-tavily_search_tool = TavilySearchResults()
+tavily_search_tool = None # Created on first search; importing Tavily is slow
+
+def _tavily_search(query: str) -> List[Dict[str, str]]:
+    global tavily_search_tool
+    if tavily_search_tool is None:
+        from langchain_community.tools.tavily_search import TavilySearchResults
+        tavily_search_tool = TavilySearchResults()
+    return tavily_search_tool.invoke({"query": query})
+
+@tool
+def cached_search(
+    query: Annotated[str, "The search query."]
+) -> Annotated[List[Dict[str, str]], "A list of search results with their URLs and content."]:
+    """Search the internet for recipes and cooking information. Repeated queries are answered from a cache."""
+    logger.debug(f"Searching: {query}")
+    return through_cassette(
+        "cached_search", {"query": query},
+        lambda: get_search_cache().get_or_search(query, _tavily_search),
+    )
+
+## Recipe Corpus Tools
+
+@tool
+def search_recipe_corpus(
+    query: Annotated[str, "Keywords to look for, e.g. 'sourdough rye' or 'gluten free banana'."],
+    limit: Annotated[int, "The maximum number of recipes to return."] = 5
+) -> Annotated[Any, "Matching recipes, best first, with their IDs, names, URLs and a snippet of the matching text."]:
+    """Search the local recipe corpus by keyword. Every word must appear in a recipe's name, ingredients, instructions or tags; results are ranked by relevance."""
+    logger.debug(f"Searching recipe corpus: {query}")
+    try:
+        return get_recipe_db().search(query, limit)
+    except (FileNotFoundError, sqlite3.Error) as e:
+        return {"error": str(e)}
+
+@tool
+def find_recipes_by_ingredients(
+    expression: Annotated[str, "A boolean ingredient expression, e.g. 'flour AND yeast AND NOT sugar' or '(butter OR olive oil) AND tag:focaccia'."],
+    limit: Annotated[int, "The maximum number of recipes to return."] = 10
+) -> Annotated[Any, "The IDs, names and URLs of the matching recipes."]:
+    """Find recipes in the local recipe corpus by the ingredients they contain. Combine exact ingredient names with AND, OR, NOT and parentheses; prefix a term with 'tag:' to match a tag instead."""
+    logger.debug(f"Querying recipe corpus by ingredients: {expression}")
+    try:
+        return [{"id": recipe_id, "name": name, "url": url} for recipe_id, name, url in get_recipe_db().query_ingredients(expression, limit)]
+    except (ValueError, FileNotFoundError, sqlite3.Error) as e:
+        return {"error": str(e)}
+
+@tool
+def get_corpus_recipe(
+    recipe_id: Annotated[str, "The ID of a recipe returned by search_recipe_corpus."]
+) -> Annotated[Any, "The recipe's name, URL, ingredient lines, parsed ingredients, instructions and tags."]:
+    """Get the full details of a recipe in the local recipe corpus."""
+    try:
+        return get_recipe_db().get_recipe(recipe_id) or {"error": f"No recipe with ID {recipe_id} in the corpus."}
+    except (FileNotFoundError, sqlite3.Error) as e:
+        return {"error": str(e)}
 
 ## Datetime Tool (mainly for dummy use)
 
@@ -29,6 +88,17 @@ def get_user_input() -> Annotated[str, "The user's input."]:
 
 ## Recipe Manipulation Tools
 
+def _with_parsed_ingredients(recipe: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the rule-parsed ingredient lines to a scraped recipe. Lines the rules cannot parse are listed as-is for the agent to read."""
+    lines = recipe.get("ingredients") or []
+    if "error" in recipe or not lines:
+        return recipe
+    parsed = parse_ingredient_lines(lines)
+    recipe = dict(recipe)
+    recipe["parsed_ingredients"] = [p.to_dict() for p in parsed if p is not None]
+    recipe["unparsed_ingredients"] = [line for line, p in zip(lines, parsed) if p is None]
+    return recipe
+
 @tool
 def scrape_recipe_info(
     url: Annotated[str, "The URL of the recipe to scrape."]
@@ -40,36 +110,40 @@ def scrape_recipe_info(
         url (str): The URL of the recipe to scrape.
 
     Returns:
-        dict: A dictionary containing the recipe's name, ingredients, instructions, and tags.
+        dict: A dictionary containing the recipe's name, ingredients, instructions, and tags,
+            plus the ingredients parsed into name, quantity, unit and note.
     """
+    from scrape_util import scrape_recipe # Pulls in recipe_scrapers; only needed once scraping starts
+    return _with_parsed_ingredients(through_cassette("scrape_recipe", {"url": url}, lambda: scrape_recipe(url, cache=get_page_cache())))
 
-    out: Dict[str, Optional[List[str]]] = {}
-    out["source"] = url
-    try:
-        scraper = scrape_me(url, wild_mode=True)
-
-        try:
-            ing: List[str] = scraper.ingredients()
-            out["ingredients"] = ing
-        except Exception as e:
-            logger.error(f"Failed to get ingredients: {e}")
-
-        try:
-            inst: List[str] = scraper.instructions_list()
-            out["instructions"] = inst
-        except Exception as e:
-            logger.error(f"Failed to get instructions: {e}")
+@tool
+def scrape_recipes_batch(
+    max_urls: Annotated[Optional[int], "The maximum number of URLs to take from the Pot. If not provided, all URLs are scraped."] = None
+) -> Annotated[Dict[str, Any], "The scraped recipes and any URLs that failed."]:
+    """
+    Takes URLs from the Pot and scrapes them all concurrently.
 
-        try:
-            name: str = scraper.title()
-            out["name"] = name
-        except Exception as e:
-            logger.error(f"Failed to get name: {e}")
+    Args:
+        max_urls (int, optional): The maximum number of URLs to take from the Pot.
 
-        return out
-    except Exception as e:
-        logger.error(f"Failed to scrape recipe: {e}")
-        return out
+    Returns:
+        dict: The scraped recipes (name, ingredients, parsed ingredients, instructions, source) and the URLs that failed.
+    """
+    logger.debug("Scraping recipe URLs from pot in batch.")
+    urls: List[str] = []
+    with get_session() as state:
+        while max_urls is None or len(urls) < max_urls:
+            url = state.pot.pop_url()
+            if url is None:
+                break
+            urls.append(url)
+            state.record("delete_pot_url", url)
+    from scrape_util import scrape_recipes
+    results = through_cassette("scrape_recipes", {"urls": urls}, lambda: scrape_recipes(urls, cache=get_page_cache()))
+    return {
+        "recipes": [_with_parsed_ingredients(r) for r in results if "error" not in r],
+        "failed": [{"source": r["source"], "error": r["error"]} for r in results if "error" in r],
+    }
 
 @tool("generate_ingredient", args_schema=Ingredient)
 def generate_ingredient(
@@ -95,9 +169,9 @@ def generate_recipe(
     logger.debug("Generating representation of Recipe object.")
     logger.debug(f"Name: {name}, Ingredients: {ingredients}, Instructions: {instructions}, Tags: {tags}, Sources: {sources}")
     recipe = Recipe(name=name, ingredients=ingredients, instructions=instructions, tags=tags, sources=sources)
-    pot = load_pot_from_file()
-    pot.add_recipe(recipe)
-    save_pot_to_file(pot)
+    with get_session() as state:
+        state.pot.add_recipe(recipe)
+        state.record("save_pot_recipe", recipe)
     return recipe.tiny()
 
 @tool
@@ -106,13 +180,13 @@ def get_recipe_from_pot(
 ) -> Annotated[Optional[Recipe], "The Recipe object."]:
     """Get the Recipe object with the specified ID from the Pot."""
     logger.debug("Getting recipe from pot.")
-    pot = load_pot_from_file()
-    if recipe_id:
-        out = str(pot.get_recipe(recipe_id))
-    else:
-        out = str(pot.pop_recipe())
-    save_pot_to_file(pot)
-    return out
+    with get_session() as state:
+        if recipe_id:
+            return str(state.pot.get_recipe(recipe_id))
+        recipe = state.pot.pop_recipe()
+        if recipe is not None:
+            state.record("delete_pot_recipe", recipe.get_ID())
+    return str(recipe)
 
 @tool
 def add_url_to_pot(
@@ -120,34 +194,48 @@ def add_url_to_pot(
 ) -> Annotated[str, "Message indicating success or failure."]:
     """Add a URL to the Pot."""
     logger.debug("Adding URL to pot.")
-    pot = load_pot_from_file()
-    pot.add_url(url)
-    save_pot_to_file(pot)
+    with get_session() as state:
+        state.pot.add_url(url)
+        state.record("save_pot_url", url)
     return "URL added to Pot."
 
+@tool
+def add_urls_to_pot(
+    urls: Annotated[List[str], "The URLs of the recipes to add to the Pot."]
+) -> Annotated[str, "Message indicating how many URLs were added."]:
+    """Add several URLs to the Pot at once. Duplicates and URLs already in the Pot are skipped."""
+    logger.debug("Adding URLs to pot.")
+    with get_session() as state:
+        added = state.pot.add_urls(urls)
+        if added:
+            state.record("save_pot_urls", added)
+    return f"{len(added)} of {len(urls)} URLs added to Pot."
+
 @tool
 def pop_url_from_pot() -> Annotated[Optional[str], "The URL popped from the Pot."]:
     """Returns a URL from the Pot."""
     logger.debug("Popping URL from pot.")
-    pot = load_pot_from_file()
-    url = pot.pop_url()
-    save_pot_to_file(pot)
+    with get_session() as state:
+        url = state.pot.pop_url()
+        if url is not None:
+            state.record("delete_pot_url", url)
     return str(url)
 
 @tool
 def examine_pot() -> Annotated[str, "The string representation of the Pot's contents."]:
     """Get the contents of the Pot."""
     logger.debug("Dumping pot.")
-    pot = load_pot_from_file()
-    return str(''.join([str(pot.get_all_recipes()),str(pot.get_all_urls())]))
+    with get_session() as state:
+        pot = state.pot
+        return str(''.join([str(pot.get_all_recipes()),str(pot.get_all_urls())]))
 
 @tool
 def clear_pot() -> Annotated[str, "Message indicating success or failure."]:
     """Clear the Pot of all recipes."""
     logger.debug("Clearing pot.")
-    pot = load_pot_from_file()
-    pot.clear_pot()
-    save_pot_to_file(pot)
+    with get_session() as state:
+        state.pot.clear_pot()
+        state.record("clear_pot")
     return "Pot cleared."
 
 ## Recipe Graph Tools ##
@@ -157,9 +245,9 @@ def create_recipe_graph(
 ) -> Annotated[str, "ID of the newly created foundational recipe node."]:
     """Create a new recipe graph with the provided foundational recipe. Typically used to start a new recipe graph."""
     logger.debug("Creating recipe graph with foundational recipe.")
-    recipe_graph = load_graph_from_file(default_graph_file)
-    node_id = recipe_graph.create_recipe_graph(recipe)
-    save_graph_to_file(recipe_graph, default_graph_file)
+    with get_session() as state:
+        node_id = state.graph.create_recipe_graph(recipe)
+        state.record("save_node", state.graph, node_id)
     return f"Recipe graph created with foundational recipe node ID: {node_id}"
 
 @tool
@@ -168,8 +256,8 @@ def get_recipe(
 ) -> Annotated[Optional[Recipe], "The Recipe object."]:
     """Get the Recipe object at the specified node ID."""
     logger.debug("Getting recipe from recipe graph.")
-    recipe_graph = load_graph_from_file(default_graph_file)
-    recipe = recipe_graph.get_recipe(node_id)
+    with get_session() as state:
+        recipe = state.graph.get_recipe(node_id)
     return str(recipe)
 
 @tool
@@ -178,10 +266,10 @@ def add_node(
 ) -> Annotated[str, "ID of the newly added recipe node."]:
     """Add a new node to the recipe graph with the provided recipe and create an edge from the current foundational recipe."""
     logger.debug("Adding node to recipe graph.")
-    recipe_graph = load_graph_from_file(default_graph_file)
     recipe = Recipe.from_json(recipe_str)
-    node_id = recipe_graph.add_node(recipe)
-    save_graph_to_file(recipe_graph, default_graph_file)
+    with get_session() as state:
+        node_id = state.graph.add_node(recipe)
+        state.record("save_node", state.graph, node_id)
     return f"New recipe node added with ID: {node_id}"
 
 @tool
@@ -190,46 +278,61 @@ def get_node_id(
 ) -> Annotated[Optional[str], "The node ID of the recipe."]:
     """Get the node ID of the foundational recipe."""
     logger.debug("Getting node ID from recipe graph.")
-    recipe_graph = load_graph_from_file(default_graph_file)
     # TODO - see if the given recipe matches any recipe in the graph
-    return str(recipe_graph.get_node_id())
+    with get_session() as state:
+        return str(state.graph.get_node_id())
 
 @tool
 def get_foundational_recipe() -> Annotated[Optional[Recipe], "The current foundational recipe."]:
     """Get the current foundational recipe."""
     logger.debug("Getting foundational recipe from recipe graph.")
-    recipe_graph = load_graph_from_file(default_graph_file)
-    recipe = recipe_graph.get_foundational_recipe()
+    with get_session() as state:
+        recipe = state.graph.get_foundational_recipe()
     return str(recipe)
 
+@tool
+def measure_recipe(
+    node_id: Annotated[Optional[str], "The node ID of the recipe to measure. Defaults to the foundational recipe."] = None,
+    scale: Annotated[Optional[float], "Multiply every amount by this factor, e.g. 2 to double the recipe or 0.5 to halve it."] = None,
+    target_grams: Annotated[Optional[float], "Scale the recipe so its ingredients weigh this many grams in total."] = None,
+) -> Annotated[Any, "Each ingredient's amount in grams, millilitres and baker's percent, with the total and flour weights."]:
+    """Convert a recipe's ingredient amounts to grams and millilitres, optionally scaled, with baker's percentages (each ingredient's weight as a percentage of the flour's). Amounts that cannot be converted are null."""
+    logger.debug("Measuring recipe from recipe graph.")
+    with get_session() as state:
+        recipe = state.graph.get_recipe(node_id)
+    if recipe is None:
+        return {"error": "No recipe to measure."}
+    from recipe_units import measure_ingredients # Pulls in numpy; only needed once a recipe is measured
+    return measure_ingredients(recipe.ingredients, scale, target_grams)
+
 @tool
 def set_foundational_recipe(
     node_id: Annotated[str, "The node ID of the recipe to set as foundational."],
 ) -> Annotated[str, "Message indicating success or failure."]:
     """Set the recipe with the specified node ID as the foundational recipe."""
     logger.debug("Setting foundational recipe in recipe graph.")
-    recipe_graph = load_graph_from_file(default_graph_file)
-    recipe = recipe_graph.get_recipe(node_id)
-    recipe_graph.set_foundational_recipe(recipe)
-    save_graph_to_file(recipe_graph, default_graph_file)
+    with get_session() as state:
+        recipe = state.graph.get_recipe(node_id)
+        state.graph.set_foundational_recipe(recipe)
+        state.record("save_foundational_node", state.graph)
     return f"Foundational recipe set to node ID: {node_id}"
 
 @tool
 def get_graph() -> Annotated[str, "A representation of the current recipe graph."]:
     """Get a representation of the current recipe graph."""
     logger.debug("Getting recipe graph.")
-    recipe_graph = load_graph_from_file(default_graph_file)
-    graph = recipe_graph.get_graph()
-    nodes = [(node, data['recipe'].to_json()) for node, data in graph.nodes(data=True)]
-    edges = list(graph.edges(data=True))
+    with get_session() as state:
+        graph = state.graph.get_graph()
+        nodes = [(node, state.graph.get_recipe(node).to_json()) for node in graph.nodes]
+        edges = list(graph.edges(data=True))
     return f"Recipe Graph: Nodes - {nodes}, Edges - {edges}"
 
 @tool
 def get_graph_size() -> Annotated[str, "The number of nodes in the recipe graph."]:
     """Get the number of nodes in the recipe graph."""
     logger.debug("Getting the number of nodes in the recipe graph.")
-    recipe_graph = load_graph_from_file(default_graph_file)
-    return f"Number of nodes in recipe graph: {recipe_graph.get_graph_size()}"
+    with get_session() as state:
+        return f"Number of nodes in recipe graph: {state.graph.get_graph_size()}"
 
 ## Modifications List Tools ##
 
@@ -248,7 +351,6 @@ def suggest_mod(
     Suggest a modification to be added to the modification list.
     """
     try:
-        mods_list = load_mods_list_from_file(default_mods_list_file)
         modification = RecipeModification(
             priority=priority,
             add_ingredient=add_ingredient,
@@ -259,8 +361,9 @@ def suggest_mod(
             add_tag=add_tag,
             remove_tag=remove_tag
         )
-        mods_list.suggest_mod(modification)
-        save_mods_list_to_file(mods_list, default_mods_list_file)
+        with get_session() as state:
+            state.mods_list.suggest_mod(modification)
+            state.record("save_mod", modification)
         return f"Modification suggested successfully. Mod ID: {modification._id}"
     except Exception as e:
         logger.error(f"Failed to suggest modification: {e}")
@@ -270,8 +373,8 @@ def suggest_mod(
 def get_mods_list() -> Annotated[List[RecipeModification], "The current list of suggested modifications."]:
     """Get the current list of suggested modifications."""
     logger.debug("Getting mods list.")
-    mods_list = load_mods_list_from_file(default_mods_list_file)
-    current_mods_list = mods_list.get_mods_list()
+    with get_session() as state:
+        current_mods_list = state.mods_list.get_mods_list()
     return str(current_mods_list)
 
 @tool
@@ -283,13 +386,14 @@ def apply_mod() -> Annotated[Dict[str, Any], "The result of applying the modific
         dict: The result of applying the modification.
     """
     try:
-        recipe_graph = load_graph_from_file(default_graph_file)
-        mods_list = load_mods_list_from_file(default_mods_list_file)
-        mod, success = mods_list.apply_mod(recipe_graph)
-        save_mods_list_to_file(mods_list, default_mods_list_file)
-        save_graph_to_file(recipe_graph, default_graph_file)
+        with get_session() as state:
+            mod, success = state.mods_list.apply_mod(state.graph)
+            if mod is not None:
+                state.record("delete_mod", mod._id)
+                if success:
+                    state.record("save_node", state.graph, state.graph.get_node_id())
         if mod is not None:
-            return {"modification": mod.to_dict(), "success": success}
+            return {"modification": mod.to_json(), "success": success}
         else:
             return {"error": "No modification was applied."}
     except Exception as e:
@@ -308,10 +412,10 @@ def rank_mod(
     - Larger numerical values indicate lower priority.
     """
     logger.debug("Ranking modification in mods list.")
-    mods_list = load_mods_list_from_file(default_mods_list_file)
-    mods_list.rank_mod(mod_id, new_priority)
-    save_mods_list_to_file(mods_list, default_mods_list_file)
-    updated_mods_list = mods_list.get_mods_list()
+    with get_session() as state:
+        if state.mods_list.rank_mod(mod_id, new_priority):
+            state.record("save_mod", state.mods_list.get_mod(mod_id))
+        updated_mods_list = state.mods_list.get_mods_list()
     return f"Modification reprioritized: {updated_mods_list}"
 
 @tool
@@ -320,9 +424,10 @@ def remove_mod(
 ) -> Annotated[bool, "Indicates whether the modification was successfully removed."]:
     """Remove a modification from the mods list."""
     logger.debug("Removing modification from mods list.")
-    mods_list = load_mods_list_from_file(default_mods_list_file)
-    result = mods_list.remove_mod(mod_id)
-    save_mods_list_to_file(mods_list, default_mods_list_file)
+    with get_session() as state:
+        result = state.mods_list.remove_mod(mod_id)
+        if result:
+            state.record("delete_mod", mod_id)
     if not result:
         return f"Failed to remove modification: {mod_id}"
     else:
@@ -330,7 +435,59 @@ def remove_mod(
 
 ## Recipe Analysis Tools ##
 
-## TODO - Analyze nutritional information
+@tool
+def analyze_nutrition(
+    node_id: Annotated[Optional[str], "The node ID of the recipe to analyze. Defaults to the foundational recipe."] = None,
+    servings: Annotated[Optional[int], "The number of servings the recipe makes, to also report nutrients per serving."] = None,
+) -> Annotated[Any, "The recipe's key nutrient totals, per serving if requested, the food each ingredient was matched to, and the ingredients that could not be counted."]:
+    """Estimate a recipe's nutrients (energy, protein, fat, carbohydrate, fiber, sugars, sodium and more) from its ingredients."""
+    logger.debug("Analyzing nutrition of recipe from recipe graph.")
+    with get_session() as state:
+        recipe = state.graph.get_recipe(node_id)
+    if recipe is None:
+        return {"error": "No recipe to analyze."}
+    from nutrition import analyze_ingredients # Pulls in numpy; only needed once a recipe is analyzed
+    try:
+        return analyze_ingredients(recipe.ingredients, servings)
+    except FileNotFoundError as e:
+        return {"error": str(e)}
+
+@tool
+def compare_mods_nutrition() -> Annotated[Any, "For each suggested modification, the change it would make to the foundational recipe's key nutrients."]:
+    """Estimate how each modification in the mods list would change the foundational recipe's nutrients, without applying any of them."""
+    logger.debug("Comparing nutrition of suggested modifications.")
+    with get_session() as state:
+        recipe = state.graph.get_foundational_recipe()
+        mods = state.mods_list.get_mods_list()
+    if recipe is None:
+        return {"error": "No foundational recipe to compare against."}
+    from nutrition import analyze_recipes, get_nutrient_matrix
+    candidates, entries = [recipe.ingredients], []
+    for mod in mods:
+        entry = {"mod_id": mod._id, "modification": mod.to_json()}
+        candidate = recipe.copy(deep=True)
+        try:
+            candidate.apply_modification(mod)
+        except (ValueError, AttributeError, TypeError) as e:
+            # e.g. removing an instruction the recipe lacks, or tagging a recipe without tags
+            logger.warning(f"Could not apply modification {mod._id} for comparison: {e}")
+            entry["error"] = f"Could not apply modification: {e}"
+        else:
+            entry["candidate"] = len(candidates)
+            candidates.append(candidate.ingredients)
+        entries.append(entry)
+    try:
+        matrix = get_nutrient_matrix()
+        totals = analyze_recipes(candidates, matrix)
+    except FileNotFoundError as e:
+        return {"error": str(e)}
+    for entry in entries:
+        if "candidate" in entry:
+            entry["change"] = matrix.summary(totals[entry.pop("candidate")] - totals[0])
+    return {
+        "foundational": matrix.summary(totals[0]),
+        "modifications": entries,
+    }
 
 ## TODO - Analyze recipe complexity
 
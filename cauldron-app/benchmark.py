@@ -0,0 +1,448 @@
+### OFFLINE END-TO-END BENCHMARK FOR CALDRON ###
+# Builds the full agent graph from prompts_dict with a scripted fake chat model, stubbed
+# web search and a pre-filled offline page cache, then drives multi-turn sessions to
+# measure the framework's own overhead. Needs no network or API keys:
+#   python benchmark.py --sizes 0,100,500 --turns 3 --json bench.json
+# A recorded session can be replayed instead of the scripted one:
+#   python benchmark.py --cassette session.jsonl.gz
+# Startup cost (import-time profile, graph build, agent warm-up) is measured with:
+#   python benchmark.py --startup
+# Regression checks for real ChatOpenAI agents behind a fake endpoint run with:
+#   python benchmark.py --check
+
+import argparse
+import json
+import logging
+import os
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "offline-benchmark")
+os.environ["CALDRON_OFFLINE"] = "1"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import tool
+from langchain_openai import ChatOpenAI
+from logging_util import logger
+import agent_tools
+from agent_defs import prompts_dict
+from cassette import Cassette, use_cassette
+from cauldron_app import build_flow_graph
+from class_defs import Ingredient, Recipe, RecipeModification
+from langchain_util import agent_node, createAgent
+from llm_cache import LLMResponseCache
+from page_cache import get_page_cache
+from search_cache import SearchCache, set_search_cache
+from session_state import fresh_session
+from telemetry import get_telemetry
+from util import llm_model
+
+default_sizes = "0,50,200"
+default_turns = 3
+default_results = 4
+default_script = [
+    "find a recipe for banana bread",
+    "modify the recipe to add a pinch of salt",
+    "what is in the recipe now?",
+]
+
+# Order matters: the routers' prompts start with the same words as Frontman's
+AGENT_MARKERS = [
+    ("You are Caldron\nPostman", "Caldron\nPostman"),
+    ("You are Research\nPostman", "Research\nPostman"),
+    ("You are Caldron,", "Frontman"),
+    ("You are Tavily", "Tavily"),
+    ("You are Sleuth", "Sleuth"),
+    ("You are ModSquad", "ModSquad"),
+    ("You are KnowItAll", "KnowItAll"),
+    ("You are Spinnaret", "Spinnaret"),
+]
+
+FIXTURE_RECIPE = {
+    "name": "Benchmark Banana Bread",
+    "ingredients": [
+        {"name": "banana", "quantity": 3, "unit": None},
+        {"name": "flour", "quantity": 2, "unit": "cups"},
+        {"name": "sugar", "quantity": 0.5, "unit": "cup"},
+    ],
+    "instructions": ["Mash the bananas.", "Mix everything together.", "Bake for an hour."],
+    "tags": ["bread"],
+    "sources": [],
+}
+
+## Scripted Chat Model
+class ScriptedChatModel(BaseChatModel):
+    """Deterministic stand-in for ChatOpenAI that plays each agent's part by rule.
+
+    Routers answer through the bound `route` function and agents through OpenAI tool calls,
+    so the real prompt templates, output parsers and AgentExecutor loops all run.
+    """
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-benchmark"
+
+    def bind_functions(self, functions: List[Dict[str, Any]], function_call: Optional[str] = None, **kwargs: Any):
+        # Mirrors ChatOpenAI.bind_functions, which createRouter relies on
+        return self.bind(functions=functions, function_call={"name": function_call}, **kwargs)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        system = "\n".join(str(m.content) for m in messages if isinstance(m, SystemMessage))
+        agent = next((name for marker, name in AGENT_MARKERS if marker in system), None)
+        if "functions" in kwargs:
+            message = _route_message(agent, messages)
+        else:
+            message = _agent_message(agent, messages)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+def _conversation(messages: List[BaseMessage]) -> Tuple[List[BaseMessage], List[Tuple[str, str]]]:
+    # Split into the graph's messages and this agent's own tool calls (the scratchpad)
+    steps: List[Tuple[str, str]] = []
+    while messages and isinstance(messages[-1], ToolMessage):
+        steps.insert(0, (messages[-1].tool_call_id.split(":")[0], str(messages[-1].content)))
+        messages = messages[:-2] if len(messages) > 1 and isinstance(messages[-2], AIMessage) else messages[:-1]
+    return [m for m in messages if not isinstance(m, SystemMessage)], steps
+
+def _route_message(router: Optional[str], messages: List[BaseMessage]) -> AIMessage:
+    history, _ = _conversation(messages)
+    last = history[-1] if history else None
+    sender = getattr(last, "name", None)
+    request = next((str(m.content) for m in history if isinstance(m, HumanMessage)), "")
+    if router == "Research\nPostman":
+        target = {None: "Tavily", "Tavily": "Sleuth"}.get(sender, "Caldron\nPostman")
+    elif isinstance(last, HumanMessage):
+        if request.startswith("find"):
+            target = "Research\nPostman"
+        elif request.startswith("modify"):
+            target = "ModSquad"
+        else:
+            target = "KnowItAll"
+    elif sender in ("Tavily", "Sleuth", "ModSquad"):
+        target = "Spinnaret"
+    else:
+        target = "FINISH"
+    arguments = json.dumps({"next": target, "sender": router})
+    return AIMessage(content="", additional_kwargs={"function_call": {"name": "route", "arguments": arguments}})
+
+def _call(tool: str, step: int, **args: Any) -> AIMessage:
+    call = {"id": f"{tool}:{step}", "type": "function", "function": {"name": tool, "arguments": json.dumps(args)}}
+    return AIMessage(content="", additional_kwargs={"tool_calls": [call]})
+
+def _agent_message(agent: Optional[str], messages: List[BaseMessage]) -> AIMessage:
+    history, steps = _conversation(messages)
+    done = [tool for tool, _ in steps]
+    last_output = steps[-1][1] if steps else ""
+    task = str(history[-1].content) if history else ""
+    if agent == "Tavily":
+        if not done:
+            return _call("cached_search", 0, query=task)
+        if done == ["cached_search"]:
+            urls = [result["url"] for result in json.loads(last_output)]
+            return _call("add_urls_to_pot", 1, urls=urls)
+    elif agent == "Sleuth":
+        url = re.search(r"https?://\S+", task)
+        if not done and url:
+            return _call("scrape_recipe_info", 0, url=url.group(0))
+        if done == ["scrape_recipe_info"]:
+            scraped = json.loads(last_output)
+            ingredients = [{"name": line, "quantity": 1, "unit": None} for line in scraped.get("ingredients", [])]
+            return _call(
+                "generate_recipe", 1,
+                name=scraped.get("name", "Recipe"),
+                ingredients=ingredients,
+                instructions=scraped.get("instructions", []),
+                sources=[scraped.get("source", "")],
+            )
+    elif agent == "Spinnaret":
+        if not done:
+            return _call("get_graph", 0)
+        if done == ["get_graph"] and "Nodes - []" in last_output:
+            return _call("create_recipe_graph", 1, recipe=FIXTURE_RECIPE)
+    elif agent == "ModSquad":
+        if not done:
+            return _call("suggest_modification", 0, priority=1, add_ingredient={"name": "salt", "quantity": 1, "unit": "pinch"})
+        if done == ["suggest_modification"]:
+            return _call("apply_mod", 1)
+    elif agent == "KnowItAll":
+        if not done:
+            return _call("get_foundational_recipe", 0)
+    # Frontman answers without calling clear_pot, which would empty the seeded Pot after the first turn
+    return AIMessage(content=f"{agent} finished: {', '.join(done) or 'no tools needed'}.")
+
+## Stubbed Web
+def _recipe_page(url: str, index: int) -> str:
+    data = {
+        "@context": "https://schema.org",
+        "@type": "Recipe",
+        "name": f"Banana Bread #{index}",
+        "recipeIngredient": ["3 bananas", "2 cups flour", "1/2 cup sugar", f"{index} tbsp butter"],
+        "recipeInstructions": [{"@type": "HowToStep", "text": f"Step {i + 1} of recipe {index}."} for i in range(4)],
+    }
+    return f'<html><head><title>{data["name"]}</title><script type="application/ld+json">{json.dumps(data)}</script></head><body></body></html>'
+
+class StubSearch:
+    """Replaces the Tavily tool: returns fixed results and stores their pages in the offline page cache."""
+    def __init__(self, results: int = default_results) -> None:
+        self.results = results
+
+    def invoke(self, input: Dict[str, str]) -> List[Dict[str, str]]:
+        slug = "-".join(re.findall(r"\w+", input["query"].lower()))
+        urls = [f"https://bench.example/{slug}-{i}" for i in range(self.results)]
+        for i, url in enumerate(urls):
+            if get_page_cache().get(url) is None:
+                get_page_cache().put(url, _recipe_page(url, i))
+        return [{"url": url, "content": f"Result {i} for {input['query']}"} for i, url in enumerate(urls)]
+
+## Harness
+def seed_state(session, size: int) -> None:
+    """Pre-fill the Pot with `size` recipes and grow the Recipe Graph to `size` nodes."""
+    if size == 0:
+        return
+    with session as state:
+        for i in range(size):
+            recipe = Recipe(name=f"Seed {i}", ingredients=[Ingredient(name="flour", quantity=i + 1, unit="g")], instructions=["Mix."])
+            state.pot.add_recipe(recipe)
+            state.record("save_pot_recipe", recipe)
+        node_id = state.graph.create_recipe_graph(Recipe.parse_obj(FIXTURE_RECIPE))
+        state.record("save_node", state.graph, node_id)
+        for i in range(size - 1):
+            mod = RecipeModification(priority=1, add_instruction=f"Seed step {i}.")
+            node_id = state.graph.add_modification(mod)
+            state.record("save_node", state.graph, node_id)
+    session.flush()
+
+def run_session(chain, session, script: List[str]) -> List[Dict[str, Any]]:
+    telemetry = get_telemetry()
+    turns = []
+    for prompt in script:
+        telemetry.start_turn()
+        steps = 0
+        start = time.perf_counter()
+        for _ in chain.stream({"messages": [HumanMessage(content=prompt)], "sender": "User", "next": "Caldron\nPostman"}, {"recursion_limit": 50}):
+            session.flush() # Same per-step persistence as CaldronApp
+            steps += 1
+        wall = time.perf_counter() - start
+        stats = telemetry.end_turn()
+        node_wall = sum(s["wall"] for s in stats.values() if s["calls"])
+        tool_time = sum(total for s in stats.values() for _, total in s["tools"].values())
+        llm_time = sum(e["dur"] for e in telemetry.events if e["turn"] == telemetry.turn and e["cat"] == "llm")
+        with session as state:
+            graph_size, pot_size = state.graph.get_graph_size(), len(state.pot.get_all_recipes())
+        turns.append({
+            "prompt": prompt,
+            "wall_ms": wall * 1e3,
+            "steps": steps,
+            "graph_overhead_ms": (wall - node_wall) * 1e3,
+            "agent_overhead_ms": (node_wall - tool_time - llm_time) * 1e3,
+            "llm_ms": llm_time * 1e3,
+            "tool_ms": tool_time * 1e3,
+            "state_io_ms": sum(s["io"] for s in stats.values()) * 1e3,
+            "graph_size": graph_size,
+            "pot_size": pot_size,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        })
+    return turns
+
+def run_benchmark(
+    sizes: List[int],
+    turns: int = default_turns,
+    results: int = default_results,
+    cassette: Optional[str] = None,
+) -> Dict[int, List[Dict[str, Any]]]:
+    """Run the scripted session (or a replayed cassette) once per seeded size."""
+    script = default_script * turns
+    recording = None
+    if cassette is not None:
+        # Replay real traffic: ChatOpenAI is answered entirely from the recording
+        recording = use_cassette(os.path.abspath(cassette), "replay")
+        llm = ChatOpenAI(model=llm_model, temperature=0, cache=recording)
+        script = recording.turns
+    else:
+        llm = ScriptedChatModel()
+    workdir = tempfile.mkdtemp(prefix="caldron_bench_")
+    os.chdir(workdir) # The state store, page cache and logs all use relative paths
+    set_search_cache(SearchCache(":memory:"))
+    agent_tools.tavily_search_tool = StubSearch(results)
+    flow_graph, _, _ = build_flow_graph(llm, prompts_dict)
+    chain = flow_graph.compile()
+    report = {}
+    for size in sizes:
+        if recording is not None:
+            recording.rewind()
+        session = fresh_session(flush_interval=None)
+        seed_state(session, size)
+        get_telemetry().reset()
+        report[size] = run_session(chain, session, script)
+    return report
+
+## Self-Checks
+def _fake_openai(requests: List[httpx.Request]) -> httpx.MockTransport:
+    """A chat completions endpoint that calls fixed_clock once, then answers. Streaming requests fail."""
+    def reply(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        body = json.loads(request.content)
+        if body.get("stream"):
+            raise httpx.ConnectError("streaming request", request=request)
+        if any(m["role"] == "tool" for m in body["messages"]):
+            message = {"role": "assistant", "content": "It is now."}
+        else:
+            call = {"id": "call_0", "type": "function", "function": {"name": "fixed_clock", "arguments": "{}"}}
+            message = {"role": "assistant", "content": None, "tool_calls": [call]}
+        return httpx.Response(200, json={
+            "id": "check", "object": "chat.completion", "created": 0, "model": llm_model,
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 40, "completion_tokens": 7, "total_tokens": 47},
+        })
+    return httpx.MockTransport(reply)
+
+@tool
+def fixed_clock() -> str:
+    """Get the current date and time."""
+    # Fixed so repeated turns send identical prompts
+    return "2026-01-01 12:00:00"
+
+def _check_agent(cache, requests: List[httpx.Request]) -> str:
+    llm = ChatOpenAI(model=llm_model, temperature=0, cache=cache, http_client=httpx.Client(transport=_fake_openai(requests)))
+    agent = createAgent("Check", "You are a test agent.", llm, [fixed_clock])
+    # Run it as a graph node would, with the telemetry and cassette callbacks attached
+    update = agent_node({"messages": [HumanMessage(content="What time is it?")]}, agent, "Check")
+    return update["messages"][-1].content
+
+def check_agent_replay(workdir: str) -> None:
+    """A replayed agent turn is answered from the cassette without touching the network."""
+    filename = os.path.join(workdir, "check.jsonl.gz")
+    recorded: List[httpx.Request] = []
+    recording = Cassette(filename, "record")
+    output = _check_agent(recording, recorded)
+    recording.close()
+    assert recorded, "the recording run never reached the endpoint"
+    replayed: List[httpx.Request] = []
+    assert _check_agent(Cassette(filename, "replay"), replayed) == output
+    assert not replayed, f"replay sent {len(replayed)} request(s) to the network"
+
+def check_agent_cache(workdir: str) -> None:
+    """A repeated agent turn is answered from the response cache, even by a new model and client."""
+    cache = LLMResponseCache(os.path.join(workdir, "llm_cache.db"))
+    first: List[httpx.Request] = []
+    output = _check_agent(cache, first)
+    assert first and cache.stats()["hits"] == 0
+    second: List[httpx.Request] = []
+    assert _check_agent(cache, second) == output
+    assert not second, f"a cached agent turn sent {len(second)} request(s)"
+    assert cache.stats()["hits"] == len(first)
+
+def check_agent_tokens(workdir: str) -> None:
+    """Token usage reported by the endpoint for an agent's calls lands on that agent's span."""
+    get_telemetry().reset()
+    requests: List[httpx.Request] = []
+    _check_agent(False, requests)
+    stats = get_telemetry().summary()["Check"]
+    assert stats["llm_calls"] == len(requests) == 2
+    assert stats["prompt_tokens"] == 80 and stats["completion_tokens"] == 14, stats
+    get_telemetry().reset()
+
+def check_seeded_pot(workdir: str, size: int = 20) -> None:
+    """The seeded Pot and Recipe Graph keep their size through every timed turn."""
+    turns = run_benchmark([size], turns=1)[size]
+    for turn in turns:
+        assert turn["pot_size"] >= size, f"Pot shrank below its seeded size: {turn['pot_size']} < {size} after {turn['prompt']!r}"
+        assert turn["graph_size"] >= size, f"Recipe Graph shrank below its seeded size: {turn['graph_size']} < {size}"
+
+def run_checks() -> None:
+    workdir = tempfile.mkdtemp(prefix="caldron_check_")
+    for check in [check_agent_replay, check_agent_cache, check_agent_tokens, check_seeded_pot]:
+        check(workdir)
+        print(f"ok  {check.__name__}")
+
+## Startup Profile
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+import cauldron_app
+imported = time.perf_counter()
+chain, flow_graph, agents, _, _ = cauldron_app.get_compiled_graph("gpt-3.5-turbo")
+compiled = time.perf_counter()
+cauldron_app.warm_agents(agents)
+warmed = time.perf_counter()
+print(json.dumps({"import_s": imported - start, "graph_s": compiled - imported, "warmup_s": warmed - compiled}))
+"""
+
+def profile_startup(top: int = 15) -> Dict[str, Any]:
+    """Time a cold start in fresh interpreters: imports (with -X importtime), graph build and agent warm-up.
+
+    Time to first prompt is the import plus graph time; warm-up runs in the background.
+    """
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [app_dir, os.getenv("PYTHONPATH")])))
+    workdir = tempfile.mkdtemp(prefix="caldron_startup_")
+    probe = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    timings = json.loads(probe.stdout.strip().splitlines()[-1])
+    imports = subprocess.run([sys.executable, "-X", "importtime", "-c", "import cauldron_app"], cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    modules = []
+    for line in imports.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+        if match:
+            modules.append((int(match.group(2)) / 1e6, int(match.group(1)) / 1e6, len(match.group(3)) // 2, match.group(4)))
+    timings["slowest_imports"] = [
+        {"module": name, "cumulative_s": cumulative, "self_s": own}
+        for cumulative, own, depth, name in sorted((m for m in modules if m[2] <= 2), reverse=True)[:top]
+    ]
+    return timings
+
+def print_startup(timings: Dict[str, Any]) -> None:
+    print(f"import cauldron_app: {timings['import_s'] * 1e3:8.1f} ms")
+    print(f"build + compile:     {timings['graph_s'] * 1e3:8.1f} ms")
+    print(f"first prompt after:  {(timings['import_s'] + timings['graph_s']) * 1e3:8.1f} ms")
+    print(f"agent warm-up:       {timings['warmup_s'] * 1e3:8.1f} ms (background)")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for module in timings["slowest_imports"]:
+        print(f"{module['cumulative_s'] * 1e3:>14.1f} {module['self_s'] * 1e3:>9.1f}  {module['module']}")
+
+def print_report(report: Dict[int, List[Dict[str, Any]]]) -> None:
+    columns = ["wall_ms", "steps", "graph_overhead_ms", "agent_overhead_ms", "llm_ms", "tool_ms", "state_io_ms", "graph_size", "pot_size", "max_rss_mb"]
+    print(f"{'size':>6} {'turn':>4} " + " ".join(f"{c:>17}" for c in columns))
+    for size, turns in report.items():
+        for i, turn in enumerate(turns):
+            print(f"{size:>6} {i:>4} " + " ".join(f"{turn[c]:>17.2f}" for c in columns))
+        medians = {c: statistics.median(t[c] for t in turns) for c in columns}
+        print(f"{size:>6} {'med':>4} " + " ".join(f"{medians[c]:>17.2f}" for c in columns))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the Caldron agent graph.")
+    parser.add_argument("--sizes", default=default_sizes, help="Comma-separated Pot/Recipe Graph sizes to seed before each session.")
+    parser.add_argument("--turns", type=int, default=default_turns, help="How many times to repeat the scripted conversation.")
+    parser.add_argument("--results", type=int, default=default_results, help="Search results (and so Sleuth branches) per search.")
+    parser.add_argument("--cassette", help="Replay the turns and traffic of a recorded cassette instead of the scripted session.")
+    parser.add_argument("--startup", action="store_true", help="Profile cold-start imports, graph build and agent warm-up instead.")
+    parser.add_argument("--check", action="store_true", help="Run the offline regression checks instead.")
+    parser.add_argument("--json", help="Also write the raw per-turn numbers to this file.")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    json_path = os.path.abspath(args.json) if args.json else None
+    if args.check:
+        run_checks()
+        sys.exit(0)
+    if args.startup:
+        timings = profile_startup()
+        print_startup(timings)
+        if json_path:
+            with open(json_path, 'w') as file:
+                json.dump(timings, file, indent=2)
+        sys.exit(0)
+    report = run_benchmark([int(size) for size in args.sizes.split(",")], args.turns, args.results, args.cassette)
+    print_report(report)
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,197 @@
+import atexit
+import gzip
+import json
+import os
+import threading
+import warnings
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+from uuid import UUID
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.load import dumps, loads
+from logging_util import logger
+# Shared with the response cache so both key a model's calls the same way
+from llm_cache import _hash, _model_key
+
+cassette_version = 1
+cassette_modes = ("record", "replay")
+
+warnings.filterwarnings("ignore", message="The function `loads` is in beta.")
+
+def _args_key(name: str, args: Dict[str, Any]) -> str:
+    return _hash(name, json.dumps(args, sort_keys=True, default=str))
+
+class CassetteCallback(BaseCallbackHandler):
+    """Records the input and output of every tool call into a recording Cassette."""
+    def __init__(self, cassette: 'Cassette') -> None:
+        self.cassette = cassette
+        self._inputs: Dict[UUID, Any] = {}
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._inputs[run_id] = (serialized.get("name", "tool"), input_str)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._inputs.pop(run_id, None)
+        if started is not None:
+            self.cassette._write({"kind": "tool", "name": started[0], "input": started[1], "output": str(output)})
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._inputs.pop(run_id, None)
+        if started is not None:
+            self.cassette._write({"kind": "tool", "name": started[0], "input": started[1], "error": str(error)})
+
+class Cassette(BaseCache):
+    """Gzipped JSONL recording of a session's LLM and external tool traffic.
+
+    A Cassette is passed to the chat models as their LangChain cache. In "record" mode it
+    lets every call through and writes each response, each external tool result (see
+    `through_cassette`), each tool call and each user turn as it happens. In "replay"
+    mode LLM calls and external tools are answered from the recording and nothing touches
+    the network. Responses are matched on the exact prompt first. If that fails, they are
+    matched in recorded order for the same model binding, which tolerates the random
+    recipe and node IDs that differ from run to run. Tools that only touch the session
+    state still run for real during replay.
+    """
+    def __init__(self, filename: str, mode: str = "replay") -> None:
+        if mode not in cassette_modes:
+            raise ValueError(f"Cassette mode must be one of {cassette_modes}, not {mode!r}.")
+        logger.info(f"Opening cassette {filename} in {mode} mode.")
+        self.filename = filename
+        self.mode = mode
+        self.callback = CassetteCallback(self)
+        self.turns: List[str] = []
+        self._lock = threading.Lock()
+        self._file = None
+        if mode == "replay":
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            self._file = gzip.open(filename, 'wt', encoding='utf-8')
+            self._write({"kind": "header", "version": cassette_version})
+
+    def _load(self) -> None:
+        self.turns = []
+        # Recorded LLM responses and external results are indexed both by their exact
+        # request and by model binding/tool name; each entry is served at most once
+        self._entries: List[Any] = []
+        self._consumed: set = set()
+        self._by_key: Dict[str, Deque[int]] = defaultdict(deque)
+        self._by_group: Dict[str, Deque[int]] = defaultdict(deque)
+        entries = []
+        try:
+            with gzip.open(self.filename, 'rt', encoding='utf-8') as file:
+                for line in file:
+                    entries.append(json.loads(line))
+        except (EOFError, ValueError):
+            # A recording cut short by a crash is still usable up to its last full entry
+            logger.warning(f"Cassette {self.filename} is truncated; replaying what was recorded.")
+        for entry in entries:
+            if entry["kind"] == "llm":
+                self._index(entry["key"], entry["llm"], entry["generations"])
+            elif entry["kind"] == "external":
+                self._index(entry["key"], entry["name"], entry["result"])
+            elif entry["kind"] == "turn":
+                self.turns.append(entry["content"])
+        logger.info(f"Loaded {len(self._entries)} recorded results and {len(self.turns)} turns from {self.filename}.")
+
+    def _index(self, key: str, group: str, value: Any) -> None:
+        self._by_key[key].append(len(self._entries))
+        self._by_group[group].append(len(self._entries))
+        self._entries.append(value)
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        if self._file is None:
+            return
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def _take(self, key: str, group: str) -> Any:
+        # Callers hold self._lock
+        for queue in (self._by_key[key], self._by_group[group]):
+            while queue:
+                index = queue.popleft()
+                if index not in self._consumed:
+                    self._consumed.add(index)
+                    return self._entries[index]
+        raise LookupError(f"Cassette {self.filename} has no recorded result left for this call.")
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if self.mode == "record":
+            return None
+        with self._lock:
+            llm_string = _model_key(llm_string)
+            generations = self._take(_hash(llm_string, prompt), _hash(llm_string))
+        return [loads(generation) for generation in generations]
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        llm_string = _model_key(llm_string)
+        self._write({
+            "kind": "llm",
+            "key": _hash(llm_string, prompt),
+            "llm": _hash(llm_string),
+            "generations": [dumps(generation) for generation in return_val],
+        })
+
+    def clear(self, **kwargs: Any) -> None:
+        pass
+
+    def external(self, name: str, args: Dict[str, Any], call: Callable[[], Any]) -> Any:
+        """Record or replay the result of a call that leaves the process (search, scraping)."""
+        key = _args_key(name, args)
+        if self.mode == "record":
+            result = call()
+            self._write({"kind": "external", "name": name, "key": key, "args": args, "result": result})
+            return result
+        with self._lock:
+            return self._take(key, name)
+
+    def rewind(self) -> None:
+        """Start replaying from the beginning of the recording again."""
+        if self.mode == "replay":
+            with self._lock:
+                self._load()
+
+    def record_turn(self, content: str) -> None:
+        self._write({"kind": "turn", "content": content})
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+_cassette: Optional[Cassette] = None
+_cassette_checked = False
+
+def use_cassette(filename: str, mode: str = "replay") -> Cassette:
+    """Install a process-wide Cassette. Call before the agents are created."""
+    global _cassette, _cassette_checked
+    if _cassette is not None:
+        _cassette.close()
+    _cassette = Cassette(filename, mode)
+    _cassette_checked = True
+    atexit.register(_cassette.close)
+    return _cassette
+
+def get_cassette() -> Optional[Cassette]:
+    """Return the active Cassette, if any.
+
+    Set CALDRON_CASSETTE to a file path (and CALDRON_CASSETTE_MODE to "record" or
+    "replay", default "replay") to enable one without code changes.
+    """
+    global _cassette_checked
+    if not _cassette_checked:
+        _cassette_checked = True
+        filename = os.getenv("CALDRON_CASSETTE")
+        if filename:
+            use_cassette(filename, os.getenv("CALDRON_CASSETTE_MODE", "replay"))
+    return _cassette
+
+def through_cassette(name: str, args: Dict[str, Any], call: Callable[[], Any]) -> Any:
+    """Run `call` normally, or record/replay its result when a Cassette is active."""
+    cassette = get_cassette()
+    if cassette is None:
+        return call()
+    return cassette.external(name, args, call)
@@ -3,79 +3,88 @@
 ### IMPORTS ###
 import warnings
 from logging_util import logger
-from langchain_util import ChatOpenAI, workflow, enter_chain, HumanMessage
-from class_defs import fresh_graph, fresh_mods_list, load_graph_from_file, fresh_pot, default_pot_file, load_pot_from_file
-from agent_defs import create_all_agents, prompts_dict, form_edges, create_conditional_edges
+from langchain_util import workflow, enter_chain
+from session_state import fresh_session
+from llm_cache import get_llm_cache
+from telemetry import get_telemetry
+from cassette import get_cassette
+from agent_defs import create_all_agents, warm_agents, prompts_dict, form_edges, create_conditional_edges
 from custom_print import printer
-import matplotlib.pyplot as plt
-import networkx as nx
+from flow_visualizer import FlowVisualizer
 import threading
+import os
+from datetime import datetime
 
 warnings.filterwarnings("ignore", message="Parent run .* not found for run .* Treating as a root run.")
 
 ### DEFINITIONS ###
 
+def build_flow_graph(llm, defs=prompts_dict, agents=None):
+    """Create every agent in `defs` (unless given) and wire them into an uncompiled LangGraph workflow."""
+    if agents is None:
+        agents = create_all_agents(llm, defs)
+    flow_graph = workflow()
+    for node_name, node in agents.items():
+        flow_graph.add_node(node_name, node)
+    direct_edges = form_edges(flow_graph)
+    conditional_edges = create_conditional_edges(flow_graph)
+    flow_graph.set_entry_point("Caldron\nPostman")
+    return flow_graph, direct_edges, conditional_edges
+
+_compiled_graphs = {}
+
+def get_compiled_graph(llm, defs=prompts_dict):
+    """Build and compile the flow graph once per model and agent definitions.
+
+    Returns the compiled chain, the uncompiled workflow, the agent nodes and the direct
+    and conditional edges.
+    """
+    key = (llm if isinstance(llm, str) else id(llm), id(defs))
+    if key not in _compiled_graphs:
+        agents = create_all_agents(llm, defs)
+        flow_graph, direct_edges, conditional_edges = build_flow_graph(llm, defs, agents)
+        _compiled_graphs[key] = (flow_graph.compile(), flow_graph, agents, direct_edges, conditional_edges)
+    return _compiled_graphs[key]
+
 class CaldronApp():
     
-    def __init__(self, db_path, llm_model, defs=prompts_dict, verbose=False):
+    def __init__(self, db_path, llm_model, defs=prompts_dict, verbose=False, visualize=True):
         
         logger.info("Initializing Caldron Application")
 
         #Pathways and Parameters
         self.db = db_path
-        self.llm = ChatOpenAI(model=llm_model, temperature=0)
+        self.llm = llm_model # Created with the first agent that needs it
 
         #Central Data Structures
-        self.recipe_pot_file = fresh_pot()
-        self.recipe_graph_file = fresh_graph()
-        self.mods_list_file = fresh_mods_list()
-
-        ##Determine Agent Structure
-        self.agents = create_all_agents(self.llm, defs)
-
-        # Define the control flow
-        self.flow_graph = workflow()
-        self.display_graph = nx.DiGraph()
-        for node_name, node in self.agents.items():
-            self.flow_graph.add_node(node_name, node)
-            self.display_graph.add_node(node_name)
+        self.session = fresh_session()
 
-        direct_edges = form_edges(self.flow_graph)
-        for edge in direct_edges:
-            self.display_graph.add_edge(*edge)
-        conditional_edges = create_conditional_edges(self.flow_graph)
-
-        self.flow_graph.set_entry_point("Caldron\nPostman")
-        self.chain = self.flow_graph.compile()
+        ##Determine Agent Structure & Control Flow
+        self.chain, self.flow_graph, self.agents, direct_edges, conditional_edges = get_compiled_graph(self.llm, defs)
+        # Build the agents and import their heavy dependencies while the user types
+        self.warmup_thread = threading.Thread(target=warm_agents, args=(self.agents,), name="agent-warmup", daemon=True)
+        self.warmup_thread.start()
 
         labeldict = {"__end__": "USER"}
         for node_name, node in prompts_dict.items():
             labeldict[node_name] = node["label"]
 
-        ## Update Visualization
-        def update_graph(self, node_colors=["#457b9d" for n in self.display_graph.nodes()]):
-            plt.clf()
-            #plt.legend(["Sender", "Receiver"], loc="upper left")
-            nx.draw_networkx_nodes(self.display_graph, self.node_pos, node_size=3000, node_color=node_colors)
-            nx.draw_networkx_edges(self.display_graph, self.node_pos, edgelist=direct_edges, style='solid', connectionstyle='arc3,rad=0.2', arrows=True)
-            nx.draw_networkx_edges(self.display_graph, self.node_pos, edgelist=conditional_edges, style='dotted', connectionstyle='arc3,rad=0.2', arrows=True)
-            nx.draw_networkx_labels(self.display_graph, self.node_pos, labels=labeldict, font_size=10, font_weight="bold")
-            plt.draw()
-
-        ## Visualization Thread
-        def visualize_graph(self):
-            plt.ion()
-
-            # Get positions for the nodes
-            self.node_pos = nx.shell_layout(self.display_graph)
-            update_graph(self)
+        ## Visualization Process
+        self.visualizer = FlowVisualizer(list(self.flow_graph.nodes), direct_edges, conditional_edges, labeldict)
+        if visualize:
+            self.visualizer.start()
 
         ## Simple Interaction Thread
         def simple_interaction_loop(self):
+            from langchain_core.messages import HumanMessage
             i = input("Enter a message: ")
             msq_queue = []
             msq_queue.append(HumanMessage(content=i))
+            trace_file = os.path.join("logs", f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
             while i != "exit":
+                if get_cassette() is not None:
+                    get_cassette().record_turn(i)
+                get_telemetry().start_turn()
                 for s in self.chain.stream(
                     {
                         "messages": [msq_queue.pop()],
@@ -84,6 +93,7 @@ class CaldronApp():
                     },
                     {"recursion_limit": 50}
                 ):
+                    self.session.flush() # Persist this step's state changes before moving on
                     print("--------------------")
                     if 'Frontman' in s.keys():
                         print("\n")
@@ -91,34 +101,25 @@ class CaldronApp():
                         print("\n")
                     else:
                         print(s)
-                        #pot = load_pot_from_file(self.recipe_pot_file)
+                        #pot = self.session.pot
                         #print(pot.get_all_recipes())
 
-                    # Change node color if its name matches a key in s
-                    if 'next' in s[list(s.keys())[0]].keys():
-                        update_graph(self)
-                        plt.pause(0.1)
-                        c = []
-                        for n in self.display_graph.nodes():
-                            if n == "Frontman":
-                                n = 'FINISH' 
-                            if n == s[list(s.keys())[0]]['sender']:
-                                c.append("#a8dadc")
-                            elif n == s[list(s.keys())[0]]['next']:
-                                c.append("#e63946")
-                            else:
-                                c.append("#457b9d")
-                        update_graph(self, node_colors=c)
-                        plt.pause(0.1)
-                    
-                graph = load_graph_from_file(self.recipe_graph_file)
-                printer.pprint(graph.get_foundational_recipe())
-                update_graph(self)
+                    # Highlight the node that just ran and the one it routed to
+                    update = s[list(s.keys())[0]]
+                    if 'next' in update.keys():
+                        self.visualizer.highlight(update['sender'], update['next'])
+
+                with self.session as state:
+                    printer.pprint(state.graph.get_foundational_recipe())
+                logger.info(f"LLM cache stats: {get_llm_cache().stats()}")
+                get_telemetry().end_turn()
+                get_telemetry().export_jsonl(f"{trace_file}.jsonl")
+                get_telemetry().export_chrome_trace(f"{trace_file}.json")
+                self.visualizer.reset()
                 i = input("Enter a message: ")
                 msq_queue.append(HumanMessage(content=i))
 
         ## Start Threads
-        self.visualize_thread = threading.Thread(target=visualize_graph(self))
         self.interface_thread = threading.Thread(target=simple_interaction_loop(self))
-        self.visualize_thread.start()
-        self.interface_thread.start()
\ No newline at end of file
+        self.interface_thread.start()
+        self.visualizer.close()
\ No newline at end of file
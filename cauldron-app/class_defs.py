@@ -4,14 +4,18 @@ import os
 import ujson
 import networkx as nx
 import heapq
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
 from typing import List, Dict, Optional, Any, Tuple, Type, TypeVar
 from logging_util import logger
-from langchain.pydantic_v1 import BaseModel, Field, PrivateAttr
+from langchain.pydantic_v1 import BaseModel, Field, PrivateAttr, validator
 
 T = TypeVar('T')
 default_mods_list_file = "mods_list.pkl"
 default_graph_file="recipe_graph.pkl"
 default_pot_file="recipe_pot.pkl"
+default_keyframe_interval = 8
+default_recipe_cache_size = 64
 
 class Ingredient(BaseModel):
     """Model for an ingredient in a recipe."""
@@ -46,7 +50,7 @@ class RecipeModification(BaseModel):
     remove_tag: Optional[str] = None
 
     # Private attribute
-    _id: str = PrivateAttr(default=str(uuid.uuid4()))
+    _id: str = PrivateAttr(default_factory=lambda: str(uuid.uuid4()))
 
     class Config:
         json_loads = ujson.loads
@@ -72,7 +76,7 @@ class Recipe(BaseModel):
     sources: List[str] = Field(default=None, description="List of sources for the recipe")
 
     # Private attribute
-    _id: str = PrivateAttr(default=str(uuid.uuid4()))
+    _id: str = PrivateAttr(default_factory=lambda: str(uuid.uuid4()))
     
     class Config:
         json_loads = ujson.loads
@@ -134,11 +138,34 @@ class Recipe(BaseModel):
         return False
 
 class RecipeGraph:
-    """Model for a recipe graph."""
-    def __init__(self) -> None:
+    """Model for a recipe graph.
+
+    Nodes produced by a RecipeModification store only that modification and their parent
+    node. The root and every `keyframe_interval`-th node along a chain store the full
+    Recipe, so materializing any node replays fewer than `keyframe_interval` modifications.
+    Recently materialized recipes are kept in an LRU cache. A `keyframe_interval` of 1
+    stores a full Recipe on every node.
+    """
+    def __init__(self, keyframe_interval: int = default_keyframe_interval, cache_size: int = default_recipe_cache_size) -> None:
         logger.info("Initializing RecipeGraph object.")
         self.graph = nx.DiGraph()
-        self.foundational_recipe_node: Optional[Recipe] = None
+        self.foundational_recipe_node: Optional[str] = None
+        self.keyframe_interval = keyframe_interval
+        self.cache_size = cache_size
+        self._recipe_cache: OrderedDict[str, Recipe] = OrderedDict()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Materialized recipes are derived data; leave them out of pickles
+        state = self.__dict__.copy()
+        state['_recipe_cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # Graphs pickled before delta encoding stored a full Recipe on every node
+        state.setdefault('keyframe_interval', 1)
+        state.setdefault('cache_size', default_recipe_cache_size)
+        state.setdefault('_recipe_cache', OrderedDict())
+        self.__dict__.update(state)
 
     def get_graph_size(self) -> int:
         logger.debug("Getting the number of nodes in the recipe graph.")
@@ -147,7 +174,7 @@ class RecipeGraph:
     def create_recipe_graph(self, recipe: Recipe) -> str:
         logger.debug("Creating recipe graph with foundational recipe.")
         node_id = str(uuid.uuid4())
-        self.graph.add_node(node_id, recipe=recipe)
+        self.graph.add_node(node_id, recipe=recipe, depth=0)
         self.foundational_recipe_node = node_id
         return node_id
 
@@ -157,7 +184,34 @@ class RecipeGraph:
             node_id = self.foundational_recipe_node
         if self.get_graph_size() == 0:
             return None
-        return Recipe.from_json(self.graph.nodes[node_id].get('recipe', None))
+        return self._materialize(node_id).copy(deep=True)
+
+    def _materialize(self, node_id: str) -> Recipe:
+        if node_id in self._recipe_cache:
+            self._recipe_cache.move_to_end(node_id)
+            return self._recipe_cache[node_id]
+        # Walk back to the nearest keyframe or cached ancestor, then replay the modifications
+        chain = []
+        current = node_id
+        while current not in self._recipe_cache and 'recipe' not in self.graph.nodes[current]:
+            chain.append(current)
+            current = self.graph.nodes[current]['parent']
+        base = self._recipe_cache[current] if current in self._recipe_cache else self.graph.nodes[current]['recipe']
+        recipe = base.copy(deep=True)
+        for delta_node in reversed(chain):
+            recipe.apply_modification(self.graph.nodes[delta_node]['mod'])
+            recipe._id = delta_node
+        self._cache_recipe(node_id, recipe)
+        return recipe
+
+    def _cache_recipe(self, node_id: str, recipe: Recipe) -> None:
+        self._recipe_cache[node_id] = recipe
+        self._recipe_cache.move_to_end(node_id)
+        while len(self._recipe_cache) > self.cache_size:
+            self._recipe_cache.popitem(last=False)
+
+    def is_keyframe(self, node_id: str) -> bool:
+        return 'recipe' in self.graph.nodes[node_id]
     
     def get_node_id(self, node_id: Optional[str] = None) -> Optional[str]:
         logger.debug("Getting node ID from recipe graph.")
@@ -169,12 +223,32 @@ class RecipeGraph:
         logger.debug("Adding node to recipe graph.")
         node_id = recipe._id
         logger.debug(f"Node ID: {node_id}")
-        self.graph.add_node(node_id, recipe=recipe)
+        self.graph.add_node(node_id, recipe=recipe, depth=0)
+        self._recipe_cache.pop(node_id, None)
         if self.foundational_recipe_node is not None:
             self.graph.add_edge(self.foundational_recipe_node, node_id)
         self.foundational_recipe_node = node_id
         return node_id
 
+    def add_modification(self, modification: RecipeModification) -> Optional[str]:
+        """Apply a modification to the foundational recipe and add the result as a new foundational node."""
+        logger.debug("Adding modification node to recipe graph.")
+        parent_id = self.foundational_recipe_node
+        recipe = self.get_recipe(parent_id)
+        if recipe is None or not recipe.apply_modification(modification):
+            return None
+        recipe.new_ID()
+        node_id = recipe.get_ID()
+        depth = self.graph.nodes[parent_id].get('depth', 0) + 1
+        if depth >= self.keyframe_interval:
+            self.graph.add_node(node_id, recipe=recipe.copy(deep=True), depth=0)
+        else:
+            self.graph.add_node(node_id, mod=modification, parent=parent_id, depth=depth)
+        self.graph.add_edge(parent_id, node_id)
+        self._cache_recipe(node_id, recipe)
+        self.foundational_recipe_node = node_id
+        return node_id
+
     def get_foundational_recipe(self) -> Optional[Recipe]:
         logger.debug("Getting foundational recipe from recipe graph.")
         return self.get_recipe(self.foundational_recipe_node)
@@ -193,37 +267,113 @@ class RecipeGraph:
         return self.graph
 
 class ModsList(BaseModel):
-    """Model for a list of recipe modifications."""
-    queue: List[Tuple[int, RecipeModification]] = Field(default=[], description="Priority queue of recipe modifications")
+    """Model for a list of recipe modifications.
+
+    `queue` is a binary min-heap of (priority, sequence, modification) entries: lower
+    priority values come first and ties keep suggestion order. `_index` maps each mod ID
+    to its heap position so ranking and removal sift a single entry in O(log n).
+    """
+    queue: List[Tuple[int, int, RecipeModification]] = Field(default=[], description="Priority queue of recipe modifications")
+
+    # Private attributes
+    _index: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _counter: int = PrivateAttr(default=0)
+    _sorted: Optional[List[RecipeModification]] = PrivateAttr(default=None)
 
     def __init__(self, **data):
         super().__init__(**data)
         logger.info("Initializing ModsList object.")
+        self._rebuild()
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        super().__setstate__(state)
+        self._rebuild()
 
     def __str__(self) -> str:
         return self.json()
-        
+
+    def _rebuild(self) -> None:
+        # Mods lists pickled before the indexed heap stored (-priority, mod) pairs
+        entries = [entry if len(entry) == 3 else (entry[1].priority, seq, entry[1]) for seq, entry in enumerate(self.queue)]
+        heapq.heapify(entries)
+        self.queue = entries
+        self._index = {mod._id: i for i, (_, _, mod) in enumerate(entries)}
+        self._counter = max((seq for _, seq, _ in entries), default=-1) + 1
+        self._sorted = None
+
+    def _swap(self, i: int, j: int) -> None:
+        self.queue[i], self.queue[j] = self.queue[j], self.queue[i]
+        self._index[self.queue[i][2]._id] = i
+        self._index[self.queue[j][2]._id] = j
+
+    def _sift_up(self, i: int) -> None:
+        while i > 0:
+            parent = (i - 1) // 2
+            if self.queue[i] >= self.queue[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i: int) -> None:
+        size = len(self.queue)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and self.queue[child] < self.queue[smallest]:
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
+
+    def _remove_at(self, i: int) -> RecipeModification:
+        entry = self.queue[i]
+        last = self.queue.pop()
+        del self._index[entry[2]._id]
+        if i < len(self.queue):
+            self.queue[i] = last
+            self._index[last[2]._id] = i
+            self._sift_up(i)
+            self._sift_down(self._index[last[2]._id])
+        self._sorted = None
+        return entry[2]
+
     def suggest_mod(self, mod: RecipeModification) -> None:
         logger.debug("Suggesting modification to mods list.")
-        heapq.heappush(self.queue, (-mod.priority, mod))
+        if mod._id in self._index:
+            self.rank_mod(mod._id, mod.priority)
+            return
+        self.queue.append((mod.priority, self._counter, mod))
+        self._counter += 1
+        self._index[mod._id] = len(self.queue) - 1
+        self._sift_up(len(self.queue) - 1)
+        self._sorted = None
+
+    def pop_mod(self) -> Optional[RecipeModification]:
+        logger.debug("Popping modification from mods list.")
+        if self.queue:
+            return self._remove_at(0)
+        return None
 
-    def apply_mod(self, recipe_graph: RecipeGraph) -> bool:
+    def apply_mod(self, recipe_graph: RecipeGraph) -> Tuple[Optional[RecipeModification], bool]:
         logger.debug("Applying modification from mods list.")
-        if self.queue:
-            mod = heapq.heappop(self.queue)[1]
-            recipe = recipe_graph.get_foundational_recipe()
-            if recipe is not None:
-                # Apply the modification to the recipe
-                if recipe.apply_modification(mod):
-                    recipe.new_ID()
-                    recipe_graph.add_node(recipe)
-                    recipe_graph.set_foundational_recipe(recipe)
-                    return True
-        return False
+        mod = self.pop_mod()
+        if mod is not None:
+            # Apply the modification to the foundational recipe
+            node_id = recipe_graph.add_modification(mod)
+            return (mod, node_id is not None)
+        return (None, False)
+
+    def get_mod(self, mod_id: str) -> Optional[RecipeModification]:
+        logger.debug("Getting modification from mods list.")
+        i = self._index.get(mod_id)
+        return self.queue[i][2] if i is not None else None
 
     def get_mods_list(self) -> List[RecipeModification]:
         logger.debug("Getting mods list.")
-        return [mod for _, mod in sorted(self.queue, key=lambda x: -x[0])]
+        if self._sorted is None:
+            self._sorted = [mod for _, _, mod in sorted(self.queue)]
+        return list(self._sorted)
 
     def push_mod(self, recipe_graph: RecipeGraph) -> Tuple[RecipeModification, bool]:
         logger.debug("Pushing modification from mods list.")
@@ -234,94 +384,153 @@ class ModsList(BaseModel):
             logger.warning(f"Failed to apply modification {mod}.")
         return (mod, success)
 
-    def rank_mod(self, mod_id: str, new_priority: int) -> None:
+    def rank_mod(self, mod_id: str, new_priority: int) -> bool:
         logger.debug("Ranking modification in mods list.")
-        for i, (_, mod) in enumerate(self.queue):
-            if mod._id == mod_id:
-                self.queue[i] = (-new_priority, mod)
-                heapq.heapify(self.queue)
-                break
+        i = self._index.get(mod_id)
+        if i is None:
+            return False
+        _, seq, mod = self.queue[i]
+        mod.priority = new_priority
+        self.queue[i] = (new_priority, seq, mod)
+        self._sift_up(i)
+        self._sift_down(self._index[mod_id])
+        self._sorted = None
+        return True
+
+    def remove_mod(self, mod_id: str) -> bool:
+        logger.debug("Removing modification from mods list.")
+        i = self._index.get(mod_id)
+        if i is None:
+            return False
+        self._remove_at(i)
+        return True
     
+def normalize_url(url: str) -> str:
+    """Canonical form of a URL used for deduplication: lowercase host, no "www.", fragment or trailing slash."""
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    path = parts.path.rstrip("/")
+    return urlunsplit((parts.scheme.lower(), netloc, path, parts.query, ""))
+
 class Pot(BaseModel):
-    """Model for a short-term storage of recipe info."""
-    recipes: List[Recipe] = Field(default=[], description="Set of recipes in the pot")
-    urlList: List[str] = Field(default=[], description="List of URLs for recipes")
+    """Model for a short-term storage of recipe info.
+
+    Recipes are keyed by recipe ID and URLs by their normalized form. Both dicts keep
+    insertion order, so lookups and removals are O(1) while popping still returns the
+    most recently added entry.
+    """
+    recipes: Dict[str, Recipe] = Field(default={}, description="Recipes in the pot keyed by recipe ID")
+    urlList: Dict[str, str] = Field(default={}, description="URLs for recipes keyed by normalized URL")
 
     def __init__(self, **data):
         super().__init__(**data)
         logger.info("Initializing Pot object.")
 
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        super().__setstate__(state)
+        # Pots pickled before the hash index stored plain lists
+        self.recipes = Pot._index_recipes(self.recipes)
+        self.urlList = Pot._index_urls(self.urlList)
+
+    @validator('recipes', pre=True)
+    def _index_recipes(cls, value: Any) -> Any:
+        if isinstance(value, list):
+            recipes = [recipe if isinstance(recipe, Recipe) else Recipe.parse_obj(recipe) for recipe in value]
+            return {recipe.get_ID(): recipe for recipe in recipes}
+        return value
+
+    @validator('urlList', pre=True)
+    def _index_urls(cls, value: Any) -> Any:
+        if isinstance(value, list):
+            # Like add_urls, the first spelling of a URL wins and later duplicates are dropped
+            urls: Dict[str, str] = {}
+            for url in value:
+                urls.setdefault(normalize_url(url), url)
+            return urls
+        return value
+
     def __str__(self) -> str:
         return self.json()
     
     def add_recipe(self, recipe: Recipe) -> None:
         logger.debug("Adding recipe to pot.")
-        self.recipes.append(recipe)
+        self.recipes[recipe.get_ID()] = recipe
 
     def remove_recipe(self, recipe_id: str) -> bool:
         logger.debug("Removing recipe from pot.")
-        for i, recipe in enumerate(self.recipes):
-            if recipe._id == recipe_id:
-                self.recipes.pop(i)
-                return True
-        return False
+        return self.recipes.pop(recipe_id, None) is not None
     
     def get_recipe(self, recipe_id: str) -> Optional[Recipe]:
         logger.debug("Getting recipe from pot.")
-        for recipe in self.recipes:
-            if recipe._id == recipe_id:
-                return recipe
-        return None
+        return self.recipes.get(recipe_id)
     
     def pop_recipe(self) -> Optional[Recipe]:
         logger.debug("Popping recipe from pot.")
         if self.recipes:
-            return self.recipes.pop()
+            return self.recipes.popitem()[1]
         return None
     
     def get_all_recipes(self) -> List[Recipe]:
         logger.debug("Getting all recipes from pot.")
-        return self.recipes
+        return list(self.recipes.values())
     
     def add_url(self, url: str) -> None:
         logger.debug("Adding URL to pot.")
-        assert url not in self.urlList, "URL already in pot."
+        key = normalize_url(url)
+        assert key not in self.urlList, "URL already in pot."
         assert url.startswith("http"), "Invalid URL."
-        self.urlList.append(url)
+        self.urlList[key] = url
+
+    def add_urls(self, urls: List[str]) -> List[str]:
+        """Add every new, valid URL in one pass and return the ones that were added."""
+        logger.debug(f"Adding {len(urls)} URLs to pot.")
+        added = []
+        for url in urls:
+            key = normalize_url(url)
+            if key in self.urlList:
+                continue
+            if not url.startswith("http"):
+                logger.warning(f"Skipping invalid URL: {url}")
+                continue
+            self.urlList[key] = url
+            added.append(url)
+        return added
 
     def remove_url(self, url: str) -> bool:
         logger.debug("Removing URL from pot.")
-        if url in self.urlList:
-            self.urlList.remove(url)
-            return True
-        return False
+        return self.urlList.pop(normalize_url(url), None) is not None
     
     def get_url(self, url: str) -> Optional[str]:
         logger.debug("Getting URL from pot.")
-        if url in self.urlList:
-            return url
-        return None
+        return self.urlList.get(normalize_url(url))
     
     def pop_url(self) -> Optional[str]:
         logger.debug("Popping URL from pot.")
         if self.urlList:
-            return self.urlList.pop()
+            return self.urlList.popitem()[1]
         return None
     
     def get_all_urls(self) -> List[str]:
         logger.debug("Getting all URLs from pot.")
-        return self.urlList
+        return list(self.urlList.values())
     
     def clear_pot(self) -> None:
         logger.debug("Clearing pot.")
-        self.recipes = []
-        self.urlList = []
+        self.recipes = {}
+        self.urlList = {}
 
 # General utility functions
 def save_to_file(obj: T, filename: str) -> None:
     logger.info(f"Saving {obj.__class__.__name__} to file.")
-    with open(filename, 'wb') as file:
+    # Write to a temporary file and rename it over the target so a crash never leaves a truncated pickle
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'wb') as file:
         pickle.dump(obj, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_filename, filename)
 
 def load_from_file(cls: Type[T], filename: str) -> T:
     logger.info(f"Loading {cls.__name__} from file.")
@@ -0,0 +1,126 @@
+import multiprocessing
+import queue
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from logging_util import logger
+
+idle_color = "#457b9d"
+sender_color = "#a8dadc"
+next_color = "#e63946"
+default_queue_size = 64
+default_frame_interval = 0.05
+
+Edge = Tuple[str, str]
+
+def _node_colors(nodes: Sequence[str], sender: Optional[str], next: Optional[str]) -> List[str]:
+    colors = []
+    for n in nodes:
+        if n == "Frontman":
+            n = 'FINISH'
+        if n == sender:
+            colors.append(sender_color)
+        elif n == next:
+            colors.append(next_color)
+        else:
+            colors.append(idle_color)
+    return colors
+
+def _render(nodes: List[str], direct_edges: List[Edge], conditional_edges: List[Edge], labels: Dict[str, str], events: Any, frame_interval: float) -> None:
+    """Renderer process: draw the graph once, then recolor the node artists as events arrive."""
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
+    display_graph = nx.DiGraph()
+    display_graph.add_nodes_from(nodes)
+    display_graph.add_edges_from(direct_edges)
+    # Edges bring in nodes the StateGraph does not list, such as __end__ (labelled USER); they
+    # must be in the node list too, or they get labels and edges but no artist to highlight
+    display_graph.add_nodes_from(node for edge in conditional_edges for node in edge)
+    nodes = list(display_graph.nodes)
+    node_pos = nx.shell_layout(display_graph)
+
+    plt.ion()
+    figure = plt.figure()
+    node_artist = nx.draw_networkx_nodes(display_graph, node_pos, nodelist=nodes, node_size=3000, node_color=_node_colors(nodes, None, None))
+    nx.draw_networkx_edges(display_graph, node_pos, edgelist=direct_edges, style='solid', connectionstyle='arc3,rad=0.2', arrows=True)
+    nx.draw_networkx_edges(display_graph, node_pos, edgelist=conditional_edges, style='dotted', connectionstyle='arc3,rad=0.2', arrows=True)
+    nx.draw_networkx_labels(display_graph, node_pos, labels=labels, font_size=10, font_weight="bold")
+    plt.show(block=False)
+
+    while plt.fignum_exists(figure.number):
+        # Only the latest state matters; skip any backlog the window fell behind on
+        latest = None
+        try:
+            while True:
+                latest = events.get_nowait()
+                if latest is None:
+                    plt.close(figure)
+                    return
+        except queue.Empty:
+            pass
+        if latest is not None:
+            node_artist.set_facecolor(_node_colors(nodes, *latest))
+            figure.canvas.draw_idle()
+        plt.pause(frame_interval)
+
+class FlowVisualizer:
+    """Shows which agent is active in a matplotlib window drawn by a separate process.
+
+    The interaction loop only puts small (sender, next) events on a bounded queue and never
+    waits on the renderer. Events that arrive while the queue is full are dropped, because
+    the renderer only ever shows the most recent one.
+    """
+    def __init__(
+        self,
+        nodes: Sequence[str],
+        direct_edges: Sequence[Edge],
+        conditional_edges: Sequence[Edge],
+        labels: Dict[str, str],
+        queue_size: int = default_queue_size,
+        frame_interval: float = default_frame_interval,
+    ) -> None:
+        self.nodes = list(nodes)
+        self.direct_edges = list(direct_edges)
+        self.conditional_edges = list(conditional_edges)
+        self.labels = dict(labels)
+        self.frame_interval = frame_interval
+        # Spawn rather than fork: the parent already runs the state flusher and agent warm-up threads
+        self._context = multiprocessing.get_context("spawn")
+        self._events = self._context.Queue(maxsize=queue_size)
+        self._process: Optional[multiprocessing.process.BaseProcess] = None
+
+    def start(self) -> None:
+        if self._process is not None:
+            return
+        logger.info("Starting flow graph visualizer process.")
+        self._process = self._context.Process(
+            target=_render,
+            args=(self.nodes, self.direct_edges, self.conditional_edges, self.labels, self._events, self.frame_interval),
+            name="flow-visualizer",
+            daemon=True,
+        )
+        self._process.start()
+
+    def _send(self, event: Optional[Tuple[Optional[str], Optional[str]]]) -> None:
+        if self._process is None or not self._process.is_alive():
+            return
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            pass
+
+    def highlight(self, sender: Optional[str], next: Optional[str]) -> None:
+        """Color the node that just ran and the node it routed to."""
+        self._send((sender, next))
+
+    def reset(self) -> None:
+        """Return every node to the idle color."""
+        self._send((None, None))
+
+    def close(self) -> None:
+        if self._process is None:
+            return
+        self._send(None)
+        self._process.join(timeout=2)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
@@ -0,0 +1,376 @@
+### RULE-BASED INGREDIENT LINE PARSER ###
+# Splits free-text ingredient lines ("1 ½ cups (180g) all-purpose flour, sifted") into
+# quantity, unit, name and note without calling a model. Lines the rules cannot handle
+# can be sent to an LLM in one batched function call. Throughput against the corpus:
+#   python ingredient_parser.py --db sql/recipes_normalized.db
+
+import argparse
+import functools
+import re
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+from logging_util import logger
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+
+default_cache_size = 65536
+
+class ParsedIngredient(NamedTuple):
+    name: str
+    quantity: Optional[float]
+    unit: Optional[str] # canonical unit name, e.g. "cup" or "gram"
+    note: Optional[str] # preparation, alternatives and parenthetical remarks
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+## Units
+# Canonical unit -> the spellings that map to it (matched case-insensitively, with an optional trailing ".")
+UNIT_ALIASES: Dict[str, Tuple[str, ...]] = {
+    "teaspoon": ("teaspoon", "teaspoons", "tsp", "tsps", "tsp.", "t"),
+    "tablespoon": ("tablespoon", "tablespoons", "tbsp", "tbsps", "tbs", "tb", "tbl", "tbls", "T"),
+    "cup": ("cup", "cups", "c"),
+    "fluid ounce": ("fluid ounce", "fluid ounces", "fl oz", "fl. oz", "fl.oz", "floz"),
+    "pint": ("pint", "pints", "pt"),
+    "quart": ("quart", "quarts", "qt"),
+    "gallon": ("gallon", "gallons", "gal"),
+    "milliliter": ("milliliter", "milliliters", "millilitre", "millilitres", "ml", "mls"),
+    "liter": ("liter", "liters", "litre", "litres", "l"),
+    "ounce": ("ounce", "ounces", "oz", "ozs"),
+    "pound": ("pound", "pounds", "lb", "lbs"),
+    "gram": ("gram", "grams", "gramme", "grammes", "g", "gm", "gms", "gr"),
+    "kilogram": ("kilogram", "kilograms", "kg", "kgs"),
+    "milligram": ("milligram", "milligrams", "mg"),
+    "pinch": ("pinch", "pinches"),
+    "dash": ("dash", "dashes"),
+    "drop": ("drop", "drops"),
+    "clove": ("clove", "cloves"),
+    "stick": ("stick", "sticks"),
+    "slice": ("slice", "slices"),
+    "piece": ("piece", "pieces"),
+    "sprig": ("sprig", "sprigs"),
+    "bunch": ("bunch", "bunches"),
+    "handful": ("handful", "handfuls"),
+    "head": ("head", "heads"),
+    "scoop": ("scoop", "scoops"),
+    "sheet": ("sheet", "sheets"),
+    "can": ("can", "cans", "tin", "tins"),
+    "package": ("package", "packages", "pkg", "pack", "packs"),
+    "packet": ("packet", "packets", "envelope", "envelopes", "sachet", "sachets"),
+    "jar": ("jar", "jars"),
+    "bottle": ("bottle", "bottles"),
+    "bag": ("bag", "bags"),
+    "box": ("box", "boxes"),
+    "container": ("container", "containers", "carton", "cartons", "tub", "tubs"),
+    "block": ("block", "blocks"),
+}
+# Units that name a container whose size may follow in parentheses: "1 (14 oz) can tomatoes"
+CONTAINER_UNITS = {"can", "package", "packet", "jar", "bottle", "bag", "box", "container", "block", "stick"}
+# Units that imply an amount of one when no number is given: "pinch of salt"
+COUNTLESS_UNITS = {"pinch", "dash", "handful"}
+
+# Case matters only for the single-letter cooking abbreviations: "T" is a tablespoon, "t" a teaspoon
+_case_sensitive = {alias: unit for unit, aliases in UNIT_ALIASES.items() for alias in aliases if alias in ("T", "t")}
+_aliases = {alias.lower(): unit for unit, aliases in UNIT_ALIASES.items() for alias in aliases if alias not in _case_sensitive}
+_plural_aliases = {alias.lower() for aliases in UNIT_ALIASES.values() for alias in aliases if alias.lower().endswith("s") and alias.lower()[:-1] in _aliases}
+_max_alias = max(len(alias) for alias in _aliases)
+
+def canonical_unit(unit: Optional[str]) -> Optional[str]:
+    """Map a unit spelling ("Tbsp", "cups", "grams") to its canonical name, or None if it is not a known unit."""
+    if unit is None:
+        return None
+    text = " ".join(str(unit).split()).rstrip(".")
+    return _case_sensitive.get(text) or _aliases.get(text.lower())
+
+## Text Normalization
+_vulgar_fractions = {
+    "½": "1/2", "⅓": "1/3", "⅔": "2/3", "¼": "1/4", "¾": "3/4", "⅕": "1/5", "⅖": "2/5", "⅗": "3/5", "⅘": "4/5",
+    "⅙": "1/6", "⅚": "5/6", "⅐": "1/7", "⅛": "1/8", "⅜": "3/8", "⅝": "5/8", "⅞": "7/8", "⅑": "1/9", "⅒": "1/10",
+}
+_vulgar = re.compile("(\\d?)([" + "".join(_vulgar_fractions) + "])")
+_bullet = re.compile(r"^[\s▢☐□•*·\-–]+")
+_spaces = re.compile(r"\s+")
+# "1 and 1/2", "1 & 1/2" and "3-1/4" are mixed numbers, not ranges
+_mixed_number = re.compile(r"(?<![\d/.])(\d+)\s*(?:-|&|\band\b)\s*(\d+/\d+)", re.IGNORECASE)
+
+def _normalize(line: str) -> str:
+    text = line.replace("⁄", "/").replace("\xa0", " ")
+    # "1½" -> "1 1/2", "½" -> "1/2"
+    text = _vulgar.sub(lambda m: (m.group(1) + " " if m.group(1) else " ") + _vulgar_fractions[m.group(2)], text)
+    text = _mixed_number.sub(r"\1 \2", _bullet.sub("", text))
+    return _spaces.sub(" ", text).strip()
+
+## Quantities
+_number = r"(?:\d+ \d+/\d+|\d+/\d+|\d*\.\d+|\d+)"
+_range_separator = r"\s*(?:-|–|—|to|or)\s*"
+_quantity = re.compile(rf"(?P<low>{_number})(?:{_range_separator}(?P<high>{_number}))?(?![\d/])", re.IGNORECASE)
+_article = re.compile(r"(?:an?|one)\s+(?=\S)", re.IGNORECASE)
+_approximate = re.compile(r"(?:about|approximately|approx\.?|roughly|around|~)\s*(?=\d)", re.IGNORECASE)
+_measure_start = re.compile(rf"\s*/?\s*(?P<open>\(\s*)?(?P<quantity>{_number}(?:{_range_separator}{_number})?)\s*-?\s*")
+_parenthetical = re.compile(r"\s*[(\[]([^()\[\]]*(?:[(\[][^()\[\]]*[)\]][^()\[\]]*)*)[)\]]")
+_of = re.compile(r"^of\s+", re.IGNORECASE)
+
+def _number_value(text: str) -> float:
+    whole, _, fraction = text.rpartition(" ") if " " in text else ("", "", text)
+    if "/" in fraction:
+        numerator, denominator = fraction.split("/")
+        value = float(numerator) / float(denominator) if float(denominator) else 0.0
+    else:
+        value = float(fraction)
+    return value + (float(whole) if whole else 0.0)
+
+def parse_quantity(text: str) -> Optional[float]:
+    """Value of a quantity such as "1 1/2", "¾", "2.5" or "2-3" (a range gives its midpoint)."""
+    match = _quantity.fullmatch(_normalize(text))
+    if match is None:
+        return None
+    low = _number_value(match.group("low"))
+    return (low + _number_value(match.group("high"))) / 2 if match.group("high") else low
+
+## Units in Context
+def _match_unit(text: str, quantity: Optional[float], glued: bool) -> Tuple[Optional[str], str]:
+    """Split a leading unit off `text`. Returns (canonical unit, rest of the text).
+
+    Scraped pages often lose the spaces between amount, unit and name ("2cupsall-purpose
+    flour"). Then no word boundary is required after the unit, single-letter units are only
+    accepted before a capital, and the plural spelling is tried first for amounts above one.
+    """
+    candidates = []
+    for length in range(min(_max_alias, len(text)), 0, -1):
+        prefix = text[:length]
+        unit = _case_sensitive.get(prefix) or _aliases.get(prefix.lower())
+        if unit is None:
+            continue
+        rest = text[length:]
+        if rest.startswith("."):
+            rest = rest[1:]
+        bounded = not rest or not rest[0].isalpha()
+        if bounded or (glued and (length > 1 or rest[0].isupper())):
+            candidates.append((bounded, prefix.lower() in _plural_aliases, unit, rest))
+    if not candidates:
+        return None, text
+    if glued and not any(bounded for bounded, _, _, _ in candidates):
+        plural = quantity is not None and quantity > 1
+        candidates.sort(key=lambda candidate: candidate[1] != plural)
+    else:
+        candidates = [candidate for candidate in candidates if candidate[0]] or candidates
+    _, _, unit, rest = candidates[0]
+    return unit, rest.lstrip()
+
+## Names and Notes
+_size_words = re.compile(r"^(?:extra[- ]large|large|medium|small|jumbo|heaping|heaped|level|scant|generous|rounded)\s+", re.IGNORECASE)
+_trailing_notes = re.compile(
+    r"\s*(?:,|\bplus\b|\bfor\b|\bto taste\b|\bas needed\b|\bdivided\b|\boptional\b|\bat room temperature\b|\bor more\b|\bor less\b|\*)"
+    r".*$",
+    re.IGNORECASE,
+)
+
+def _split_name(text: str) -> Tuple[str, Optional[str]]:
+    """Separate the ingredient name from trailing preparation and serving notes."""
+    match = _trailing_notes.search(text)
+    if match is None or match.start() == 0:
+        return text.strip(" ,;:-"), None
+    name = text[:match.start()].strip(" ,;:-")
+    note = text[match.start():].strip(" ,;:-*")
+    return name, note or None
+
+def _join_notes(*notes: Optional[str]) -> Optional[str]:
+    joined = "; ".join(note.strip() for note in notes if note and note.strip())
+    return joined or None
+
+def _measure(text: str) -> Optional[Tuple[float, str, int]]:
+    """A leading size or alternative measure such as "(14 oz)", "28-ounce", "/ 500g" or "5.6 g".
+
+    Returns (quantity, canonical unit, length of the matched text), or None.
+    """
+    match = _measure_start.match(text)
+    if match is None:
+        return None
+    unit, rest = _match_unit(text[match.end():], None, False)
+    if unit is None:
+        return None
+    if match.group("open"):
+        if not rest.startswith(")"):
+            return None
+        rest = rest[1:].lstrip()
+    return parse_quantity(match.group("quantity")), unit, len(text) - len(rest)
+
+def _strip_size(text: str, notes: List[Optional[str]]) -> str:
+    if (size := _size_words.match(text)) is not None:
+        notes.append(size.group(0).strip())
+        return text[size.end():]
+    return text
+
+@functools.lru_cache(maxsize=default_cache_size)
+def parse_ingredient_line(line: str) -> Optional[ParsedIngredient]:
+    """Parse one ingredient line with the rules. Returns None if the line does not look parseable."""
+    text = _normalize(line)
+    notes: List[Optional[str]] = []
+    if (approximate := _approximate.match(text)) is not None:
+        notes.append(approximate.group(0).strip())
+        text = text[approximate.end():]
+    quantity = None
+    unit = None
+
+    match = _quantity.match(text)
+    if match is not None:
+        quantity = parse_quantity(match.group(0))
+        rest = text[match.end():]
+        glued = not rest.startswith(" ")
+        rest = _strip_size(rest.lstrip(" -"), notes)
+        size = _measure(rest)
+        if size is not None:
+            size_quantity, size_unit, end = size
+            after_unit, after = _match_unit(rest[end:], quantity, False)
+            if after_unit is not None and after_unit not in CONTAINER_UNITS:
+                # "3 (360g) cups flour": the parenthesis is the same amount in other units
+                notes.append(rest[:end].strip(" ()"))
+                unit, rest = after_unit, after
+            else:
+                # "1 (14 oz) can tomatoes", "2 8-ounce packages cream cheese"
+                quantity *= size_quantity
+                unit = size_unit
+                notes.append(after_unit)
+                rest = after if after_unit else rest[end:]
+        else:
+            unit, rest = _match_unit(rest, quantity, glued)
+            size = _measure(rest) if unit is not None else None
+            if size is not None and unit in CONTAINER_UNITS:
+                # "1 can (14 oz) tomatoes"
+                notes.append(unit)
+                quantity *= size[0]
+                unit, rest = size[1], rest[size[2]:]
+            elif size is not None:
+                # "4 cups / 500g flour", "1 tsp 5 g salt"
+                notes.append(rest[:size[2]].strip(" /()"))
+                rest = rest[size[2]:]
+        rest = _of.sub("", rest)
+    else:
+        # "a pinch of salt", "generous pinch of salt": an article or a pinch-like unit implies one
+        rest = _strip_size(text, notes)
+        article = _article.match(rest)
+        unit, after = _match_unit(rest[article.end():] if article else rest, 1.0, False)
+        if unit is not None and (article or unit in COUNTLESS_UNITS):
+            quantity, rest = 1.0, _of.sub("", after)
+        else:
+            unit = None
+
+    # Parenthetical remarks anywhere in the rest become notes
+    notes.extend(group.strip() for group in _parenthetical.findall(rest))
+    rest = _parenthetical.sub(" ", rest)
+    rest = _strip_size(_spaces.sub(" ", rest).strip(), notes)
+    name, trailing = _split_name(rest)
+    notes.append(trailing)
+    name = name.lower()
+    if not name or not any(c.isalpha() for c in name) or name[0].isdigit():
+        return None
+    return ParsedIngredient(name, quantity, unit, _join_notes(*notes))
+
+## Batch API
+def parse_ingredient_lines(
+    lines: Sequence[str],
+    llm: Union[str, 'ChatOpenAI', None] = None,
+) -> List[Optional[ParsedIngredient]]:
+    """Parse many ingredient lines, in order.
+
+    Lines the rules cannot parse are None, unless `llm` (a chat model or model name) is
+    given: then they are sent to it together in a single function call, and whatever it
+    still cannot parse stays None.
+    """
+    results = [parse_ingredient_line(line) for line in lines]
+    failed = [i for i, result in enumerate(results) if result is None and lines[i].strip()]
+    if failed and llm is not None:
+        for i, parsed in zip(failed, llm_parse_lines([lines[i] for i in failed], llm)):
+            results[i] = parsed
+    return results
+
+parse_fx = {
+    "name": "parseIngredients",
+    "description": "Record the quantity, unit and name of each numbered ingredient line.",
+    "parameters": {
+        "title": "parseIngredientsSchema",
+        "type": "object",
+        "properties": {
+            "ingredients": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "index": {"type": "integer", "description": "The line number."},
+                        "name": {"type": "string", "description": "The ingredient name, without amounts or preparation."},
+                        "quantity": {"type": ["number", "null"], "description": "The amount as a number; the midpoint of a range."},
+                        "unit": {"type": ["string", "null"], "description": "The unit of measurement, if any."},
+                        "note": {"type": ["string", "null"], "description": "Preparation or other remarks, if any."},
+                    },
+                    "required": ["index", "name"],
+                },
+            },
+        },
+        "required": ["ingredients"],
+    },
+}
+
+def llm_parse_lines(lines: Sequence[str], llm: Union[str, 'ChatOpenAI']) -> List[Optional[ParsedIngredient]]:
+    """Parse ingredient lines with one LLM function call. Lines it skips or garbles come back as None."""
+    from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_util import callbacks, resolve_llm
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", "You split recipe ingredient lines into quantity, unit, ingredient name and notes. "
+                   "Use null for a missing quantity or unit. Give every line, using its number as the index."),
+        ("human", "{lines}"),
+    ])
+    chain = prompt | resolve_llm(llm).bind_functions(functions=[parse_fx], function_call="parseIngredients") | JsonOutputFunctionsParser()
+    results: List[Optional[ParsedIngredient]] = [None] * len(lines)
+    try:
+        output = chain.invoke({"lines": "\n".join(f"{i}. {line}" for i, line in enumerate(lines))}, config={"callbacks": callbacks()})
+    except Exception as e:
+        logger.error(f"LLM ingredient parsing failed: {e}")
+        return results
+    for entry in output.get("ingredients", []):
+        try:
+            index, name = int(entry["index"]), str(entry["name"]).strip().lower()
+            quantity = entry.get("quantity")
+            quantity = float(quantity) if isinstance(quantity, (int, float)) else parse_quantity(str(quantity)) if quantity else None
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= index < len(lines) and name:
+            unit = entry.get("unit")
+            results[index] = ParsedIngredient(name, quantity, canonical_unit(unit) or unit or None, entry.get("note") or None)
+    logger.debug(f"LLM parsed {sum(r is not None for r in results)} of {len(lines)} ingredient lines.")
+    return results
+
+def _corpus_lines(filename: str) -> Iterable[Tuple[str, Optional[float], Optional[str]]]:
+    """(line, quantity, unit) pairs from recipes whose ingredient lines line up with their parsed rows."""
+    import sqlite3
+    conn = sqlite3.connect(filename)
+    rows = {}
+    for recipe_id, name, quantity, unit in conn.execute("SELECT recipe_id, name, quantity, unit FROM recipe_ingredient ORDER BY recipe_id, position"):
+        rows.setdefault(recipe_id, []).append((quantity, unit))
+    for recipe_id, text in conn.execute("SELECT id, ingredients_text FROM recipe WHERE ingredients_text != ''"):
+        lines = text.split("\n")
+        expected = rows.get(recipe_id, [])
+        for i, line in enumerate(lines):
+            quantity, unit = expected[i] if len(expected) == len(lines) else (None, None)
+            yield line, quantity, unit
+    conn.close()
+
+if __name__ == "__main__":
+    from recipe_db import default_recipe_db
+    parser = argparse.ArgumentParser(description="Measure the ingredient parser against the ingredient lines of a recipe database.")
+    parser.add_argument("--db", default=default_recipe_db, help="Normalized recipe database (see recipe_db.py).")
+    args = parser.parse_args()
+    corpus = list(_corpus_lines(args.db))
+    lines = [line for line, _, _ in corpus]
+    start = time.perf_counter()
+    parsed = [parse_ingredient_line.__wrapped__(line) for line in lines]
+    elapsed = time.perf_counter() - start
+    compared = agreed = 0
+    for (line, quantity, unit), result in zip(corpus, parsed):
+        if quantity is None or result is None:
+            continue
+        compared += 1
+        agreed += result.quantity is not None and abs(result.quantity - quantity) < 0.01 and result.unit == canonical_unit(unit)
+    print(f"{len(lines)} lines in {elapsed:.2f}s ({len(lines) / elapsed:,.0f} lines/s, uncached)")
+    print(f"parsed {sum(p is not None for p in parsed) / len(lines):.1%}; quantity and unit agree with the stored rows on {agreed / max(compared, 1):.1%} of {compared}")
@@ -1,34 +1,98 @@
 # langchain_util.py
 
-import operator
-from typing import Annotated, Sequence, TypedDict
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, BaseMessage, AIMessage, SystemMessage
-from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
-from langchain.agents import AgentExecutor, create_openai_tools_agent
-from langchain.agents.agent import RunnableAgent
-from langchain_community.utilities.sql_database import SQLDatabase
-from langchain_community.agent_toolkits.sql.prompt import SQL_FUNCTIONS_SUFFIX, SQL_PREFIX
-from langchain_community.agent_toolkits import SQLDatabaseToolkit
-from langgraph.graph import StateGraph
+import functools
+import threading
+from typing import TYPE_CHECKING, Annotated, Any, Callable, List, Optional, Sequence, TypedDict, Union
+
+# langchain_openai, langchain.agents, the SQL toolkit, langchain_core's prompts and
+# LangGraph take up to seconds to import, so they are imported where an agent or the
+# graph is first built rather than at startup
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+    from langchain_core.messages import BaseMessage
+    from langchain_core.tools import BaseTool
 
 from dotenv import load_dotenv
 import os
 from logging_util import logger
+from llm_cache import get_llm_cache
+from telemetry import get_telemetry
+from cassette import get_cassette
 
 load_dotenv()
 LANGCHAIN_TRACING_V2=True
 LANGCHAIN_API_KEY=os.getenv("LANGCHAIN_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+default_max_branches = 8
+default_token_budget = 6000 # Estimated prompt tokens of message history per agent call
+default_max_history = 60 # Messages kept in AgentState, including the pinned user request
+default_keep_recent = 2 # Latest messages that are never elided
+default_elide_chars = 1200 # Older messages longer than this are cut down to a preview
+default_preview_chars = 400
+
+def response_cache():
+    """The cache handed to every chat model: the active cassette if one is recording or
+    replaying, otherwise the shared LLM response cache."""
+    return get_cassette() or get_llm_cache()
+
+def callbacks() -> list:
+    """LangChain callbacks attached to every agent and router invocation."""
+    cassette = get_cassette()
+    handlers = [get_telemetry().callback]
+    if cassette is not None and cassette.mode == "record":
+        handlers.append(cassette.callback)
+    return handlers
+
+@functools.lru_cache(maxsize=None)
+def get_chat_model(llm_model: str) -> 'ChatOpenAI':
+    """Return the shared ChatOpenAI instance for a model name, importing it on first use."""
+    from langchain_openai import ChatOpenAI
+    logger.info(f"Creating chat model {llm_model}.")
+    return ChatOpenAI(model=llm_model, temperature=0, cache=response_cache())
+
+def resolve_llm(llm: Union[str, 'ChatOpenAI']) -> 'ChatOpenAI':
+    """Accept either a chat model or a model name to be created lazily."""
+    return get_chat_model(llm) if isinstance(llm, str) else llm
+
+class LazyAgent:
+    """Defers building an agent executor or router until the graph first reaches it.
+
+    `warm` builds it ahead of time, e.g. from a background thread while the user types.
+    """
+    def __init__(self, name: str, build: Callable[[], Any]) -> None:
+        self.name = name
+        self._build = build
+        self._agent = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._agent is None:
+            with self._lock:
+                if self._agent is None:
+                    logger.info(f"Building agent {self.name}.")
+                    self._agent = self._build()
+        return self._agent
+
+    def warm(self) -> None:
+        self.get()
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.get().invoke(input, config, **kwargs)
+
+    def batch(self, inputs, config=None, **kwargs):
+        return self.get().batch(inputs, config, **kwargs)
+
 def createAgent(
     name: str,
     system_prompt: str,
-    llm: ChatOpenAI,
+    llm: 'ChatOpenAI',
     tools: list,
 ) -> str:
-    
+    from langchain.agents import AgentExecutor, create_openai_tools_agent
+    from langchain.agents.agent import RunnableAgent
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
     prompt = ChatPromptTemplate.from_messages(
         [
             ("system","""
@@ -46,18 +110,28 @@ def createAgent(
     agent = RunnableAgent(
             runnable=create_openai_tools_agent(llm, tools=tools, prompt=prompt),
             input_keys_arg=["messages"],
-            return_keys_arg=["output"]
+            return_keys_arg=["output"],
+            # Streamed calls skip the LLM cache (and so the cassette) and report no token usage
+            stream_runnable=False,
         )
-    return AgentExecutor(name=name, agent=agent, tools=tools)
+    return AgentExecutor(name=name, agent=agent, tools=tools, return_intermediate_steps=True)
 
 def createBookworm(
         name: str, 
         system_prompt: str, 
         llm_model: str, 
         db_path: str, 
-        verbose=False
+        verbose=False,
+        extra_tools: Sequence['BaseTool'] = ()
 ):
     assert type(llm_model) == str, "Model must be a string"
+    from langchain.agents import AgentExecutor, create_openai_tools_agent
+    from langchain.agents.agent import RunnableAgent
+    from langchain_community.utilities.sql_database import SQLDatabase
+    from langchain_community.agent_toolkits.sql.prompt import SQL_FUNCTIONS_SUFFIX, SQL_PREFIX
+    from langchain_community.agent_toolkits import SQLDatabaseToolkit
+    from langchain_core.messages import AIMessage, SystemMessage
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
     #assert type(prompt) == str, "Prompt must be a string"
 
     prompt = ChatPromptTemplate.from_messages(
@@ -70,21 +144,25 @@ def createBookworm(
         ]
     )
 
-    llm = ChatOpenAI(model=llm_model, temperature=0)
+    llm = get_chat_model(llm_model)
     db = SQLDatabase.from_uri(db_path)
     toolkit = SQLDatabaseToolkit(llm=llm, db=db)
-    tools = toolkit.get_tools()
+    tools = toolkit.get_tools() + list(extra_tools) # e.g. full-text corpus search, far cheaper than LIKE queries
     agent = RunnableAgent(
             runnable=create_openai_tools_agent(llm, tools, prompt),
             input_keys_arg=["messages"],
-            return_keys_arg=["output"]
+            return_keys_arg=["output"],
+            # Streamed calls skip the LLM cache (and so the cassette) and report no token usage
+            stream_runnable=False,
         )
     return AgentExecutor(name=name, agent=agent, tools=tools)
 
-def createRouter(name, system_prompt, llm: ChatOpenAI, members, exit=False) -> str:
+def createRouter(name, system_prompt, llm: 'ChatOpenAI', members, exit=False) -> str:
     """An LLM-based router."""
+    from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
     if exit:
-        members.append("FINISH")
+        members = members + ["FINISH"] # Don't grow the shared prompts_dict list on every build
     route_fx = {
         "name": "route",
         "description": "Select the next role.",
@@ -126,15 +204,100 @@ def createRouter(name, system_prompt, llm: ChatOpenAI, members, exit=False) -> s
         | JsonOutputFunctionsParser()
     )
 
+def createPreRouter(name, router, rules: List[Callable[[dict], Optional[str]]]):
+    """Wrap a router with deterministic rules that are tried in order before it is invoked.
+
+    Each rule inspects the AgentState and returns the next member for obvious transitions,
+    or None to defer. The LLM router is only called when no rule applies.
+    """
+    from langchain_core.runnables import RunnableLambda
+
+    def route(state, config):
+        for rule in rules:
+            target = rule(state)
+            if target is not None:
+                logger.info(f"{name} fast-path route: {state.get('sender')} -> {target}")
+                return {"next": target, "sender": name}
+        logger.debug(f"{name} deferring to LLM router.")
+        return router.invoke(state, config)
+    return RunnableLambda(route, name=name)
+
+## Message History
+def _estimate_tokens(message: 'BaseMessage') -> int:
+    # Roughly four characters per token plus per-message overhead; no tokenizer download needed
+    return len(str(message.content)) // 4 + 4
+
+def _elide(message: 'BaseMessage', elide_chars: int = default_elide_chars, preview_chars: int = default_preview_chars) -> 'BaseMessage':
+    content = str(message.content)
+    if len(content) <= elide_chars:
+        return message
+    return message.copy(update={"content": f"{content[:preview_chars]}\n...[{len(content) - preview_chars} characters elided]"})
+
+def compact_messages(
+    messages: Sequence['BaseMessage'],
+    token_budget: int = default_token_budget,
+    keep_recent: int = default_keep_recent,
+) -> List['BaseMessage']:
+    """Fit a message history into a token budget for one agent call.
+
+    The first message (the user's request) is always kept. Long messages older than the
+    latest `keep_recent` are cut down to a preview, and the oldest remaining messages are
+    dropped until the estimate fits, leaving a note saying how many were omitted.
+    """
+    from langchain_core.messages import SystemMessage
+
+    messages = list(messages)
+    if not messages:
+        return messages
+    pinned, rest = messages[0], messages[1:]
+    cutoff = max(len(rest) - keep_recent, 0)
+    rest = [_elide(m) for m in rest[:cutoff]] + rest[cutoff:]
+    budget = token_budget - _estimate_tokens(pinned)
+    kept: List['BaseMessage'] = []
+    for message in reversed(rest):
+        cost = _estimate_tokens(message)
+        if kept and cost > budget: # The latest message is always kept
+            break
+        kept.append(message)
+        budget -= cost
+    kept.reverse()
+    omitted = len(rest) - len(kept)
+    if omitted:
+        logger.debug(f"Omitted {omitted} messages to fit a budget of {token_budget} tokens.")
+        kept.insert(0, SystemMessage(content=f"[{omitted} earlier messages omitted to save space]"))
+    return [pinned] + kept
+
+def add_bounded_messages(left: Sequence['BaseMessage'], right: Sequence['BaseMessage']) -> List['BaseMessage']:
+    """AgentState reducer that appends messages but keeps at most `default_max_history`,
+    always retaining the first one (the user's request)."""
+    messages = list(left) + list(right)
+    if len(messages) > default_max_history:
+        messages = messages[:1] + messages[len(messages) - default_max_history + 1:]
+    return messages
+
+def _failed(observation: Any) -> bool:
+    # Tools report failure with an "error" key, or (like apply_mod) with "success": False
+    return isinstance(observation, dict) and ("error" in observation or observation.get("success") is False)
+
+def _successful_tools(result) -> List[str]:
+    # Tools that ran and reported success, for the deterministic pre-routers
+    return [action.tool for action, observation in result.get("intermediate_steps", []) if not _failed(observation)]
+
 # Helper function to create a node for a given agent
-def agent_node(state, agent, name):
-    result = agent.invoke(state)
+def agent_node(state, agent, name, token_budget: int = default_token_budget):
+    from langchain_core.messages import AIMessage
+
+    state = {**state, "messages": compact_messages(state["messages"], token_budget)}
+    with get_telemetry().node(name):
+        result = agent.invoke(state, config={"callbacks": callbacks()})
     #logger.info(f"Agent {name} invoked with state: {state}")
     if "output" in result.keys(): # If the agent has an output
+        tools = _successful_tools(result)
         result = AIMessage(content=result["output"], name=name)
         return {
             "messages": [result],
             "sender": name,
+            "last_tools": tools,
         }
     else: # If it routed to another agent
         return {
@@ -142,15 +305,70 @@ def agent_node(state, agent, name):
             "next": result["next"]
         }
 
-class AgentState(TypedDict):
-    messages: Annotated[Sequence[BaseMessage], operator.add]
-    sender: str
-    next: str
+def fan_out_node(
+    state,
+    agent,
+    name,
+    split: Callable[[dict], List[str]],
+    max_concurrency: int = default_max_branches,
+    token_budget: int = default_token_budget,
+    retry: Optional[Callable[[List[str]], None]] = None,
+):
+    """Run one copy of an agent per task returned by `split` concurrently (fan-out), then
+    return all of their messages in one update for the AgentState reducer to merge (fan-in).
+
+    Each branch sees the shared message history followed by its own task. With no tasks
+    the agent runs once as a regular agent_node. The tasks of branches that raised are
+    passed to `retry`, e.g. to queue them again, and listed in the merged messages.
+    """
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    tasks = split(state)
+    if not tasks:
+        return agent_node(state, agent, name, token_budget)
+    logger.info(f"Fanning out {name} over {len(tasks)} branches.")
+    history = compact_messages(state["messages"], token_budget)
+    inputs = [{**state, "messages": history + [HumanMessage(content=task)]} for task in tasks]
+    with get_telemetry().node(name):
+        results = agent.batch(
+            inputs,
+            config={"max_concurrency": max_concurrency, "callbacks": callbacks()},
+            return_exceptions=True,
+        )
+    messages, tools, failed = [], [], []
+    for task, result in zip(tasks, results):
+        if isinstance(result, Exception):
+            logger.error(f"{name} branch failed: {result}")
+            messages.append(AIMessage(content=f"Failed to complete task '{task}': {result}", name=name))
+            failed.append(task)
+            continue
+        messages.append(AIMessage(content=result["output"], name=name))
+        tools.extend(tool for tool in _successful_tools(result) if tool not in tools)
+    if failed and retry is not None:
+        retry(failed)
+        messages.append(AIMessage(content=f"{len(failed)} of {len(tasks)} tasks failed and were queued to be retried.", name=name))
+    return {
+        "messages": messages,
+        "sender": name,
+        "last_tools": tools,
+    }
 
 def workflow():
+    from langchain_core.messages import BaseMessage
+    from langgraph.graph import StateGraph
+
+    # Defined here so LangGraph can resolve the message type without importing it at startup
+    class AgentState(TypedDict):
+        messages: Annotated[Sequence[BaseMessage], add_bounded_messages]
+        sender: str
+        next: str
+        last_tools: Sequence[str]
+
     return StateGraph(AgentState)
 
 def enter_chain(message: str):
+    from langchain_core.messages import HumanMessage
+
     results = {
         "messages": [HumanMessage(content=message)],
     }
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import warnings
+from typing import TYPE_CHECKING, Any, Dict, Optional
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.embeddings import Embeddings
+from langchain_core.load import dumps, loads
+from logging_util import logger
+
+# numpy is only needed for semantic lookups, so it is imported when embeddings are used
+if TYPE_CHECKING:
+    import numpy as np
+
+default_llm_cache_file = "llm_cache.db"
+default_max_entries = 5000
+default_similarity_threshold = 0.97
+
+warnings.filterwarnings("ignore", message="The function `loads` is in beta.")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS response (
+    key TEXT PRIMARY KEY,
+    llm_string_hash TEXT NOT NULL,
+    generations TEXT NOT NULL,
+    embedding BLOB,
+    latency REAL NOT NULL DEFAULT 0,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS response_last_access ON response (last_access);
+CREATE INDEX IF NOT EXISTS response_llm_string ON response (llm_string_hash);
+"""
+
+def _hash(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+def _model_key(llm_string: str) -> str:
+    # The model's serialization includes reprs like "<httpx.Client object at 0x7f...>" that change every run
+    return re.sub(r" at 0x[0-9a-f]+", "", llm_string)
+
+def _prompt_text(prompt: str) -> str:
+    # Chat prompts arrive as serialized message lists; embed only their text content
+    try:
+        return "\n".join(str(m.get("kwargs", {}).get("content", "")) for m in json.loads(prompt))
+    except (ValueError, AttributeError, TypeError):
+        return prompt
+
+class LLMResponseCache(BaseCache):
+    """Persistent LangChain cache for chat model responses shared by routers and agents.
+
+    Exact matches are keyed on a hash of the LLM string (model, parameters and bound
+    functions) and the serialized messages. If `embeddings` is given, an exact miss falls
+    back to the most similar cached prompt for the same LLM string whose cosine similarity
+    reaches `similarity_threshold`. Entries beyond `max_entries` are evicted least
+    recently used first.
+    """
+    def __init__(
+        self,
+        filename: str = default_llm_cache_file,
+        max_entries: int = default_max_entries,
+        embeddings: Optional[Embeddings] = None,
+        similarity_threshold: float = default_similarity_threshold,
+    ) -> None:
+        logger.info(f"Opening LLM response cache at {filename}.")
+        self.max_entries = max_entries
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self._lock = threading.RLock()
+        self._pending: Dict[str, float] = {}
+        self._pending_embeddings: Dict[str, 'np.ndarray'] = {}
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        if filename != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def _hit(self, key: str, generations: str, latency: float, semantic: bool) -> RETURN_VAL_TYPE:
+        self._conn.execute("UPDATE response SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        self.semantic_hits += int(semantic)
+        self.latency_saved += latency
+        return [loads(generation) for generation in json.loads(generations)]
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        llm_string = _model_key(llm_string)
+        key = _hash(llm_string, prompt)
+        with self._lock:
+            row = self._conn.execute("SELECT generations, latency FROM response WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                logger.debug("LLM cache hit.")
+                return self._hit(key, row[0], row[1], semantic=False)
+        if self.embeddings is not None:
+            import numpy as np
+            embedding = np.asarray(self.embeddings.embed_query(_prompt_text(prompt)), dtype=np.float32)
+            embedding /= np.linalg.norm(embedding) or 1.0
+            with self._lock:
+                best_key, best_score, best_row = None, self.similarity_threshold, None
+                for other_key, generations, latency, blob in self._conn.execute(
+                    "SELECT key, generations, latency, embedding FROM response "
+                    "WHERE llm_string_hash = ? AND embedding IS NOT NULL",
+                    (_hash(llm_string),),
+                ):
+                    score = float(np.dot(embedding, np.frombuffer(blob, dtype=np.float32)))
+                    if score >= best_score:
+                        best_key, best_score, best_row = other_key, score, (generations, latency)
+                if best_key is not None:
+                    logger.debug(f"LLM cache semantic hit (similarity {best_score:.3f}).")
+                    return self._hit(best_key, *best_row, semantic=True)
+                self._pending_embeddings[key] = embedding
+        with self._lock:
+            self.misses += 1
+            self._pending[key] = time.perf_counter()
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        llm_string = _model_key(llm_string)
+        key = _hash(llm_string, prompt)
+        with self._lock:
+            # The time since the matching miss is what a later hit on this entry saves
+            started = self._pending.pop(key, None)
+            latency = time.perf_counter() - started if started is not None else 0.0
+            embedding = self._pending_embeddings.pop(key, None)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response (key, llm_string_hash, generations, embedding, latency, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    _hash(llm_string),
+                    json.dumps([dumps(generation) for generation in return_val]),
+                    embedding.tobytes() if embedding is not None else None,
+                    latency,
+                    time.time(),
+                ),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        excess = self._conn.execute("SELECT COUNT(*) FROM response").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM response WHERE key IN (SELECT key FROM response ORDER BY last_access LIMIT ?)",
+                (excess,),
+            )
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM response")
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and the wall-clock time saved by cache hits in this process."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "latency_saved": self.latency_saved,
+                "entries": self._conn.execute("SELECT COUNT(*) FROM response").fetchone()[0],
+            }
+
+_llm_cache: Optional[LLMResponseCache] = None
+
+def get_llm_cache() -> LLMResponseCache:
+    """Return the process-wide LLMResponseCache, opening the default one on first use."""
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LLMResponseCache()
+    return _llm_cache
+
+def set_llm_cache(cache: LLMResponseCache) -> None:
+    """Replace the process-wide LLMResponseCache, e.g. with a semantic or in-memory one."""
+    global _llm_cache
+    _llm_cache = cache
@@ -1,41 +1,193 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 
+default_log_level = os.getenv("CALDRON_LOG_LEVEL", "DEBUG")
+default_module_levels = os.getenv("CALDRON_LOG_LEVELS", "") # e.g. "class_defs=INFO,agent_tools=WARNING"
+default_queue_size = 10000
+default_max_bytes = 5 * 1024 * 1024
+default_backup_count = 3
+default_max_dir_bytes = 50 * 1024 * 1024
+default_rate_limit = 20 # records per call site per interval
+default_rate_interval = 1.0
+
+_exc_formatter = logging.Formatter()
+_record_fields = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object per line."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "module": record.module,
+            "func": record.funcName,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        # Anything passed with extra={...} (and the rate limiter's suppressed count)
+        entry.update({key: value for key, value in record.__dict__.items() if key not in _record_fields})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class ModuleLevelFilter(logging.Filter):
+    """Applies a per-module minimum level, keyed by module name (e.g. "class_defs")."""
+    def __init__(self, levels: dict) -> None:
+        super().__init__()
+        self.levels = levels
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.levels.get(record.module, logging.NOTSET)
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `limit` records per call site through per `interval` seconds.
+
+    Warnings and errors always pass. The next record let through from a throttled call
+    site carries the number of records that were dropped as `suppressed`.
+    """
+    def __init__(self, limit: int = default_rate_limit, interval: float = default_rate_interval) -> None:
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        site = (record.pathname, record.lineno)
+        with self._lock:
+            window, count, suppressed = self._sites.get(site, (now, 0, 0))
+            if now - window >= self.interval:
+                window, count = now, 0
+            if count >= self.limit:
+                self._sites[site] = (window, count, suppressed + 1)
+                return False
+            self._sites[site] = (window, count + 1, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking or raising when the queue is full."""
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback to text in the caller, but leave formatting to the listener
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def parse_module_levels(spec: str) -> dict:
+    """Parse "module=LEVEL,module=LEVEL" into {module: levelno}."""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        module, _, level = item.partition("=")
+        levelno = logging.getLevelName(level.strip().upper())
+        if isinstance(levelno, int):
+            levels[module.strip()] = levelno
+    return levels
+
+def prune_log_dir(log_dir: str, max_dir_bytes: int = default_max_dir_bytes, keep: tuple = ()) -> int:
+    """Delete the oldest files in `log_dir` until it holds at most `max_dir_bytes`. Returns the number removed."""
+    files = []
+    for name in os.listdir(log_dir):
+        path = os.path.join(log_dir, name)
+        if os.path.isfile(path) and path not in keep:
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= max_dir_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
 # Configure logger
-def setup_logging(log_level=logging.DEBUG, log_dir='logs'):
-    """Sets up the logging configuration."""
+def setup_logging(
+    log_level=default_log_level,
+    log_dir='logs',
+    module_levels=default_module_levels,
+    max_bytes=default_max_bytes,
+    backup_count=default_backup_count,
+    max_dir_bytes=default_max_dir_bytes,
+    rate_limit=default_rate_limit,
+    queue_size=default_queue_size,
+):
+    """Sets up the logging configuration.
+
+    Callers only put records on a queue; a background listener thread writes them to the
+    console and to a size-rotated JSON lines file in `log_dir`, which is pruned to
+    `max_dir_bytes` on startup.
+    """
     # Create the logs directory if it does not exist
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
     # Generate a log file name with a datetime stamp
-    log_file = os.path.join(log_dir, f"app_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+    log_file = os.path.join(log_dir, f"app_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+    prune_log_dir(log_dir, max_dir_bytes)
 
     # Create a custom logger
     logger = logging.getLogger('cauldron')
 
     # Set the log level
     logger.setLevel(log_level)
+    logger.propagate = False
 
-    # Create handlers
+    # Create handlers, run by the listener thread
     c_handler = logging.StreamHandler()
-    f_handler = logging.FileHandler(log_file)
-
-    # Set level for handlers
-    c_handler.setLevel(log_level)
-    f_handler.setLevel(log_level)
+    f_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, delay=True)
 
     # Create formatters and add it to handlers
     c_format = logging.Formatter('%(asctime)s - %(name)-6s - %(levelname)-6s - %(filename)-12s - %(funcName)s - %(message)s')
-    f_format = logging.Formatter('%(asctime)s - %(name)-6s - %(levelname)-6s - %(filename)-12s - %(funcName)s - %(message)s')
-
     c_handler.setFormatter(c_format)
-    f_handler.setFormatter(f_format)
+    f_handler.setFormatter(JsonFormatter())
+
+    # Filter in the calling thread so dropped records never reach the queue
+    q_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    if isinstance(module_levels, str):
+        module_levels = parse_module_levels(module_levels)
+    if module_levels:
+        q_handler.addFilter(ModuleLevelFilter(module_levels))
+    if rate_limit:
+        q_handler.addFilter(RateLimitFilter(rate_limit))
 
     # Add handlers to the logger
-    logger.addHandler(c_handler)
-    logger.addHandler(f_handler)
+    logger.addHandler(q_handler)
+    listener = logging.handlers.QueueListener(q_handler.queue, c_handler, f_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
     return logger
 
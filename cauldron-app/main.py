@@ -1,4 +1,6 @@
 from cauldron_app import CaldronApp
 from util import db_path, llm_model
 
-app = CaldronApp(db_path, llm_model)
\ No newline at end of file
+# Guarded so the visualizer's spawned process can import this module without starting another app
+if __name__ == "__main__":
+    app = CaldronApp(db_path, llm_model)
\ No newline at end of file
@@ -0,0 +1,288 @@
+### NUTRITION ANALYSIS ###
+# Nutrient totals of recipes from a precomputed food x nutrient matrix. The matrix is built
+# once from a FoodData Central CSV download (https://fdc.nal.usda.gov/download-datasets.html),
+# keeping the nutrients listed in ingredients/nutrients_db.csv, and memory-mapped afterwards:
+#   python nutrition.py build path/to/FoodData_Central_sr_legacy_food_csv
+#   python nutrition.py corpus --db sql/recipes_normalized.db
+
+import argparse
+import csv
+import json
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+import numpy as np
+from logging_util import logger
+from recipe_units import IngredientArrays
+
+if TYPE_CHECKING:
+    from class_defs import Ingredient
+
+default_ingredients_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ingredients")
+default_nutrients_csv = os.path.join(default_ingredients_dir, "nutrients_db.csv")
+default_nutrient_matrix = os.getenv("CALDRON_NUTRIENT_MATRIX", os.path.join(default_ingredients_dir, "nutrient_matrix.npy"))
+default_data_types = ("foundation_food", "sr_legacy_food")
+default_max_rank = 99999 # nutrients_db.csv ranks archived and obscure nutrients 999999 or leaves them blank
+default_chunk_rows = 16384
+
+ENERGY = 1008
+# Foundation foods often report energy only under the Atwater factors
+ENERGY_FALLBACKS = (2047, 2048)
+# The nutrients the agent tools report, by FoodData Central nutrient id: energy, protein, fat,
+# saturated fat, carbohydrate, fiber, sugars, cholesterol, sodium, calcium, iron, potassium
+SUMMARY_NUTRIENTS = (1008, 1003, 1004, 1258, 1005, 1079, 2000, 1253, 1093, 1087, 1089, 1092)
+
+class Nutrient(NamedTuple):
+    id: int
+    name: str
+    unit: str
+    rank: int
+
+    @property
+    def label(self) -> str:
+        return f"{self.name} ({self.unit.lower()})"
+
+def load_nutrients(filename: str = default_nutrients_csv, max_rank: int = default_max_rank) -> List[Nutrient]:
+    """The nutrients in nutrients_db.csv, in FoodData Central rank order, without archived or unranked ones."""
+    nutrients = []
+    with open(filename, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row["rank"].strip() and int(row["rank"]) < max_rank:
+                nutrients.append(Nutrient(int(row["id"]), row["name"].strip(), row["unit_name"].strip(), int(row["rank"])))
+    return sorted(nutrients, key=lambda nutrient: nutrient.rank)
+
+def _index_file(matrix_file: str) -> str:
+    return os.path.splitext(matrix_file)[0] + ".json"
+
+def _csv_rows(filename: str) -> Iterable[Dict[str, str]]:
+    with open(filename, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        for row in reader:
+            yield dict(zip(header, row))
+
+def build_matrix(
+    fdc_dir: str,
+    out: str = default_nutrient_matrix,
+    nutrients_csv: str = default_nutrients_csv,
+    data_types: Sequence[str] = default_data_types,
+) -> Dict[str, int]:
+    """Build the food x nutrient matrix (per 100 g) from the food.csv and food_nutrient.csv of a FoodData Central download.
+
+    Writes a float32 .npy matrix and, next to it, a .json index of its foods and nutrients.
+    """
+    nutrients = load_nutrients(nutrients_csv)
+    column = {nutrient.id: i for i, nutrient in enumerate(nutrients)}
+    foods: Dict[str, int] = {}
+    index: List[Tuple[int, str]] = []
+    for row in _csv_rows(os.path.join(fdc_dir, "food.csv")):
+        if row["data_type"] in data_types:
+            foods[row["fdc_id"]] = len(index)
+            index.append((int(row["fdc_id"]), row["description"].strip()))
+    matrix = np.zeros((len(index), len(nutrients)), dtype=np.float32)
+    values = 0
+    for row in _csv_rows(os.path.join(fdc_dir, "food_nutrient.csv")):
+        food = foods.get(row["fdc_id"])
+        nutrient = column.get(int(row["nutrient_id"])) if food is not None else None
+        if nutrient is not None and row["amount"]:
+            matrix[food, nutrient] = float(row["amount"])
+            values += 1
+    if ENERGY in column:
+        for fallback in ENERGY_FALLBACKS:
+            if fallback in column:
+                missing = matrix[:, column[ENERGY]] == 0
+                matrix[missing, column[ENERGY]] = matrix[missing, column[fallback]]
+    keep = np.flatnonzero(matrix.any(axis=0))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out + ".tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(matrix[:, keep]))
+    with open(_index_file(out) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"foods": index, "nutrients": [nutrients[i] for i in keep]}, f)
+    os.replace(out + ".tmp", out)
+    os.replace(_index_file(out) + ".tmp", _index_file(out))
+    counts = {"foods": len(index), "nutrients": len(keep), "values": values}
+    logger.info(f"Built nutrient matrix {out}: {counts}")
+    return counts
+
+## Matching Ingredient Names to Foods
+_stopwords = {"a", "an", "and", "or", "of", "with", "without", "the", "to", "for", "in", "on", "added", "ns", "nfs"}
+# Recipe words that FoodData Central descriptions spell differently: "unsalted butter" is "Butter, without salt"
+_synonyms = {"unsalted": "salt", "confectioners": "powdered", "icing": "powdered"}
+
+def _stem(word: str) -> str:
+    if len(word) > 3 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("oes"):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def _tokens(text: str) -> List[str]:
+    return [_stem(_synonyms.get(word, word)) for word in re.findall(r"[a-z]+", text.lower()) if word not in _stopwords]
+
+class NutrientMatrix:
+    """Nutrients per 100 g of FoodData Central foods, memory-mapped, with an index from ingredient names to foods.
+
+    An ingredient name matches the food whose description shares the most of its words,
+    among foods that contain its last word (the head noun: "flour" in "all-purpose flour").
+    Descriptions whose first segment ("Butter" in "Butter, salted") is made only of the
+    name's words are preferred, and shorter descriptions win ties.
+    """
+    def __init__(self, filename: str = default_nutrient_matrix) -> None:
+        if not os.path.exists(filename) or not os.path.exists(_index_file(filename)):
+            raise FileNotFoundError(f"No nutrient matrix at {filename}. Build it with `python nutrition.py build <FoodData Central CSV directory>`.")
+        self.filename = filename
+        self.matrix = np.load(filename, mmap_mode="r")
+        with open(_index_file(filename), encoding="utf-8") as f:
+            index = json.load(f)
+        self.fdc_ids = [fdc_id for fdc_id, _ in index["foods"]]
+        self.descriptions = [description for _, description in index["foods"]]
+        self.nutrients = [Nutrient(*nutrient) for nutrient in index["nutrients"]]
+        self.columns = {nutrient.id: i for i, nutrient in enumerate(self.nutrients)}
+        self._food_tokens = [frozenset(_tokens(description)) for description in self.descriptions]
+        self._first_tokens = [frozenset(_tokens(description.split(",")[0])) for description in self.descriptions]
+        self._postings: Dict[str, List[int]] = {}
+        for food, tokens in enumerate(self._food_tokens):
+            for token in tokens:
+                self._postings.setdefault(token, []).append(food)
+        self._matches: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        logger.debug(f"Loaded nutrient matrix {filename}: {len(self.descriptions)} foods x {len(self.nutrients)} nutrients.")
+
+    def match(self, name: str) -> int:
+        """Row of the food that best matches an ingredient name, or -1."""
+        key = name.strip().lower()
+        if key in self._matches:
+            return self._matches[key]
+        tokens = _tokens(key)
+        wanted = set(tokens)
+        best, best_score = -1, 0.0
+        for head in reversed(tokens):
+            for food in self._postings.get(head, ()):
+                overlap = len(wanted & self._food_tokens[food]) / len(wanted)
+                score = overlap + (head in self._first_tokens[food]) + 0.5 * (self._first_tokens[food] <= wanted) - 0.01 * len(self._food_tokens[food])
+                if overlap >= 0.5 and score > best_score:
+                    best, best_score = food, score
+            if best >= 0:
+                break
+        with self._lock:
+            self._matches[key] = best
+        return best
+
+    def match_names(self, names: Sequence[str]) -> np.ndarray:
+        return np.fromiter((self.match(name) for name in names), dtype=np.int64, count=len(names))
+
+    def analyze(self, arrays: IngredientArrays) -> np.ndarray:
+        """Nutrient totals of every recipe in `arrays`, shape (recipes, nutrients).
+
+        Each recipe's total is the dot product of its sparse vector of grams per food with the
+        matrix. Ingredients without a known weight or a matching food add nothing.
+        """
+        food = self.match_names(arrays.names)[arrays.name]
+        grams = arrays.grams()
+        rows = np.flatnonzero((food >= 0) & (grams > 0))
+        rows = rows[np.argsort(arrays.recipe[rows], kind="stable")]
+        totals = np.zeros((len(arrays.recipe_ids), self.matrix.shape[1]), dtype=np.float64)
+        for start in range(0, len(rows), default_chunk_rows):
+            chunk = rows[start:start + default_chunk_rows]
+            recipes = arrays.recipe[chunk]
+            contributions = self.matrix[food[chunk]] * (grams[chunk, None] / 100.0)
+            starts = np.flatnonzero(np.r_[True, recipes[1:] != recipes[:-1]])
+            totals[recipes[starts]] += np.add.reduceat(contributions, starts, axis=0)
+        return totals
+
+    def summary(self, totals: np.ndarray, nutrient_ids: Sequence[int] = SUMMARY_NUTRIENTS, digits: int = 1) -> Dict[str, float]:
+        """Label -> amount for the chosen nutrients of one nutrient vector."""
+        return {
+            self.nutrients[self.columns[nutrient_id]].label: round(float(totals[self.columns[nutrient_id]]), digits) + 0.0
+            for nutrient_id in nutrient_ids if nutrient_id in self.columns
+        }
+
+_nutrient_matrices: Dict[str, NutrientMatrix] = {}
+_nutrient_matrices_lock = threading.Lock()
+
+def get_nutrient_matrix(filename: str = default_nutrient_matrix) -> NutrientMatrix:
+    """Return the process-wide NutrientMatrix for a matrix file, loading it on first use."""
+    with _nutrient_matrices_lock:
+        if filename not in _nutrient_matrices:
+            _nutrient_matrices[filename] = NutrientMatrix(filename)
+        return _nutrient_matrices[filename]
+
+## Batch API
+def analyze_recipes(
+    recipes: Sequence[Sequence[Union['Ingredient', Dict[str, Any]]]],
+    matrix: Optional[NutrientMatrix] = None,
+) -> np.ndarray:
+    """Nutrient totals of many recipes (lists of Ingredients or ingredient dicts) in one pass, shape (recipes, nutrients)."""
+    matrix = matrix or get_nutrient_matrix()
+    rows = []
+    for i, ingredients in enumerate(recipes):
+        for ingredient in ingredients:
+            data = ingredient if isinstance(ingredient, dict) else ingredient.dict()
+            rows.append((i, data["name"], data.get("quantity"), data.get("unit")))
+    totals = np.zeros((len(recipes), matrix.matrix.shape[1]), dtype=np.float64)
+    if rows:
+        arrays = IngredientArrays.from_rows(rows)
+        totals[np.asarray(arrays.recipe_ids, dtype=np.int64)] = matrix.analyze(arrays)
+    return totals
+
+def analyze_ingredients(
+    ingredients: Sequence[Union['Ingredient', Dict[str, Any]]],
+    servings: Optional[int] = None,
+    matrix: Optional[NutrientMatrix] = None,
+) -> Dict[str, Any]:
+    """Key nutrient totals of one recipe, per serving if `servings` is given, with the food each ingredient matched."""
+    matrix = matrix or get_nutrient_matrix()
+    arrays = IngredientArrays.from_ingredients(ingredients)
+    totals = matrix.analyze(arrays)[0] if len(arrays) else np.zeros(matrix.matrix.shape[1])
+    food = matrix.match_names(arrays.names)[arrays.name]
+    grams = arrays.grams()
+    result: Dict[str, Any] = {
+        "total": matrix.summary(totals),
+        "ingredients": [
+            {
+                "name": arrays.names[arrays.name[i]],
+                "grams": None if np.isnan(grams[i]) else round(float(grams[i]), 1),
+                "food": matrix.descriptions[food[i]] if food[i] >= 0 else None,
+            }
+            for i in range(len(arrays))
+        ],
+        "not_counted": [arrays.names[arrays.name[i]] for i in range(len(arrays)) if food[i] < 0 or not grams[i] > 0],
+    }
+    if servings:
+        result["per_serving"] = matrix.summary(totals / servings)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the nutrient matrix or analyze a recipe corpus with it.")
+    parser.add_argument("--matrix", default=default_nutrient_matrix, help="Nutrient matrix file (.npy, with a .json index beside it).")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Build the matrix from a FoodData Central CSV download.")
+    build.add_argument("fdc_dir", help="Directory holding food.csv and food_nutrient.csv.")
+    build.add_argument("--data-types", default=",".join(default_data_types), help="Comma-separated FoodData Central data types to keep.")
+    corpus = commands.add_parser("corpus", help="Analyze every recipe in a recipe database and report timings.")
+    corpus.add_argument("--db", default=None, help="Normalized recipe database (see recipe_db.py).")
+    args = parser.parse_args()
+    if args.command == "build":
+        start = time.perf_counter()
+        counts = build_matrix(args.fdc_dir, args.matrix, data_types=tuple(args.data_types.split(",")))
+        print(f"{args.matrix}: {counts} in {time.perf_counter() - start:.2f}s")
+    else:
+        from recipe_db import RecipeDB, default_recipe_db
+        db = RecipeDB(args.db or default_recipe_db)
+        arrays = IngredientArrays.from_db(db)
+        db.close()
+        matrix = NutrientMatrix(args.matrix)
+        start = time.perf_counter()
+        food = matrix.match_names(arrays.names)
+        matched = time.perf_counter()
+        totals = matrix.analyze(arrays)
+        analyzed = time.perf_counter()
+        print(f"matched {np.mean(food >= 0):.1%} of {len(arrays.names)} ingredient names in {matched - start:.2f}s")
+        print(f"analyzed {len(arrays.recipe_ids)} recipes in {(analyzed - matched) * 1000:.1f}ms")
+        energy = totals[:, matrix.columns[ENERGY]] if ENERGY in matrix.columns else None
+        if energy is not None:
+            print(f"median recipe energy {np.median(energy[energy > 0]):.0f} kcal")
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, NamedTuple, Optional
+from logging_util import logger
+from class_defs import normalize_url
+
+default_cache_dir = "page_cache"
+default_ttl = 7 * 24 * 60 * 60 # One week
+default_max_bytes = 256 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS page (
+    url_key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    parsed TEXT
+);
+CREATE INDEX IF NOT EXISTS page_last_access ON page (last_access);
+CREATE INDEX IF NOT EXISTS page_content_hash ON page (content_hash);
+"""
+
+class CacheEntry(NamedTuple):
+    url: str
+    content_hash: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+    parsed: Optional[Dict[str, Any]]
+
+class PageCache:
+    """On-disk cache of recipe pages keyed by normalized URL.
+
+    Raw HTML is stored zlib-compressed in content-addressed blobs under `objects/`, so
+    URLs serving identical pages share one file. An SQLite index holds the validators
+    (ETag/Last-Modified) for revalidation, the parsed recipe fields and the last access
+    time used for LRU eviction once the blobs exceed `max_bytes`. In `offline` mode
+    cached pages are served regardless of age and nothing is fetched.
+    """
+    def __init__(
+        self,
+        cache_dir: str = default_cache_dir,
+        ttl: float = default_ttl,
+        max_bytes: int = default_max_bytes,
+        offline: bool = False,
+    ) -> None:
+        logger.info(f"Opening page cache at {cache_dir}.")
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "index.db"), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def _blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, "objects", content_hash[:2], content_hash)
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        key = normalize_url(url)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, content_hash, etag, last_modified, fetched_at, parsed FROM page WHERE url_key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE page SET last_access = ? WHERE url_key = ?", (time.time(), key))
+        parsed = json.loads(row[5]) if row[5] is not None else None
+        return CacheEntry(row[0], row[1], row[2], row[3], row[4], parsed)
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return self.offline or time.time() - entry.fetched_at < self.ttl
+
+    def read_html(self, entry: CacheEntry) -> Optional[str]:
+        """Return a cached page's HTML, or None if its blob is gone (the entry is then dropped)."""
+        try:
+            with open(self._blob_path(entry.content_hash), 'rb') as file:
+                return zlib.decompress(file.read()).decode('utf-8')
+        except FileNotFoundError:
+            logger.warning(f"Page cache blob for {entry.url} is missing; treating it as a miss.")
+            with self._lock:
+                self._conn.execute(
+                    "DELETE FROM page WHERE url_key = ? AND content_hash = ?", (normalize_url(entry.url), entry.content_hash)
+                )
+            return None
+
+    def put(self, url: str, html: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> CacheEntry:
+        """Store a freshly downloaded page. Parsed fields are kept only if the content is unchanged."""
+        logger.debug(f"Caching page {url}")
+        raw = html.encode('utf-8')
+        content_hash = hashlib.sha256(raw).hexdigest()
+        compressed = zlib.compress(raw)
+        path = self._blob_path(content_hash)
+        now = time.time()
+        # Write and link the blob under the lock, so a concurrent evict cannot delete it
+        # in between for having no page rows
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as file:
+                    file.write(compressed)
+                os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            self._conn.execute(
+                "INSERT INTO page (url_key, url, content_hash, size, etag, last_modified, fetched_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(url_key) DO UPDATE SET "
+                "url = excluded.url, size = excluded.size, etag = excluded.etag, "
+                "last_modified = excluded.last_modified, fetched_at = excluded.fetched_at, "
+                "last_access = excluded.last_access, "
+                "parsed = CASE WHEN page.content_hash = excluded.content_hash THEN page.parsed END, "
+                "content_hash = excluded.content_hash",
+                (normalize_url(url), url, content_hash, size, etag, last_modified, now, now),
+            )
+            self.evict()
+        return CacheEntry(url, content_hash, etag, last_modified, now, None)
+
+    def refresh(self, url: str) -> None:
+        """Mark a cached page as revalidated (HTTP 304) without touching its content."""
+        with self._lock:
+            self._conn.execute("UPDATE page SET fetched_at = ? WHERE url_key = ?", (time.time(), normalize_url(url)))
+
+    def set_parsed(self, url: str, parsed: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE page SET parsed = ? WHERE url_key = ?", (json.dumps(parsed), normalize_url(url)))
+
+    def size(self) -> int:
+        """Bytes on disk: each blob counts once, however many URLs share it."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM page GROUP BY content_hash)"
+            ).fetchone()[0]
+
+    def evict(self) -> int:
+        """Drop least recently used pages until the cache fits in `max_bytes`."""
+        removed = 0
+        with self._lock:
+            total = self.size()
+            if total <= self.max_bytes:
+                return 0
+            for key, content_hash, size in self._conn.execute(
+                "SELECT url_key, content_hash, size FROM page ORDER BY last_access"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM page WHERE url_key = ?", (key,))
+                removed += 1
+                # A blob still shared with other URLs frees no space yet
+                if self._conn.execute("SELECT 1 FROM page WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone() is None:
+                    try:
+                        os.remove(self._blob_path(content_hash))
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+        logger.debug(f"Evicted {removed} pages from the page cache.")
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            for content_hash, in self._conn.execute("SELECT DISTINCT content_hash FROM page").fetchall():
+                try:
+                    os.remove(self._blob_path(content_hash))
+                except FileNotFoundError:
+                    pass
+            self._conn.execute("DELETE FROM page")
+
+_page_cache: Optional[PageCache] = None
+
+def get_page_cache() -> PageCache:
+    """Return the process-wide PageCache. Set CALDRON_OFFLINE=1 to serve only cached pages."""
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = PageCache(offline=os.getenv("CALDRON_OFFLINE") == "1")
+    return _page_cache
@@ -0,0 +1,772 @@
+import argparse
+import ast
+import atexit
+import hashlib
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from logging_util import logger
+from sqlite_util import NestedTransactions
+
+# The legacy corpus is tracked in git and only ever read; the normalized database built
+# from it is a separate, untracked file
+default_legacy_db = os.getenv("CALDRON_LEGACY_RECIPE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sql", "recipes.db"))
+default_recipe_db = os.getenv("CALDRON_RECIPE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sql", "recipes_normalized.db"))
+default_batch_size = 500
+default_search_limit = 10
+search_weights = (10.0, 2.0, 1.0, 5.0) # name, ingredients, instructions, tags
+legacy_source = "legacy"
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version), so
+# opening a database applies only the steps it has not seen yet.
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS recipe (
+        id TEXT PRIMARY KEY,
+        url TEXT,
+        name TEXT,
+        ingredients_text TEXT,
+        source TEXT NOT NULL,
+        source_hash TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_recipe_url ON recipe(url);
+    CREATE INDEX IF NOT EXISTS idx_recipe_source ON recipe(source);
+    CREATE TABLE IF NOT EXISTS recipe_ingredient (
+        recipe_id TEXT NOT NULL REFERENCES recipe(id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        quantity REAL,
+        unit TEXT,
+        PRIMARY KEY (recipe_id, position)
+    );
+    CREATE INDEX IF NOT EXISTS idx_recipe_ingredient_name ON recipe_ingredient(name, recipe_id);
+    CREATE TABLE IF NOT EXISTS recipe_tag (
+        recipe_id TEXT NOT NULL REFERENCES recipe(id) ON DELETE CASCADE,
+        tag TEXT NOT NULL,
+        PRIMARY KEY (recipe_id, tag)
+    );
+    CREATE INDEX IF NOT EXISTS idx_recipe_tag_tag ON recipe_tag(tag, recipe_id);
+    CREATE TABLE IF NOT EXISTS instruction (
+        recipe_id TEXT NOT NULL REFERENCES recipe(id) ON DELETE CASCADE,
+        step INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        PRIMARY KEY (recipe_id, step)
+    );
+    """,
+    """
+    DROP VIEW IF EXISTS IngredientSummary;
+    CREATE VIEW IngredientSummary AS
+    SELECT name AS ingredient, COUNT(DISTINCT recipe_id) AS recipe_count
+    FROM recipe_ingredient
+    GROUP BY name;
+    DROP VIEW IF EXISTS TagSummary;
+    CREATE VIEW TagSummary AS
+    SELECT tag, COUNT(*) AS recipe_count
+    FROM recipe_tag
+    GROUP BY tag;
+    """,
+    # Full-text index with one row per recipe (rowid = recipe.rowid), kept in step with the
+    # recipe, instruction and recipe_tag tables by triggers. Writers that replace a whole
+    # recipe list it in fts_pending to skip the per-row child triggers and refresh it once.
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS recipe_fts USING fts5(
+        name, ingredients, instructions, tags,
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    );
+    CREATE TABLE IF NOT EXISTS fts_pending (recipe_id TEXT PRIMARY KEY);
+    CREATE TRIGGER IF NOT EXISTS recipe_fts_insert AFTER INSERT ON recipe BEGIN
+        INSERT INTO recipe_fts (rowid, name, ingredients, instructions, tags)
+        VALUES (new.rowid, new.name, new.ingredients_text, '', '');
+    END;
+    CREATE TRIGGER IF NOT EXISTS recipe_fts_update AFTER UPDATE OF name, ingredients_text ON recipe BEGIN
+        UPDATE recipe_fts SET name = new.name, ingredients = new.ingredients_text WHERE rowid = new.rowid;
+    END;
+    CREATE TRIGGER IF NOT EXISTS recipe_fts_delete AFTER DELETE ON recipe BEGIN
+        DELETE FROM recipe_fts WHERE rowid = old.rowid;
+    END;
+    CREATE TRIGGER IF NOT EXISTS instruction_fts_insert AFTER INSERT ON instruction
+    WHEN NOT EXISTS (SELECT 1 FROM fts_pending WHERE recipe_id = new.recipe_id) BEGIN
+        UPDATE recipe_fts SET instructions = (
+            SELECT group_concat(text, char(10)) FROM (SELECT text FROM instruction WHERE recipe_id = new.recipe_id ORDER BY step)
+        ) WHERE rowid = (SELECT rowid FROM recipe WHERE id = new.recipe_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS instruction_fts_delete AFTER DELETE ON instruction
+    WHEN NOT EXISTS (SELECT 1 FROM fts_pending WHERE recipe_id = old.recipe_id) BEGIN
+        UPDATE recipe_fts SET instructions = (
+            SELECT group_concat(text, char(10)) FROM (SELECT text FROM instruction WHERE recipe_id = old.recipe_id ORDER BY step)
+        ) WHERE rowid = (SELECT rowid FROM recipe WHERE id = old.recipe_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS recipe_tag_fts_insert AFTER INSERT ON recipe_tag
+    WHEN NOT EXISTS (SELECT 1 FROM fts_pending WHERE recipe_id = new.recipe_id) BEGIN
+        UPDATE recipe_fts SET tags = (SELECT group_concat(tag, ' ') FROM recipe_tag WHERE recipe_id = new.recipe_id)
+        WHERE rowid = (SELECT rowid FROM recipe WHERE id = new.recipe_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS recipe_tag_fts_delete AFTER DELETE ON recipe_tag
+    WHEN NOT EXISTS (SELECT 1 FROM fts_pending WHERE recipe_id = old.recipe_id) BEGIN
+        UPDATE recipe_fts SET tags = (SELECT group_concat(tag, ' ') FROM recipe_tag WHERE recipe_id = old.recipe_id)
+        WHERE rowid = (SELECT rowid FROM recipe WHERE id = old.recipe_id);
+    END;
+    DELETE FROM recipe_fts;
+    INSERT INTO recipe_fts (rowid, name, ingredients, instructions, tags)
+    SELECT r.rowid, r.name, r.ingredients_text,
+        (SELECT group_concat(text, char(10)) FROM (SELECT text FROM instruction WHERE recipe_id = r.id ORDER BY step)),
+        (SELECT group_concat(tag, ' ') FROM recipe_tag WHERE recipe_id = r.id)
+    FROM recipe r;
+    """,
+    # Materialized inverted index: ingredient posting lists with per-recipe occurrence
+    # counts, and recipe counts per ingredient and tag, all maintained by triggers. The
+    # (tag, recipe_id) index on recipe_tag already serves as the tag posting list. Like
+    # every migration it runs on the normalized copy, never on the legacy corpus file.
+    """
+    CREATE TABLE IF NOT EXISTS ingredient_posting (
+        ingredient TEXT NOT NULL,
+        recipe_id TEXT NOT NULL,
+        occurrences INTEGER NOT NULL,
+        PRIMARY KEY (ingredient, recipe_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS ingredient_stats (
+        ingredient TEXT PRIMARY KEY,
+        recipe_count INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS tag_stats (
+        tag TEXT PRIMARY KEY,
+        recipe_count INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TRIGGER IF NOT EXISTS ingredient_posting_insert AFTER INSERT ON recipe_ingredient BEGIN
+        INSERT INTO ingredient_stats (ingredient, recipe_count)
+        SELECT new.name, 1 WHERE NOT EXISTS (SELECT 1 FROM ingredient_posting WHERE ingredient = new.name AND recipe_id = new.recipe_id)
+        ON CONFLICT(ingredient) DO UPDATE SET recipe_count = recipe_count + 1;
+        INSERT INTO ingredient_posting (ingredient, recipe_id, occurrences) VALUES (new.name, new.recipe_id, 1)
+        ON CONFLICT(ingredient, recipe_id) DO UPDATE SET occurrences = occurrences + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS ingredient_posting_delete AFTER DELETE ON recipe_ingredient BEGIN
+        UPDATE ingredient_posting SET occurrences = occurrences - 1 WHERE ingredient = old.name AND recipe_id = old.recipe_id;
+        DELETE FROM ingredient_posting WHERE ingredient = old.name AND recipe_id = old.recipe_id AND occurrences <= 0;
+        UPDATE ingredient_stats SET recipe_count = recipe_count - 1
+        WHERE ingredient = old.name AND NOT EXISTS (SELECT 1 FROM ingredient_posting WHERE ingredient = old.name AND recipe_id = old.recipe_id);
+        DELETE FROM ingredient_stats WHERE ingredient = old.name AND recipe_count <= 0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS ingredient_posting_update AFTER UPDATE OF name, recipe_id ON recipe_ingredient BEGIN
+        UPDATE ingredient_posting SET occurrences = occurrences - 1 WHERE ingredient = old.name AND recipe_id = old.recipe_id;
+        DELETE FROM ingredient_posting WHERE ingredient = old.name AND recipe_id = old.recipe_id AND occurrences <= 0;
+        UPDATE ingredient_stats SET recipe_count = recipe_count - 1
+        WHERE ingredient = old.name AND NOT EXISTS (SELECT 1 FROM ingredient_posting WHERE ingredient = old.name AND recipe_id = old.recipe_id);
+        DELETE FROM ingredient_stats WHERE ingredient = old.name AND recipe_count <= 0;
+        INSERT INTO ingredient_stats (ingredient, recipe_count)
+        SELECT new.name, 1 WHERE NOT EXISTS (SELECT 1 FROM ingredient_posting WHERE ingredient = new.name AND recipe_id = new.recipe_id)
+        ON CONFLICT(ingredient) DO UPDATE SET recipe_count = recipe_count + 1;
+        INSERT INTO ingredient_posting (ingredient, recipe_id, occurrences) VALUES (new.name, new.recipe_id, 1)
+        ON CONFLICT(ingredient, recipe_id) DO UPDATE SET occurrences = occurrences + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS tag_stats_insert AFTER INSERT ON recipe_tag BEGIN
+        INSERT INTO tag_stats (tag, recipe_count) VALUES (new.tag, 1)
+        ON CONFLICT(tag) DO UPDATE SET recipe_count = recipe_count + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS tag_stats_delete AFTER DELETE ON recipe_tag BEGIN
+        UPDATE tag_stats SET recipe_count = recipe_count - 1 WHERE tag = old.tag;
+        DELETE FROM tag_stats WHERE tag = old.tag AND recipe_count <= 0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS tag_stats_update AFTER UPDATE OF tag ON recipe_tag BEGIN
+        UPDATE tag_stats SET recipe_count = recipe_count - 1 WHERE tag = old.tag;
+        DELETE FROM tag_stats WHERE tag = old.tag AND recipe_count <= 0;
+        INSERT INTO tag_stats (tag, recipe_count) VALUES (new.tag, 1)
+        ON CONFLICT(tag) DO UPDATE SET recipe_count = recipe_count + 1;
+    END;
+    DELETE FROM ingredient_posting;
+    DELETE FROM ingredient_stats;
+    DELETE FROM tag_stats;
+    INSERT INTO ingredient_posting (ingredient, recipe_id, occurrences)
+    SELECT name, recipe_id, COUNT(*) FROM recipe_ingredient GROUP BY name, recipe_id;
+    INSERT INTO ingredient_stats (ingredient, recipe_count)
+    SELECT ingredient, COUNT(*) FROM ingredient_posting GROUP BY ingredient;
+    INSERT INTO tag_stats (tag, recipe_count)
+    SELECT tag, COUNT(*) FROM recipe_tag GROUP BY tag;
+    DROP VIEW IF EXISTS IngredientSummary;
+    CREATE VIEW IngredientSummary AS SELECT ingredient, recipe_count FROM ingredient_stats;
+    DROP VIEW IF EXISTS TagSummary;
+    CREATE VIEW TagSummary AS SELECT tag, recipe_count FROM tag_stats;
+    """,
+    # Bulk CSV loads (recipe_loader.py): which dataset files and categories each recipe was
+    # seen in, and how far each file has been loaded so an interrupted load can resume.
+    # Recipes listed in fts_pending now also skip the recipe-level FTS triggers and the
+    # ingredient posting insert trigger. Their full-text rows and new postings are written
+    # with a few set-based statements when the write ends, because row-at-a-time trigger
+    # work (and FTS5 flushing its buffer at every statement that fires triggers) dominates
+    # bulk loads. Deletes still update postings, but only for postings that exist.
+    """
+    CREATE TABLE IF NOT EXISTS recipe_category (
+        recipe_id TEXT NOT NULL REFERENCES recipe(id) ON DELETE CASCADE,
+        category TEXT NOT NULL,
+        file TEXT NOT NULL,
+        PRIMARY KEY (recipe_id, category, file)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_recipe_category_category ON recipe_category(category, recipe_id);
+    CREATE TABLE IF NOT EXISTS load_checkpoint (
+        file TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        rows_done INTEGER NOT NULL,
+        complete INTEGER NOT NULL DEFAULT 0
+    );
+    DROP TRIGGER IF EXISTS recipe_fts_insert;
+    CREATE TRIGGER recipe_fts_insert AFTER INSERT ON recipe
+    WHEN NOT EXISTS (SELECT 1 FROM fts_pending WHERE recipe_id = new.id) BEGIN
+        INSERT INTO recipe_fts (rowid, name, ingredients, instructions, tags)
+        VALUES (new.rowid, new.name, new.ingredients_text, '', '');
+    END;
+    DROP TRIGGER IF EXISTS recipe_fts_update;
+    CREATE TRIGGER recipe_fts_update AFTER UPDATE OF name, ingredients_text ON recipe
+    WHEN NOT EXISTS (SELECT 1 FROM fts_pending WHERE recipe_id = new.id) BEGIN
+        UPDATE recipe_fts SET name = new.name, ingredients = new.ingredients_text WHERE rowid = new.rowid;
+    END;
+    DROP TRIGGER IF EXISTS ingredient_posting_insert;
+    CREATE TRIGGER ingredient_posting_insert AFTER INSERT ON recipe_ingredient
+    WHEN NOT EXISTS (SELECT 1 FROM fts_pending WHERE recipe_id = new.recipe_id) BEGIN
+        INSERT INTO ingredient_stats (ingredient, recipe_count)
+        SELECT new.name, 1 WHERE NOT EXISTS (SELECT 1 FROM ingredient_posting WHERE ingredient = new.name AND recipe_id = new.recipe_id)
+        ON CONFLICT(ingredient) DO UPDATE SET recipe_count = recipe_count + 1;
+        INSERT INTO ingredient_posting (ingredient, recipe_id, occurrences) VALUES (new.name, new.recipe_id, 1)
+        ON CONFLICT(ingredient, recipe_id) DO UPDATE SET occurrences = occurrences + 1;
+    END;
+    DROP TRIGGER IF EXISTS ingredient_posting_delete;
+    CREATE TRIGGER ingredient_posting_delete AFTER DELETE ON recipe_ingredient
+    WHEN EXISTS (SELECT 1 FROM ingredient_posting WHERE ingredient = old.name AND recipe_id = old.recipe_id) BEGIN
+        UPDATE ingredient_posting SET occurrences = occurrences - 1 WHERE ingredient = old.name AND recipe_id = old.recipe_id;
+        DELETE FROM ingredient_posting WHERE ingredient = old.name AND recipe_id = old.recipe_id AND occurrences <= 0;
+        UPDATE ingredient_stats SET recipe_count = recipe_count - 1
+        WHERE ingredient = old.name AND NOT EXISTS (SELECT 1 FROM ingredient_posting WHERE ingredient = old.name AND recipe_id = old.recipe_id);
+        DELETE FROM ingredient_stats WHERE ingredient = old.name AND recipe_count <= 0;
+    END;
+    """,
+]
+schema_version = len(MIGRATIONS)
+
+Ingredient = Tuple[str, Optional[float], Optional[str]]
+
+## Legacy Decoding
+# The original `recipes` table stored lists as comma-joined strings wrapped in one or more
+# layers of JSON encoding, and some processed ingredient lists as Python reprs with every
+# character separated by ", ".
+_ingredient_split = re.compile(r",\s+(?=[\d¼-¾⅐-⅞A-Z])")
+_instruction_split = re.compile(r",\s+(?=[A-Z])")
+_tag_split = re.compile(r",\s*")
+_escaped_unicode = re.compile(r"\\u([0-9a-fA-F]{4})")
+_bracket_group = re.compile(r"[(\[]([^()\[\]]+)[)\]]")
+_range_quantity = re.compile(r"(\d+(?:\.\d+)?)\s*[-–]\s*(\d+(?:\.\d+)?)")
+_fraction_quantity = re.compile(r"(?:(\d+)\s+)?(\d+)/(\d+)")
+
+def _unwrap(value: Any) -> Any:
+    """Peel off repeated JSON encoding until a list or plain text remains."""
+    while isinstance(value, str):
+        text = value.strip()
+        if not text or text[0] not in '"[':
+            break
+        try:
+            value = json.loads(text)
+        except ValueError:
+            break
+    if isinstance(value, str):
+        value = _escaped_unicode.sub(lambda m: chr(int(m.group(1), 16)), value.strip())
+    return value
+
+def _split_list(value: Any, pattern: re.Pattern) -> List[str]:
+    value = _unwrap(value)
+    if value is None or value == "":
+        return []
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item.strip() for item in pattern.split(value) if item.strip()]
+
+def _quantity(value: Any) -> Optional[float]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    text = str(value).strip(" '\"")
+    if match := _range_quantity.fullmatch(text):
+        return (float(match.group(1)) + float(match.group(2))) / 2
+    if match := _fraction_quantity.fullmatch(text):
+        return float(match.group(1) or 0) + float(match.group(2)) / float(match.group(3))
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def _clean(value: Any) -> Optional[str]:
+    text = str(value).strip(" '\"[]()") if value is not None else ""
+    return text if text and text != "None" else None
+
+def _ingredient_rows(value: Any) -> List[Sequence[Any]]:
+    if isinstance(value, str):
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            # Hand-written reprs with unquoted or unbalanced strings: take each bracketed
+            # group as one entry, with the last two fields as quantity and unit
+            rows = []
+            for group in _bracket_group.findall(value):
+                fields = group.split(",")
+                rows.append([",".join(fields[:-2]), *fields[-2:]] if len(fields) > 3 else fields)
+            return rows
+    if not isinstance(value, (list, tuple)):
+        return []
+    if value and not any(isinstance(entry, (list, tuple)) for entry in value) and not all(isinstance(entry, str) for entry in value):
+        # A flattened list of (name, quantity, unit) triples
+        return [value[i:i + 3] for i in range(0, len(value), 3)]
+    return [entry if isinstance(entry, (list, tuple)) else (entry,) for entry in value]
+
+def parse_legacy_ingredients(value: Any) -> List[Ingredient]:
+    """Decode a legacy `processed_ingredients` value into (name, quantity, unit) rows."""
+    value = _unwrap(value)
+    if isinstance(value, str) and len(value) > 6 and value[1:3] == ", " and value[4:6] == ", ":
+        value = value[0::3]
+    ingredients = []
+    for entry in _ingredient_rows(value):
+        name = _clean(entry[0]) if entry else None
+        if name is None:
+            continue
+        quantity = _quantity(entry[1]) if len(entry) > 1 else None
+        unit = _clean(entry[2]) if len(entry) > 2 else None
+        ingredients.append((name.lower(), quantity, unit))
+    return ingredients
+
+def parse_legacy_tags(value: Any) -> List[str]:
+    return sorted({tag.lower() for tag in _split_list(value, _tag_split)})
+
+def _statements(script: str) -> Iterator[str]:
+    """Split an SQL script into statements, keeping trigger bodies whole."""
+    statement = ""
+    for part in script.split(";"):
+        statement += part + ";"
+        if sqlite3.complete_statement(statement):
+            if statement.strip(" \n;"):
+                yield statement
+            statement = ""
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query matching every word (a trailing * keeps prefix search)."""
+    terms = re.findall(r"\w+\*?", text)
+    return " ".join(f'"{term.rstrip("*")}"' + ("*" if term.endswith("*") else "") for term in terms)
+
+## Ingredient Queries
+# Boolean ingredient expressions such as "flour AND yeast AND NOT sugar" or
+# "(butter OR olive oil) AND tag:sourdough". NOT binds tightest, then AND, then OR;
+# consecutive words form one multi-word ingredient name.
+_query_token = re.compile(r'\s*(\(|\)|"[^"]*"|[^\s()"]+)')
+_operators = {"AND", "OR", "NOT"}
+
+class _QueryParser:
+    def __init__(self, text: str) -> None:
+        self.tokens = _query_token.findall(text)
+        self.pos = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self) -> str:
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def parse(self) -> Tuple:
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected {self.peek()!r} in ingredient query.")
+        return node
+
+    def parse_or(self) -> Tuple:
+        nodes = [self.parse_and()]
+        while (self.peek() or "").upper() == "OR":
+            self.take()
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", tuple(nodes))
+
+    def parse_and(self) -> Tuple:
+        nodes = [self.parse_not()]
+        while (self.peek() or "").upper() == "AND":
+            self.take()
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ("and", tuple(nodes))
+
+    def parse_not(self) -> Tuple:
+        token = self.peek()
+        if token is None:
+            raise ValueError("Ingredient query ended early.")
+        if token.upper() == "NOT":
+            self.take()
+            return ("not", self.parse_not())
+        if token == "(":
+            self.take()
+            node = self.parse_or()
+            if self.peek() != ")":
+                raise ValueError("Unbalanced parentheses in ingredient query.")
+            self.take()
+            return node
+        words = []
+        while self.peek() is not None and self.peek() not in "()" and self.peek().upper() not in _operators:
+            words.append(self.take().strip('"'))
+        if not words:
+            raise ValueError(f"Expected an ingredient before {token!r}.")
+        term = " ".join(words).lower()
+        if term.startswith("tag:"):
+            return ("tag", term[4:].strip())
+        return ("ingredient", term)
+
+def parse_ingredient_query(text: str) -> Tuple:
+    """Parse a boolean ingredient expression into a nested (op, operands) tree."""
+    return _QueryParser(text).parse()
+
+def _read_legacy(conn: sqlite3.Connection) -> Optional[List[Tuple]]:
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'recipes'").fetchone():
+        return None
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(recipes)")}
+    tags_column = "tags" if "tags" in columns else "NULL"
+    return conn.execute(
+        f"SELECT id, url, name, ingredients, instructions, processed_ingredients, {tags_column} FROM recipes"
+    ).fetchall()
+
+def source_hash(*columns: Any) -> str:
+    return hashlib.sha256(json.dumps(columns, default=str).encode('utf-8')).hexdigest()
+
+class RecipeDB(NestedTransactions):
+    """Normalized, indexed view of a recipe corpus in SQLite.
+
+    Opening a database migrates it to the current schema. `load_legacy` then brings the
+    normalized tables up to date with the original JSON-encoded `recipes` table in the
+    read-only `legacy` file (or in this database when `legacy` is None), rewriting only
+    the recipes whose source row changed.
+    """
+    def __init__(self, filename: str = default_recipe_db, legacy: Optional[str] = default_legacy_db) -> None:
+        logger.info(f"Opening recipe database at {filename}.")
+        self.filename = filename
+        self.legacy = legacy
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._bulk_depth = 0
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self.migrate()
+
+    @contextmanager
+    def bulk(self) -> Iterator[sqlite3.Connection]:
+        """A transaction that indexes the recipes written in it once, at the end, instead of row by row."""
+        with self.transaction() as conn:
+            self._bulk_depth += 1
+            try:
+                yield conn
+            finally:
+                self._bulk_depth -= 1
+            if self._bulk_depth == 0:
+                self._refresh_indexes(conn)
+
+    def _refresh_indexes(self, conn: sqlite3.Connection) -> None:
+        """Write the full-text row and ingredient postings of every recipe listed in fts_pending."""
+        conn.execute(
+            "DELETE FROM recipe_fts WHERE rowid IN (SELECT r.rowid FROM fts_pending p JOIN recipe r ON r.id = p.recipe_id)"
+        )
+        conn.execute(
+            "INSERT INTO recipe_fts (rowid, name, ingredients, instructions, tags) "
+            "SELECT r.rowid, r.name, r.ingredients_text, "
+            "(SELECT group_concat(text, char(10)) FROM (SELECT text FROM instruction WHERE recipe_id = r.id ORDER BY step)), "
+            "(SELECT group_concat(tag, ' ') FROM recipe_tag WHERE recipe_id = r.id) "
+            "FROM fts_pending p JOIN recipe r ON r.id = p.recipe_id ORDER BY r.rowid"
+        )
+        # upsert_recipe cleared the old postings through the delete trigger, so only the new rows are missing
+        conn.execute(
+            "INSERT INTO ingredient_posting (ingredient, recipe_id, occurrences) "
+            "SELECT i.name, i.recipe_id, COUNT(*) FROM fts_pending f JOIN recipe_ingredient i ON i.recipe_id = f.recipe_id "
+            "WHERE true GROUP BY i.name, i.recipe_id "
+            "ON CONFLICT(ingredient, recipe_id) DO UPDATE SET occurrences = occurrences + excluded.occurrences"
+        )
+        conn.execute(
+            "INSERT INTO ingredient_stats (ingredient, recipe_count) "
+            "SELECT i.name, COUNT(DISTINCT i.recipe_id) FROM fts_pending f JOIN recipe_ingredient i ON i.recipe_id = f.recipe_id "
+            "WHERE true GROUP BY i.name "
+            "ON CONFLICT(ingredient) DO UPDATE SET recipe_count = recipe_count + excluded.recipe_count"
+        )
+        conn.execute("DELETE FROM fts_pending")
+
+    def migrate(self) -> int:
+        """Apply any migrations newer than the database's schema version. Returns the version."""
+        with self._lock:
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                logger.info(f"Migrating {self.filename} to schema version {number}.")
+                with self.transaction() as conn:
+                    for statement in _statements(script):
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {number}")
+            return max(version, schema_version)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    ## Writes
+    def upsert_recipe(
+        self,
+        recipe_id: str,
+        url: Optional[str],
+        name: Optional[str],
+        ingredients: Sequence[Ingredient],
+        instructions: Sequence[str],
+        tags: Sequence[str] = (),
+        ingredient_lines: Sequence[str] = (),
+        source: str = legacy_source,
+        source_hash: str = "",
+    ) -> None:
+        """Insert or replace one recipe and all of its ingredient, tag and instruction rows.
+
+        Inside `bulk()` the recipe's full-text row and ingredient postings are written when
+        the bulk block ends.
+        """
+        with self.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO fts_pending (recipe_id) VALUES (?)", (recipe_id,))
+            conn.execute(
+                "INSERT INTO recipe (id, url, name, ingredients_text, source, source_hash) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET url = excluded.url, name = excluded.name, "
+                "ingredients_text = excluded.ingredients_text, source = excluded.source, source_hash = excluded.source_hash",
+                (recipe_id, url, name, "\n".join(ingredient_lines), source, source_hash),
+            )
+            for table in ("recipe_ingredient", "recipe_tag", "instruction"):
+                conn.execute(f"DELETE FROM {table} WHERE recipe_id = ?", (recipe_id,))
+            conn.executemany(
+                "INSERT INTO recipe_ingredient (recipe_id, position, name, quantity, unit) VALUES (?, ?, ?, ?, ?)",
+                [(recipe_id, i, *ingredient) for i, ingredient in enumerate(ingredients)],
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO recipe_tag (recipe_id, tag) VALUES (?, ?)",
+                [(recipe_id, tag) for tag in tags],
+            )
+            conn.executemany(
+                "INSERT INTO instruction (recipe_id, step, text) VALUES (?, ?, ?)",
+                [(recipe_id, i, text) for i, text in enumerate(instructions)],
+            )
+            if not self._bulk_depth:
+                self._refresh_indexes(conn)
+
+    def delete_recipe(self, recipe_id: str) -> None:
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM recipe WHERE id = ?", (recipe_id,))
+
+    def load_legacy(self, batch_size: int = default_batch_size) -> Dict[str, int]:
+        """Sync the normalized tables with the legacy `recipes` table.
+
+        Unchanged rows are skipped by comparing a hash of their raw columns, and recipes that
+        disappeared from the legacy table are removed. Changes are committed every
+        `batch_size` recipes, so an interrupted load resumes where it stopped. Safe to run
+        repeatedly.
+        """
+        counts = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0}
+        rows = self._legacy_rows()
+        if rows is None:
+            return counts
+        with self._lock:
+            known = dict(self._conn.execute("SELECT id, source_hash FROM recipe WHERE source = ?", (legacy_source,)))
+        changed = []
+        for row in rows:
+            digest = source_hash(*row[1:])
+            previous = known.pop(row[0], None)
+            if previous == digest:
+                counts["unchanged"] += 1
+            else:
+                changed.append((row, digest))
+                counts["added" if previous is None else "updated"] += 1
+        for start in range(0, len(changed), batch_size):
+            with self.bulk():
+                for (recipe_id, url, name, ingredients, instructions, processed, tags), digest in changed[start:start + batch_size]:
+                    self.upsert_recipe(
+                        recipe_id,
+                        url,
+                        name,
+                        parse_legacy_ingredients(processed),
+                        _split_list(instructions, _instruction_split),
+                        parse_legacy_tags(tags),
+                        _split_list(ingredients, _ingredient_split),
+                        legacy_source,
+                        digest,
+                    )
+        with self.transaction():
+            for recipe_id in known:
+                self.delete_recipe(recipe_id)
+                counts["removed"] += 1
+        logger.info(f"Loaded legacy recipes into {self.filename}: {counts}")
+        return counts
+
+    def _legacy_rows(self) -> Optional[List[Tuple]]:
+        """Read the legacy `recipes` table, or return None if there is none."""
+        if self.legacy is None:
+            with self._lock:
+                return _read_legacy(self._conn)
+        if not os.path.exists(self.legacy):
+            return None
+        # Opened read-only so the legacy file is never migrated or written to
+        conn = sqlite3.connect(f"{pathlib.Path(os.path.abspath(self.legacy)).as_uri()}?mode=ro", uri=True)
+        try:
+            return _read_legacy(conn)
+        finally:
+            conn.close()
+
+    ## Lookups
+    def recipes_with_ingredient(self, name: str, limit: int = 50) -> List[Tuple[str, str, str]]:
+        """Return (id, name, url) of recipes using an ingredient, by exact normalized name."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT r.id, r.name, r.url FROM ingredient_posting p JOIN recipe r ON r.id = p.recipe_id "
+                "WHERE p.ingredient = ? LIMIT ?",
+                (name.strip().lower(), limit),
+            ).fetchall()
+
+    def ingredient_counts(self, limit: int = 50, prefix: str = "") -> List[Tuple[str, int]]:
+        """Return the most common ingredients (optionally starting with `prefix`) and their recipe counts."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT ingredient, recipe_count FROM ingredient_stats WHERE ingredient >= ? AND ingredient < ? "
+                "ORDER BY recipe_count DESC LIMIT ?",
+                (prefix.lower(), prefix.lower() + "\uffff", limit),
+            ).fetchall()
+
+    def ingredient_rows(self) -> List[Tuple[str, str, Optional[float], Optional[str]]]:
+        """Return (recipe id, name, quantity, unit) for every ingredient row, grouped by recipe in position order."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT recipe_id, name, quantity, unit FROM recipe_ingredient ORDER BY recipe_id, position"
+            ).fetchall()
+
+    def tag_counts(self, limit: int = 50) -> List[Tuple[str, int]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT tag, recipe_count FROM tag_stats ORDER BY recipe_count DESC LIMIT ?", (limit,)
+            ).fetchall()
+
+    def _compile(self, node: Tuple, sizes: Dict[Tuple, int]) -> Tuple[str, List[Any]]:
+        """Compile a parsed ingredient query into a compound SELECT of recipe IDs over the posting lists."""
+        op, operand = node
+        if op == "ingredient":
+            return "SELECT recipe_id FROM ingredient_posting WHERE ingredient = ?", [operand]
+        if op == "tag":
+            return "SELECT recipe_id FROM recipe_tag WHERE tag = ?", [operand]
+        if op == "or":
+            parts = [self._compile(child, sizes) for child in operand]
+            return " UNION ".join(f"SELECT recipe_id FROM ({sql})" for sql, _ in parts), [p for _, params in parts for p in params]
+        children = [node] if op == "not" else operand
+        include = [child for child in children if child[0] != "not"]
+        exclude = [child[1] if child[0] == "not" else child for child in children if child[0] == "not"]
+        # Intersect from the shortest posting list up
+        include.sort(key=lambda child: sizes.get(child, float("inf")))
+        parts = [self._compile(child, sizes) for child in include] or [("SELECT id AS recipe_id FROM recipe", [])]
+        sql = " INTERSECT ".join(f"SELECT recipe_id FROM ({part})" for part, _ in parts)
+        params = [p for _, part_params in parts for p in part_params]
+        for child in exclude:
+            part, part_params = self._compile(child, sizes)
+            sql += f" EXCEPT SELECT recipe_id FROM ({part})"
+            params += part_params
+        return sql, params
+
+    def query_ingredients(self, expression: str, limit: int = 50) -> List[Tuple[str, str, str]]:
+        """Return (id, name, url) of recipes matching a boolean ingredient expression.
+
+        e.g. "flour AND yeast AND NOT sugar" or "(butter OR olive oil) AND tag:focaccia".
+        Answered from the posting lists; raises ValueError for a malformed expression.
+        """
+        tree = parse_ingredient_query(expression)
+        terms = []
+        stack = [tree]
+        while stack:
+            op, operand = stack.pop()
+            if op in ("ingredient", "tag"):
+                terms.append((op, operand))
+            else:
+                stack.extend([operand] if op == "not" else operand)
+        with self._lock:
+            sizes = {}
+            for op, term in terms:
+                table, column = ("ingredient_stats", "ingredient") if op == "ingredient" else ("tag_stats", "tag")
+                row = self._conn.execute(f"SELECT recipe_count FROM {table} WHERE {column} = ?", (term,)).fetchone()
+                sizes[(op, term)] = row[0] if row else 0
+            sql, params = self._compile(tree, sizes)
+            return self._conn.execute(
+                f"SELECT id, name, url FROM recipe WHERE id IN ({sql}) ORDER BY name LIMIT ?", (*params, limit)
+            ).fetchall()
+
+    def recipes_with_tag(self, tag: str, limit: int = 50) -> List[Tuple[str, str, str]]:
+        """Return (id, name, url) of recipes carrying a tag."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT r.id, r.name, r.url FROM recipe_tag t JOIN recipe r ON r.id = t.recipe_id WHERE t.tag = ? LIMIT ?",
+                (tag.strip().lower(), limit),
+            ).fetchall()
+
+    def search(self, query: str, limit: int = default_search_limit) -> List[Dict[str, Any]]:
+        """Full-text search ranked by BM25, weighting name over tags over ingredients over instructions.
+
+        Every word in `query` must appear (stemmed) somewhere in the recipe. A lower score is a
+        better match.
+        """
+        match = fts_query(query)
+        if not match:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT r.id, r.name, r.url, bm25(recipe_fts, ?, ?, ?, ?) AS score, "
+                "snippet(recipe_fts, -1, '[', ']', '...', 12) "
+                "FROM recipe_fts JOIN recipe r ON r.rowid = recipe_fts.rowid "
+                "WHERE recipe_fts MATCH ? ORDER BY score LIMIT ?",
+                (*search_weights, match, limit),
+            ).fetchall()
+        return [
+            {"id": recipe_id, "name": name, "url": url, "score": round(score, 3), "snippet": snippet}
+            for recipe_id, name, url, score, snippet in rows
+        ]
+
+    def get_recipe(self, recipe_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT id, url, name, ingredients_text FROM recipe WHERE id = ?", (recipe_id,)).fetchone()
+            if row is None:
+                return None
+            ingredients = self._conn.execute(
+                "SELECT name, quantity, unit FROM recipe_ingredient WHERE recipe_id = ? ORDER BY position", (recipe_id,)
+            ).fetchall()
+            instructions = [text for (text,) in self._conn.execute(
+                "SELECT text FROM instruction WHERE recipe_id = ? ORDER BY step", (recipe_id,)
+            )]
+            tags = [tag for (tag,) in self._conn.execute("SELECT tag FROM recipe_tag WHERE recipe_id = ?", (recipe_id,))]
+            categories = [category for (category,) in self._conn.execute(
+                "SELECT DISTINCT category FROM recipe_category WHERE recipe_id = ? ORDER BY category", (recipe_id,)
+            )]
+        return {
+            "id": row[0],
+            "url": row[1],
+            "name": row[2],
+            "ingredient_lines": row[3].split("\n") if row[3] else [],
+            "ingredients": ingredients,
+            "instructions": instructions,
+            "tags": tags,
+            "categories": categories,
+        }
+
+_recipe_dbs: Dict[str, RecipeDB] = {}
+_recipe_dbs_lock = threading.Lock()
+
+def get_recipe_db(filename: str = default_recipe_db, legacy: Optional[str] = default_legacy_db) -> RecipeDB:
+    """Return the process-wide RecipeDB for a corpus file, building or syncing it from `legacy` on first use."""
+    with _recipe_dbs_lock:
+        if filename not in _recipe_dbs:
+            if not os.path.exists(filename) and not (legacy and os.path.exists(legacy)):
+                raise FileNotFoundError(f"No recipe database at {filename} and no legacy corpus to build it from.")
+            db = RecipeDB(filename, legacy)
+            db.load_legacy()
+            atexit.register(db.close)
+            _recipe_dbs[filename] = db
+        return _recipe_dbs[filename]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the normalized recipe database from the legacy corpus.")
+    parser.add_argument("--db", default=default_recipe_db, help="Normalized SQLite file to build or update (created if missing).")
+    parser.add_argument("--legacy", default=default_legacy_db, help="SQLite file holding the legacy `recipes` table; it is only read.")
+    args = parser.parse_args()
+    db = RecipeDB(args.db, args.legacy)
+    print(f"{args.db}: schema v{schema_version}, {db.load_legacy()}")
+    db.close()
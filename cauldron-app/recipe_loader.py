@@ -0,0 +1,310 @@
+### BULK CSV LOADER FOR THE RECIPE DATABASE ###
+# Streams the scraped recipe datasets under data/ into the normalized recipe database:
+#   python recipe_loader.py                      # load new or changed files, resuming an interrupted run
+#   python recipe_loader.py --rebuild --db sql/recipes_normalized.db
+# Rows are parsed in a process pool and written in one transaction per chunk, together
+# with the file's checkpoint, so a killed load picks up at the last committed chunk.
+
+import argparse
+import ast
+import csv
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from fnmatch import fnmatch
+from typing import Any, Deque, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+from logging_util import logger
+from recipe_db import (
+    RecipeDB,
+    _ingredient_split,
+    _instruction_split,
+    _split_list,
+    default_recipe_db,
+    parse_legacy_ingredients,
+    source_hash,
+)
+
+default_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+default_pattern = "processed-*.csv"
+default_chunk_size = 1000
+default_workers = min(8, os.cpu_count() or 1)
+csv_source = "csv"
+
+_checkbox = re.compile(r"^[\s▢☐□]+")
+_category_name = re.compile(r"processed-(.+?)-recipes?-")
+
+# Parsed row: (id, url, name, ingredients, instructions, ingredient_lines, content_hash)
+ParsedRecipe = Tuple[str, str, str, List[Tuple[str, Optional[float], Optional[str]]], List[str], List[str], str]
+
+class DatasetFile(NamedTuple):
+    path: str
+    name: str # path relative to the data directory, as recorded in provenance and checkpoints
+    category: str
+
+def _category(name: str) -> str:
+    """Category of a dataset file: its directory, or for the flat "GOOD DATASETS" copies, its file name."""
+    directory, filename = os.path.split(name)
+    match = _category_name.match(filename)
+    if directory and directory != "GOOD DATASETS":
+        category = directory
+    elif match:
+        category = match.group(1)
+    else:
+        category = os.path.splitext(filename)[0]
+    return category.lower().replace("-", "_")
+
+def find_dataset_files(data_dir: str = default_data_dir, pattern: str = default_pattern) -> List[DatasetFile]:
+    """List the recipe CSVs under `data_dir` in load order: category folders first, then the copies."""
+    files = []
+    for root, dirs, filenames in os.walk(data_dir):
+        dirs.sort()
+        for filename in sorted(filenames):
+            if fnmatch(filename, pattern):
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, data_dir)
+                files.append(DatasetFile(path, name, _category(name)))
+    # Earlier files win duplicate URLs, so the category folders take precedence over the mixed copies
+    files.sort(key=lambda f: (f.name.startswith("GOOD DATASETS"), f.name))
+    return files
+
+def _csv_list(value: str, pattern: re.Pattern) -> List[str]:
+    """Decode a list column: either a Python list repr or plain comma-joined text."""
+    text = (value or "").strip()
+    items = None
+    if text.startswith("["):
+        try:
+            items = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            items = None
+    if not isinstance(items, list):
+        items = _split_list(text, pattern)
+    cleaned = (_checkbox.sub("", str(item)).replace("\xa0", " ").strip() for item in items)
+    return [item for item in cleaned if item]
+
+def parse_rows(rows: Sequence[Tuple[str, ...]]) -> List[Optional[ParsedRecipe]]:
+    """Parse raw (id, url, name, ingredients, instructions, processed) rows. Runs in the worker processes."""
+    parsed = []
+    for recipe_id, url, name, ingredients, instructions, processed in rows:
+        url, name = url.strip(), name.strip()
+        if not url and not name:
+            parsed.append(None)
+            continue
+        lines = _csv_list(ingredients, _ingredient_split)
+        steps = _csv_list(instructions, _instruction_split)
+        structured = parse_legacy_ingredients(processed)
+        digest = source_hash(name, lines, steps, structured)
+        parsed.append((recipe_id.strip() or digest[:8], url, name, structured, steps, lines, digest))
+    return parsed
+
+def read_chunks(path: str, start: int = 0, chunk_size: int = default_chunk_size) -> Iterator[List[Tuple[str, ...]]]:
+    """Stream a dataset CSV as chunks of raw rows, skipping the first `start` data rows."""
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = {column.strip().lower(): i for i, column in enumerate(header)}
+        wanted = [columns.get(column) for column in ("id", "url", "recipe name", "ingredients", "instructions", "processed ingredients")]
+        chunk = []
+        for number, row in enumerate(reader):
+            if number < start:
+                continue
+            chunk.append(tuple(row[i] if i is not None and i < len(row) else "" for i in wanted))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def _run_inline(fn: Any, *args: Any) -> Future:
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+class _Chunk(NamedTuple):
+    dataset: DatasetFile
+    rows_done: int
+    parsed: Optional[Future] # None marks the end of the file
+    repeats: List[str] # normalized URLs already claimed earlier in this run, not sent for parsing
+
+class CsvLoader:
+    """Loads dataset CSVs into a RecipeDB, deduplicating by URL and content hash.
+
+    A recipe is kept once, under the first file that contained it; every file and category
+    it appears in is recorded in `recipe_category`. Recipes loaded from the legacy table
+    are never overwritten. Progress is checkpointed per file in `load_checkpoint`, so
+    unchanged files are skipped and an interrupted file resumes at its last chunk.
+    """
+    def __init__(self, db: RecipeDB, workers: int = default_workers, chunk_size: int = default_chunk_size) -> None:
+        from class_defs import normalize_url # keep the worker processes' imports light
+        self.db = db
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.normalize_url = normalize_url
+        self.counts = {"files": 0, "files_skipped": 0, "rows": 0, "added": 0, "updated": 0, "unchanged": 0, "duplicates": 0, "invalid": 0}
+        self._known: Dict[str, Tuple[str, str, str]] = {} # recipe id -> (source, source_hash, normalized URL)
+        self._urls: Dict[str, str] = {} # normalized URL -> recipe id
+        self._hashes: Dict[str, str] = {} # content hash -> recipe id
+        self._claimed: set = set() # normalized URLs read so far in this run
+        self._files: Dict[str, set] = {} # recipe id -> dataset files it was seen in
+        self._order: Dict[str, int] = {} # dataset file -> position in the load order
+
+    def rebuild(self) -> None:
+        """Forget everything a previous load wrote: CSV recipes, provenance and checkpoints."""
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM recipe WHERE source = ?", (csv_source,))
+            conn.execute("DELETE FROM recipe_category")
+            conn.execute("DELETE FROM load_checkpoint")
+
+    def _load_state(self) -> Dict[str, Tuple[int, float, int, int]]:
+        with self.db.transaction() as conn:
+            for recipe_id, url, source, digest in conn.execute("SELECT id, url, source, source_hash FROM recipe"):
+                self._known[recipe_id] = (source, digest, self.normalize_url(url) if url else "")
+                if url:
+                    self._urls.setdefault(self.normalize_url(url), recipe_id)
+                if source == csv_source:
+                    self._hashes[digest] = recipe_id
+            for recipe_id, name in conn.execute("SELECT recipe_id, file FROM recipe_category"):
+                self._files.setdefault(recipe_id, set()).add(name)
+            return {row[0]: row[1:] for row in conn.execute("SELECT file, size, mtime, rows_done, complete FROM load_checkpoint")}
+
+    def _chunks(self, files: Sequence[DatasetFile], checkpoints: Dict[str, Tuple[int, float, int, int]], submit: Any) -> Iterator[_Chunk]:
+        for dataset in files:
+            stat = os.stat(dataset.path)
+            size, mtime, rows_done, complete = checkpoints.get(dataset.name, (None, None, 0, 0))
+            if (size, mtime) != (stat.st_size, stat.st_mtime):
+                rows_done, complete = 0, 0
+            if complete:
+                self.counts["files_skipped"] += 1
+                continue
+            self.counts["files"] += 1
+            logger.info(f"Loading {dataset.name} ({dataset.category}) from row {rows_done}.")
+            for rows in read_chunks(dataset.path, rows_done, self.chunk_size):
+                rows_done += len(rows)
+                fresh, repeats = [], []
+                for row in rows:
+                    url = self.normalize_url(row[1]) if row[1].strip() else ""
+                    if url and url in self._claimed:
+                        repeats.append(url)
+                    else:
+                        self._claimed.add(url)
+                        fresh.append(row)
+                yield _Chunk(dataset, rows_done, submit(parse_rows, fresh), repeats)
+            yield _Chunk(dataset, rows_done, None, [])
+
+    def _owned_by_earlier_file(self, recipe_id: str, dataset: DatasetFile) -> bool:
+        """Whether a file ahead of `dataset` in the load order also has this recipe (and so owns its content)."""
+        position = self._order.get(dataset.name, len(self._order))
+        return any(self._order.get(name, position) < position for name in self._files.get(recipe_id, ()))
+
+    def _apply(self, chunk: _Chunk) -> None:
+        dataset = chunk.dataset
+        stat = os.stat(dataset.path)
+        with self.db.bulk() as conn:
+            provenance = set()
+            for recipe in chunk.parsed.result() if chunk.parsed else []:
+                self.counts["rows"] += 1
+                if recipe is None:
+                    self.counts["invalid"] += 1
+                    continue
+                recipe_id, url, name, ingredients, instructions, lines, digest = recipe
+                url_key = self.normalize_url(url) if url else ""
+                if url_key and recipe_id in self._known and self._known[recipe_id][2] != url_key:
+                    # The scraper's short IDs occasionally collide across datasets
+                    recipe_id = source_hash(url_key)[:8]
+                owner = (self._urls.get(url_key) if url_key else None) or self._hashes.get(digest)
+                if owner is not None and owner != recipe_id:
+                    self.counts["duplicates"] += 1
+                    recipe_id = owner
+                elif recipe_id in self._known:
+                    source, previous, _ = self._known[recipe_id]
+                    if source != csv_source:
+                        self.counts["duplicates"] += 1
+                    elif previous == digest:
+                        self.counts["unchanged"] += 1
+                    elif self._owned_by_earlier_file(recipe_id, dataset):
+                        self.counts["duplicates"] += 1
+                    else:
+                        self.counts["updated"] += 1
+                        self.db.upsert_recipe(recipe_id, url, name, ingredients, instructions, (), lines, csv_source, digest)
+                        self._known[recipe_id] = (csv_source, digest, url_key)
+                else:
+                    self.counts["added"] += 1
+                    self.db.upsert_recipe(recipe_id, url, name, ingredients, instructions, (), lines, csv_source, digest)
+                    self._known[recipe_id] = (csv_source, digest, url_key)
+                if url_key:
+                    self._urls.setdefault(url_key, recipe_id)
+                self._hashes.setdefault(digest, recipe_id)
+                provenance.add(recipe_id)
+                self._files.setdefault(recipe_id, set()).add(dataset.name)
+            for url_key in chunk.repeats:
+                self.counts["rows"] += 1
+                self.counts["duplicates"] += 1
+                if url_key in self._urls:
+                    provenance.add(self._urls[url_key])
+            conn.executemany(
+                "INSERT OR IGNORE INTO recipe_category (recipe_id, category, file) VALUES (?, ?, ?)",
+                [(recipe_id, dataset.category, dataset.name) for recipe_id in provenance],
+            )
+            conn.execute(
+                "INSERT INTO load_checkpoint (file, size, mtime, rows_done, complete) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(file) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, "
+                "rows_done = excluded.rows_done, complete = excluded.complete",
+                (dataset.name, stat.st_size, stat.st_mtime, chunk.rows_done, int(chunk.parsed is None)),
+            )
+
+    def load(self, files: Sequence[DatasetFile]) -> Dict[str, int]:
+        """Load `files` in order. Parsing runs up to two chunks per worker ahead of the writer."""
+        checkpoints = self._load_state()
+        self._order = {dataset.name: i for i, dataset in enumerate(files)}
+        executor: Optional[Executor] = None
+        if self.workers > 0:
+            # Spawn rather than fork: the parent already runs the logging listener thread
+            import multiprocessing
+            executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        submit = executor.submit if executor else _run_inline
+        pending: Deque[_Chunk] = deque()
+        try:
+            for chunk in self._chunks(files, checkpoints, submit):
+                pending.append(chunk)
+                while len(pending) > max(1, 2 * self.workers):
+                    self._apply(pending.popleft())
+            while pending:
+                self._apply(pending.popleft())
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+        logger.info(f"Loaded dataset CSVs into {self.db.filename}: {self.counts}")
+        return self.counts
+
+def load_datasets(
+    db: RecipeDB,
+    data_dir: str = default_data_dir,
+    pattern: str = default_pattern,
+    workers: int = default_workers,
+    chunk_size: int = default_chunk_size,
+    rebuild: bool = False,
+) -> Dict[str, int]:
+    """Load every dataset CSV under `data_dir` matching `pattern` into `db`."""
+    loader = CsvLoader(db, workers, chunk_size)
+    if rebuild:
+        loader.rebuild()
+    return loader.load(find_dataset_files(data_dir, pattern))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-load the recipe dataset CSVs into the recipe database.")
+    parser.add_argument("--db", default=default_recipe_db, help="SQLite file to load into (created if missing).")
+    parser.add_argument("--data", default=default_data_dir, help="Directory holding the category folders.")
+    parser.add_argument("--pattern", default=default_pattern, help="File name pattern of the recipe CSVs.")
+    parser.add_argument("--workers", type=int, default=default_workers, help="Parser processes; 0 parses in this process.")
+    parser.add_argument("--chunk-size", type=int, default=default_chunk_size, help="Rows per parse task and transaction.")
+    parser.add_argument("--rebuild", action="store_true", help="Drop previously loaded CSV recipes and checkpoints first.")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    db = RecipeDB(args.db)
+    db.load_legacy() # legacy recipes keep their URLs; CSV copies of them only add provenance
+    counts = load_datasets(db, args.data, args.pattern, args.workers, args.chunk_size, args.rebuild)
+    db.close()
+    print(f"{args.db}: {counts} in {time.perf_counter() - start:.2f}s")
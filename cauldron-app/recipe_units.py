@@ -0,0 +1,347 @@
+### UNIT NORMALIZATION AND RECIPE SCALING ###
+# Converts ingredient amounts to grams and millilitres using per-ingredient densities and
+# piece weights. Amounts are held in flat NumPy arrays, one row per ingredient, so a whole
+# corpus converts, scales and aggregates in a handful of vectorized operations:
+#   python recipe_units.py --db sql/recipes_normalized.db      # corpus-wide ratios, with timings
+
+import argparse
+import functools
+import re
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from ingredient_parser import canonical_unit
+from logging_util import logger
+
+if TYPE_CHECKING:
+    from class_defs import Ingredient
+    from recipe_db import RecipeDB
+
+default_flour_pattern = r"\bflour\b"
+
+## Units
+UNKNOWN, MASS, VOLUME, COUNT = 0, 1, 2, 3
+
+# Canonical unit (see ingredient_parser.UNIT_ALIASES) -> (dimension, grams, millilitres or pieces per unit)
+UNIT_TABLE: Dict[str, Tuple[int, float]] = {
+    "teaspoon": (VOLUME, 4.92892),
+    "tablespoon": (VOLUME, 14.7868),
+    "cup": (VOLUME, 236.588),
+    "fluid ounce": (VOLUME, 29.5735),
+    "pint": (VOLUME, 473.176),
+    "quart": (VOLUME, 946.353),
+    "gallon": (VOLUME, 3785.41),
+    "milliliter": (VOLUME, 1.0),
+    "liter": (VOLUME, 1000.0),
+    "pinch": (VOLUME, 0.31),
+    "dash": (VOLUME, 0.62),
+    "drop": (VOLUME, 0.05),
+    "gram": (MASS, 1.0),
+    "kilogram": (MASS, 1000.0),
+    "milligram": (MASS, 0.001),
+    "ounce": (MASS, 28.3495),
+    "pound": (MASS, 453.592),
+    "stick": (COUNT, 1.0), # a weight only for butter, see ITEM_UNIT_GRAMS
+    "clove": (MASS, 5.0), # of garlic
+    "packet": (COUNT, 1.0), # a weight only for yeast or gelatin, see ITEM_UNIT_GRAMS
+    "each": (COUNT, 1.0),
+    "piece": (COUNT, 1.0),
+}
+# Units that are a known weight only for some ingredients: unit -> (name pattern, grams per unit).
+# For any other ingredient they count whole items, weighed by piece_grams ("2 cinnamon sticks").
+ITEM_UNIT_GRAMS: Dict[str, Tuple[str, float]] = {
+    "stick": (r"\bbutter\b", 113.4), # a US stick of butter
+    "packet": (r"\b(?:yeast|gelatine?)\b", 7.0),
+}
+# Stored unit spellings that mean the amount counts whole items: "3 large eggs"
+COUNT_WORDS = {"", "each", "ea", "whole", "large", "medium", "small", "extra large", "jumbo", "unit", "units", "count", "none"}
+
+_unit_names = ["unknown", *UNIT_TABLE]
+_unit_index = {unit: i for i, unit in enumerate(_unit_names)}
+_unit_dimension = np.array([UNKNOWN] + [dimension for dimension, _ in UNIT_TABLE.values()], dtype=np.int8)
+_unit_factor = np.array([np.nan] + [factor for _, factor in UNIT_TABLE.values()])
+
+def normalize_unit(unit: Optional[str]) -> Optional[str]:
+    """Canonical unit of a stored or parsed spelling. No unit means "each"; None if the unit is not known."""
+    if unit is None or " ".join(str(unit).split()).rstrip(".").lower() in COUNT_WORDS:
+        return "each"
+    return canonical_unit(unit)
+
+@functools.lru_cache(maxsize=4096)
+def _unit_code(unit: Optional[str]) -> int:
+    return _unit_index.get(normalize_unit(unit) or "unknown", 0)
+
+## Densities and Piece Weights
+# Grams per millilitre, mostly from the weight of a US cup. The last matching keyword in a
+# name decides, so "milk chocolate chips" weighs as chocolate chips.
+DENSITIES: Dict[str, float] = {
+    "water": 1.0, "ice": 0.92, "milk": 1.03, "buttermilk": 1.03, "cream": 1.0, "sour cream": 0.97,
+    "yogurt": 1.03, "greek yogurt": 1.06, "cream cheese": 0.98, "ricotta": 1.05, "mascarpone": 1.0,
+    "flour": 0.53, "bread flour": 0.54, "whole wheat flour": 0.51, "cake flour": 0.48, "pastry flour": 0.48,
+    "rye flour": 0.43, "almond flour": 0.41, "coconut flour": 0.47, "oat flour": 0.39, "rice flour": 0.66,
+    "cornmeal": 0.58, "semolina": 0.71, "cornstarch": 0.47, "corn starch": 0.47, "tapioca starch": 0.51,
+    "oats": 0.38, "rolled oats": 0.38, "quinoa": 0.72, "rice": 0.84, "breadcrumbs": 0.47, "bread crumbs": 0.47, "panko": 0.21,
+    "sugar": 0.85, "brown sugar": 0.9, "powdered sugar": 0.48, "confectioners sugar": 0.48,
+    "confectioners' sugar": 0.48, "icing sugar": 0.48, "coconut sugar": 0.68,
+    "honey": 1.42, "maple syrup": 1.32, "molasses": 1.42, "corn syrup": 1.39, "syrup": 1.33, "agave": 1.39,
+    "butter": 0.96, "peanut butter": 1.09, "almond butter": 1.06, "oil": 0.91, "shortening": 0.81, "lard": 0.87,
+    "margarine": 0.96, "mayonnaise": 0.96,
+    "egg": 1.03, "egg white": 1.03, "egg yolk": 1.03,
+    "salt": 1.22, "kosher salt": 0.6, "sea salt": 1.1, "baking soda": 1.22, "baking powder": 0.81,
+    "yeast": 0.64, "cream of tartar": 0.61, "gelatin": 0.6,
+    "cocoa": 0.36, "cocoa powder": 0.36, "cacao powder": 0.36, "espresso powder": 0.4, "vanilla": 0.88, "extract": 0.88,
+    "nutella": 1.2, "tahini": 1.02,
+    "cinnamon": 0.53, "nutmeg": 0.5, "ginger": 0.37, "cloves": 0.45, "allspice": 0.4, "cardamom": 0.4,
+    "pepper": 0.46, "paprika": 0.46, "cumin": 0.43, "chili powder": 0.54, "garlic powder": 0.62, "onion powder": 0.5,
+    "oregano": 0.2, "basil": 0.2, "thyme": 0.3, "rosemary": 0.3, "parsley": 0.16, "cilantro": 0.16, "chives": 0.2,
+    "spice": 0.5, "seasoning": 0.4, "pepper flakes": 0.3, "zest": 0.4, "xanthan gum": 0.6, "bicarbonate of soda": 1.22,
+    "chocolate": 0.72, "chocolate chips": 0.72, "chips": 0.72, "sprinkles": 0.8,
+    "nuts": 0.48, "walnuts": 0.48, "pecans": 0.48, "almonds": 0.6, "hazelnuts": 0.57, "peanuts": 0.6, "cashews": 0.55,
+    "almond meal": 0.41, "crumbs": 0.42, "marshmallows": 0.21,
+    "raisins": 0.63, "dates": 0.63, "coconut": 0.36, "shredded coconut": 0.36, "seeds": 0.6, "flaxseed": 0.63,
+    "cheese": 0.47, "parmesan": 0.42, "cheddar": 0.47, "mozzarella": 0.47,
+    "berries": 0.62, "blueberries": 0.62, "strawberries": 0.63, "raspberries": 0.52, "cranberries": 0.42, "banana": 0.95,
+    "apples": 0.53, "pineapple": 0.7, "olives": 0.57, "tomatoes": 0.76, "tomato paste": 1.1, "onion": 0.63,
+    "garlic": 0.58, "carrots": 0.54, "celery": 0.51, "zucchini": 0.52, "mushrooms": 0.3, "spinach": 0.13, "arugula": 0.08,
+    "chicken": 0.59, "pepperoni": 0.5, "sourdough starter": 1.0, "starter": 1.0,
+    "puree": 1.03, "pumpkin": 1.03, "applesauce": 1.08, "jam": 1.33, "sauce": 1.05,
+    "juice": 1.04, "vinegar": 1.01, "wine": 0.99, "beer": 1.01, "coffee": 1.0, "broth": 1.0, "stock": 1.0,
+    "half and half": 1.02, "coconut milk": 0.97, "evaporated milk": 1.07, "condensed milk": 1.3, "milk powder": 0.51,
+}
+# Grams per whole item: "2 eggs", "1 banana"
+PIECE_GRAMS: Dict[str, float] = {
+    "egg": 50.0, "egg white": 30.0, "egg yolk": 18.0, "banana": 118.0, "apple": 182.0, "pear": 178.0,
+    "lemon": 100.0, "lime": 67.0, "orange": 130.0, "onion": 150.0, "shallot": 30.0, "garlic": 5.0,
+    "carrot": 61.0, "potato": 213.0, "sweet potato": 130.0, "tomato": 123.0, "avocado": 170.0,
+    "bell pepper": 120.0, "jalapeno": 14.0, "zucchini": 200.0, "cucumber": 300.0, "date": 8.0,
+    "chicken breast": 200.0, "tortilla": 45.0, "vanilla bean": 3.0, "cinnamon stick": 2.6,
+}
+
+def _keyword_pattern(keywords: Iterable[str]) -> re.Pattern:
+    alternatives = "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+    return re.compile(rf"(?<![a-z])(?P<keyword>{alternatives})(?:e?s)?(?![a-z])")
+
+_density_pattern = _keyword_pattern(DENSITIES)
+_piece_pattern = _keyword_pattern(PIECE_GRAMS)
+
+def _lookup(name: str, pattern: re.Pattern, table: Dict[str, float]) -> Optional[float]:
+    keyword = None
+    for match in pattern.finditer(name.lower()):
+        keyword = match.group("keyword")
+    return table[keyword] if keyword else None
+
+@functools.lru_cache(maxsize=65536)
+def ingredient_density(name: str) -> Optional[float]:
+    """Grams per millilitre of an ingredient, by the last known keyword in its name."""
+    return _lookup(name, _density_pattern, DENSITIES)
+
+@functools.lru_cache(maxsize=65536)
+def piece_grams(name: str) -> Optional[float]:
+    """Grams per whole item of an ingredient ("egg", "banana"), by the last known keyword in its name."""
+    return _lookup(name, _piece_pattern, PIECE_GRAMS)
+
+## Vectorized Engine
+class IngredientArrays:
+    """Ingredient amounts of many recipes as parallel arrays, one row per ingredient.
+
+    `recipe` indexes `recipe_ids`, `name` indexes `names` and `unit` indexes the rows of
+    UNIT_TABLE (0 is an unknown unit). Missing quantities and amounts that cannot be
+    converted are NaN, and sums over a recipe skip them.
+    """
+    def __init__(self, recipe_ids: List[str], names: List[str], recipe: np.ndarray, name: np.ndarray, quantity: np.ndarray, unit: np.ndarray) -> None:
+        self.recipe_ids = recipe_ids
+        self.names = names
+        self.recipe = recipe
+        self.name = name
+        self.quantity = quantity
+        self.unit = unit
+        self._name_masks: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[str, str, Optional[float], Optional[str]]]) -> 'IngredientArrays':
+        """Build from (recipe id, ingredient name, quantity, unit) rows."""
+        recipe_codes: Dict[str, int] = {}
+        name_codes: Dict[str, int] = {}
+        recipe: List[int] = []
+        name: List[int] = []
+        quantity: List[float] = []
+        unit: List[int] = []
+        for recipe_id, ingredient, amount, unit_text in rows:
+            recipe.append(recipe_codes.setdefault(recipe_id, len(recipe_codes)))
+            name.append(name_codes.setdefault(ingredient, len(name_codes)))
+            quantity.append(np.nan if amount is None else amount)
+            unit.append(_unit_code(unit_text))
+        return cls(
+            list(recipe_codes), list(name_codes),
+            np.array(recipe, dtype=np.int32), np.array(name, dtype=np.int32),
+            np.array(quantity, dtype=np.float64), np.array(unit, dtype=np.int8),
+        )
+
+    @classmethod
+    def from_db(cls, db: 'RecipeDB') -> 'IngredientArrays':
+        """Every ingredient row of a recipe corpus."""
+        start = time.perf_counter()
+        arrays = cls.from_rows(db.ingredient_rows())
+        logger.debug(f"Loaded {len(arrays)} ingredient rows of {len(arrays.recipe_ids)} recipes in {time.perf_counter() - start:.3f}s.")
+        return arrays
+
+    @classmethod
+    def from_ingredients(cls, ingredients: Sequence[Union['Ingredient', Dict[str, Any]]], recipe_id: str = "recipe") -> 'IngredientArrays':
+        """A single recipe, from Ingredient objects or dicts with name, quantity and unit."""
+        rows = []
+        for ingredient in ingredients:
+            data = ingredient if isinstance(ingredient, dict) else ingredient.dict()
+            rows.append((recipe_id, data["name"], data.get("quantity"), data.get("unit")))
+        return cls.from_rows(rows)
+
+    def __len__(self) -> int:
+        return len(self.recipe)
+
+    @functools.cached_property
+    def densities(self) -> np.ndarray:
+        """Density of each name in `names`, NaN if unknown."""
+        return np.array([ingredient_density(name) or np.nan for name in self.names], dtype=np.float64)
+
+    @functools.cached_property
+    def piece_weights(self) -> np.ndarray:
+        """Grams per whole item of each name in `names`, NaN if unknown."""
+        return np.array([piece_grams(name) or np.nan for name in self.names], dtype=np.float64)
+
+    def matches(self, pattern: str) -> np.ndarray:
+        """Boolean mask of the rows whose ingredient name matches a regular expression (case-insensitive)."""
+        if pattern not in self._name_masks:
+            regex = re.compile(pattern, re.IGNORECASE)
+            self._name_masks[pattern] = np.fromiter((regex.search(name) is not None for name in self.names), dtype=bool, count=len(self.names))
+        return self._name_masks[pattern][self.name]
+
+    def _amounts(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Dimension of every row and its amount in grams, millilitres or pieces."""
+        dimension = _unit_dimension[self.unit]
+        amount = self.quantity * _unit_factor[self.unit]
+        for unit, (pattern, grams) in ITEM_UNIT_GRAMS.items():
+            weighed = (self.unit == _unit_index[unit]) & self.matches(pattern)
+            dimension = np.where(weighed, MASS, dimension)
+            amount = np.where(weighed, self.quantity * grams, amount)
+        return dimension, amount
+
+    def grams(self) -> np.ndarray:
+        """Weight of every row in grams."""
+        dimension, amount = self._amounts()
+        return np.select(
+            [dimension == MASS, dimension == VOLUME, dimension == COUNT],
+            [amount, amount * self.densities[self.name], amount * self.piece_weights[self.name]],
+            np.nan,
+        )
+
+    def millilitres(self) -> np.ndarray:
+        """Volume of every row in millilitres."""
+        dimension, amount = self._amounts()
+        density = self.densities[self.name]
+        return np.select(
+            [dimension == VOLUME, dimension == MASS, dimension == COUNT],
+            [amount, amount / density, amount * self.piece_weights[self.name] / density],
+            np.nan,
+        )
+
+    def recipe_totals(self, values: np.ndarray, where: Optional[np.ndarray] = None) -> np.ndarray:
+        """Sum per-row values over each recipe, skipping NaN (and rows outside the mask `where`)."""
+        weights = np.nan_to_num(values, nan=0.0)
+        if where is not None:
+            weights = np.where(where, weights, 0.0)
+        return np.bincount(self.recipe, weights=weights, minlength=len(self.recipe_ids))
+
+    def coverage(self) -> np.ndarray:
+        """Fraction of each recipe's rows whose weight is known."""
+        known = np.bincount(self.recipe, weights=~np.isnan(self.grams()), minlength=len(self.recipe_ids))
+        return known / np.maximum(np.bincount(self.recipe, minlength=len(self.recipe_ids)), 1)
+
+    def scaled(self, factor: Union[float, np.ndarray]) -> 'IngredientArrays':
+        """Multiply every amount by `factor`, a number or one factor per recipe."""
+        factor = np.asarray(factor, dtype=np.float64)
+        quantity = self.quantity * (factor[self.recipe] if factor.ndim else factor)
+        scaled = IngredientArrays(self.recipe_ids, self.names, self.recipe, self.name, quantity, self.unit)
+        scaled.__dict__.update({key: self.__dict__[key] for key in ("densities", "piece_weights", "_name_masks") if key in self.__dict__})
+        return scaled
+
+    def scale_to_yield(self, target: Union[float, np.ndarray], current: Union[float, np.ndarray]) -> 'IngredientArrays':
+        """Scale from the current yield (servings, loaves, pieces) to the target yield."""
+        return self.scaled(np.asarray(target, dtype=np.float64) / np.asarray(current, dtype=np.float64))
+
+    def scale_to_weight(self, target_grams: Union[float, np.ndarray]) -> 'IngredientArrays':
+        """Scale each recipe so its known ingredient weights add up to `target_grams`."""
+        totals = self.recipe_totals(self.grams())
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.scaled(np.where(totals > 0, target_grams / totals, np.nan))
+
+    def bakers_percentages(self, flour: str = default_flour_pattern) -> np.ndarray:
+        """Weight of every row as a percentage of its recipe's total flour weight; NaN in recipes without flour."""
+        grams = self.grams()
+        base = self.recipe_totals(grams, self.matches(flour))[self.recipe]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(base > 0, grams / base * 100, np.nan)
+
+    def ratio(self, numerator: str, denominator: str) -> np.ndarray:
+        """Per recipe, the weight of ingredients matching `numerator` over those matching `denominator`; NaN where the latter is absent."""
+        grams = self.grams()
+        top = self.recipe_totals(grams, self.matches(numerator))
+        bottom = self.recipe_totals(grams, self.matches(denominator))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(bottom > 0, top / bottom, np.nan)
+
+def _rounded(value: float, digits: int = 1) -> Optional[float]:
+    return None if np.isnan(value) else round(float(value), digits)
+
+def measure_ingredients(
+    ingredients: Sequence[Union['Ingredient', Dict[str, Any]]],
+    scale: Optional[float] = None,
+    target_grams: Optional[float] = None,
+    flour: str = default_flour_pattern,
+) -> Dict[str, Any]:
+    """Convert one recipe's ingredients to grams and millilitres, optionally scaled by a factor or to a total weight."""
+    arrays = IngredientArrays.from_ingredients(ingredients)
+    if scale is not None:
+        arrays = arrays.scaled(scale)
+    if target_grams is not None:
+        arrays = arrays.scale_to_weight(target_grams)
+    grams, millilitres, percentages = arrays.grams(), arrays.millilitres(), arrays.bakers_percentages(flour)
+    return {
+        "ingredients": [
+            {
+                "name": arrays.names[arrays.name[i]],
+                "quantity": _rounded(arrays.quantity[i], 3),
+                "unit": _unit_names[arrays.unit[i]] if arrays.unit[i] else None,
+                "grams": _rounded(grams[i]),
+                "millilitres": _rounded(millilitres[i]),
+                "bakers_percent": _rounded(percentages[i]),
+            }
+            for i in range(len(arrays))
+        ],
+        "total_grams": _rounded(arrays.recipe_totals(grams)[0]) if len(arrays) else 0.0,
+        "flour_grams": _rounded(arrays.recipe_totals(grams, arrays.matches(flour))[0]) if len(arrays) else 0.0,
+    }
+
+if __name__ == "__main__":
+    from recipe_db import RecipeDB, default_recipe_db
+    parser = argparse.ArgumentParser(description="Convert a recipe corpus to grams and report ingredient ratios across it.")
+    parser.add_argument("--db", default=default_recipe_db, help="Normalized recipe database (see recipe_db.py).")
+    args = parser.parse_args()
+    db = RecipeDB(args.db)
+    start = time.perf_counter()
+    corpus = IngredientArrays.from_db(db)
+    db.close()
+    loaded = time.perf_counter()
+    grams = corpus.grams()
+    converted = time.perf_counter()
+    print(f"{len(corpus)} rows of {len(corpus.recipe_ids)} recipes: loaded in {loaded - start:.2f}s, converted to grams in {(converted - loaded) * 1000:.1f}ms")
+    print(f"weight known for {np.mean(~np.isnan(grams)):.1%} of rows; recipes fully converted: {np.mean(corpus.coverage() == 1):.1%}")
+    for label, numerator in (("water", r"\bwater\b"), ("sugar", r"\bsugar\b"), ("butter", r"\bbutter\b"), ("egg", r"\beggs?\b"), ("salt", r"\bsalt\b")):
+        start = time.perf_counter()
+        ratios = corpus.ratio(numerator, default_flour_pattern)
+        elapsed = time.perf_counter() - start
+        present = ratios[ratios > 0]
+        if len(present):
+            low, median, high = np.percentile(present * 100, [25, 50, 75])
+            print(f"{label}:flour in {len(present)} recipes: median {median:.0f}% (IQR {low:.0f}-{high:.0f}%), {elapsed * 1000:.1f}ms")
+    start = time.perf_counter()
+    corpus.scaled(2.0).bakers_percentages()
+    print(f"doubled every recipe and computed baker's percentages in {(time.perf_counter() - start) * 1000:.1f}ms")
@@ -0,0 +1,148 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+import requests
+from recipe_scrapers import scrape_html
+from logging_util import logger
+from page_cache import PageCache
+
+default_timeout = 10
+default_max_workers = 8
+default_per_host = 2
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:86.0) Gecko/20100101 Firefox/86.0",
+}
+
+_local = threading.local()
+
+def _http_session() -> requests.Session:
+    # requests.Session is not thread-safe, so each worker keeps its own for connection reuse
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+        _local.session.headers.update(HEADERS)
+    return _local.session
+
+def fetch_html(url: str, timeout: float = default_timeout, cache: Optional[PageCache] = None) -> str:
+    """Download the raw HTML of a page.
+
+    With a cache, fresh pages are served from disk and stale ones are revalidated with
+    If-None-Match/If-Modified-Since before being downloaded again.
+    """
+    entry = cache.get(url) if cache is not None else None
+    if entry is not None and cache.is_fresh(entry):
+        html = cache.read_html(entry)
+        if html is not None:
+            return html
+        entry = None # The blob is gone, so this is a miss
+    if cache is not None and cache.offline:
+        raise LookupError(f"{url} is not in the page cache and the cache is offline.")
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    logger.debug(f"Fetching {url}")
+    response = _http_session().get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        html = cache.read_html(entry) if entry is not None else None
+        if html is not None:
+            cache.refresh(url)
+            return html
+        # Not modified, but there is no cached copy to serve: treat it as a miss and download it unconditionally
+        logger.debug(f"Got 304 for {url} without a cached copy, fetching it again")
+        response = _http_session().get(url, timeout=timeout)
+        if response.status_code == 304:
+            raise requests.HTTPError(f"{url} returned 304 to an unconditional request.", response=response)
+    response.raise_for_status()
+    # Only a full 200 body is worth keeping, other 2xx responses are returned but not cached
+    if cache is not None and response.status_code == 200:
+        cache.put(url, response.text, etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+    return response.text
+
+def parse_recipe_html(html: str, url: str) -> Dict[str, Optional[List[str]]]:
+    """Extract the name, ingredients and instructions of a recipe page."""
+    out: Dict[str, Optional[List[str]]] = {}
+    out["source"] = url
+    scraper = scrape_html(html, org_url=url, wild_mode=True)
+
+    try:
+        ing: List[str] = scraper.ingredients()
+        out["ingredients"] = ing
+    except Exception as e:
+        logger.error(f"Failed to get ingredients: {e}")
+
+    try:
+        inst: List[str] = scraper.instructions_list()
+        out["instructions"] = inst
+    except Exception as e:
+        logger.error(f"Failed to get instructions: {e}")
+
+    try:
+        name: str = scraper.title()
+        out["name"] = name
+    except Exception as e:
+        logger.error(f"Failed to get name: {e}")
+
+    return out
+
+def scrape_recipe(url: str, timeout: float = default_timeout, cache: Optional[PageCache] = None) -> Dict[str, Optional[List[str]]]:
+    """Fetch and parse a single recipe page. Failures are reported under the "error" key."""
+    try:
+        if cache is None:
+            return parse_recipe_html(fetch_html(url, timeout=timeout), url)
+        entry = cache.get(url)
+        if entry is not None and entry.parsed is not None and cache.is_fresh(entry):
+            return entry.parsed
+        html = fetch_html(url, timeout=timeout, cache=cache)
+        # A 304 revalidation keeps the previously parsed fields
+        entry = cache.get(url)
+        if entry is not None and entry.parsed is not None:
+            return entry.parsed
+        out = parse_recipe_html(html, url)
+        cache.set_parsed(url, out)
+        return out
+    except Exception as e:
+        logger.error(f"Failed to scrape recipe: {e}")
+        return {"source": url, "error": str(e)}
+
+def _host(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+def scrape_recipes(
+    urls: List[str],
+    max_workers: int = default_max_workers,
+    per_host: int = default_per_host,
+    timeout: float = default_timeout,
+    cache: Optional[PageCache] = None,
+) -> List[Dict[str, Optional[List[str]]]]:
+    """Scrape many recipe pages concurrently.
+
+    At most `max_workers` pages are fetched at once and at most `per_host` from any single
+    host. Results are returned in the same order as `urls`.
+    """
+    logger.debug(f"Scraping {len(urls)} recipes with {max_workers} workers.")
+    if not urls:
+        return []
+    host_limits = {host: threading.BoundedSemaphore(per_host) for host in map(_host, urls)}
+
+    def worker(url: str) -> Dict[str, Optional[List[str]]]:
+        with host_limits[_host(url)]:
+            return scrape_recipe(url, timeout=timeout, cache=cache)
+
+    # Submit round-robin across hosts so one slow host does not hold every worker
+    by_host: Dict[str, List[int]] = {}
+    for i, url in enumerate(urls):
+        by_host.setdefault(_host(url), []).append(i)
+    order = []
+    while by_host:
+        for host in list(by_host):
+            order.append(by_host[host].pop(0))
+            if not by_host[host]:
+                del by_host[host]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as pool:
+        futures = {i: pool.submit(worker, urls[i]) for i in order}
+        return [futures[i].result() for i in range(len(urls))]
@@ -0,0 +1,110 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+from logging_util import logger
+
+default_search_cache_file = "search_cache.db"
+default_search_ttl = 24 * 60 * 60 # One day
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search (
+    query_key TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    results TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+def normalize_query(query: str) -> str:
+    """Fold case, punctuation and whitespace so near-identical queries share a cache entry."""
+    query = unicodedata.normalize("NFKC", query).lower()
+    return " ".join(re.sub(r"[^\w]+", " ", query).split())
+
+class SearchCache:
+    """SQLite-backed TTL cache for web search results.
+
+    Identical normalized queries issued concurrently are collapsed into a single call to
+    the search backend; the other callers wait for and share its result. Pass
+    `filename=":memory:"` for a throwaway cache, e.g. in tests.
+    """
+    def __init__(self, filename: str = default_search_cache_file, ttl: float = default_search_ttl) -> None:
+        logger.info(f"Opening search cache at {filename}.")
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        if filename != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def get(self, query: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT results, fetched_at FROM search WHERE query_key = ?", (normalize_query(query),)
+            ).fetchone()
+        if row is None or time.time() - row[1] >= self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, query: str, results: Any) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search (query_key, query, results, fetched_at) VALUES (?, ?, ?, ?)",
+                (normalize_query(query), query, json.dumps(results), time.time()),
+            )
+
+    def get_or_search(self, query: str, search: Callable[[str], Any]) -> Any:
+        """Return cached results for `query`, calling `search` at most once per key on a miss.
+
+        Only list results are cached; anything else (e.g. an error message) is passed through.
+        """
+        results = self.get(query)
+        if results is not None:
+            logger.debug(f"Search cache hit: {query}")
+            return results
+        key = normalize_query(query)
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+        if not owner:
+            logger.debug(f"Waiting on in-flight search: {query}")
+            return future.result()
+        try:
+            logger.debug(f"Search cache miss: {query}")
+            results = search(query)
+            if isinstance(results, list):
+                self.put(query, results)
+            future.set_result(results)
+            return results
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM search")
+
+_search_cache: Optional[SearchCache] = None
+
+def get_search_cache() -> SearchCache:
+    """Return the process-wide SearchCache, opening the default one on first use."""
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = SearchCache()
+    return _search_cache
+
+def set_search_cache(cache: SearchCache) -> None:
+    """Replace the process-wide SearchCache, e.g. with an in-memory stand-in."""
+    global _search_cache
+    _search_cache = cache
@@ -0,0 +1,135 @@
+import atexit
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from logging_util import logger
+from class_defs import Pot, RecipeGraph, ModsList
+from state_store import StateStore, get_store, default_state_file
+from telemetry import get_telemetry
+
+default_flush_interval = 1.0
+
+class SessionState:
+    """Process-level cache of the live Pot, RecipeGraph and ModsList shared by all agent tools.
+
+    Tools mutate the in-memory objects under the session lock and record the matching
+    StateStore write with `record`. Pending writes are flushed in a single transaction
+    either by the background flusher or explicitly at the end of each graph stream step.
+    """
+    def __init__(self, store: StateStore) -> None:
+        logger.info("Initializing SessionState object.")
+        self.store = store
+        self.lock = threading.RLock()
+        self._pot: Optional[Pot] = None
+        self._graph: Optional[RecipeGraph] = None
+        self._mods_list: Optional[ModsList] = None
+        self._pending: List[Tuple[str, Tuple[Any, ...]]] = []
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    def __enter__(self) -> 'SessionState':
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.lock.release()
+
+    @property
+    def pot(self) -> Pot:
+        with self.lock:
+            if self._pot is None:
+                with get_telemetry().io("load_pot"):
+                    self._pot = self.store.load_pot()
+            return self._pot
+
+    @property
+    def graph(self) -> RecipeGraph:
+        with self.lock:
+            if self._graph is None:
+                with get_telemetry().io("load_graph"):
+                    self._graph = self.store.load_graph()
+            return self._graph
+
+    @property
+    def mods_list(self) -> ModsList:
+        with self.lock:
+            if self._mods_list is None:
+                with get_telemetry().io("load_mods_list"):
+                    self._mods_list = self.store.load_mods_list()
+            return self._mods_list
+
+    def record(self, op: str, *args: Any) -> None:
+        """Queue a StateStore write (e.g. `record("save_pot_url", url)`) for the next flush."""
+        with self.lock:
+            self._pending.append((op, args))
+
+    def pending_count(self) -> int:
+        with self.lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """Write all pending changes to the StateStore in one transaction."""
+        with self.lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, []
+            logger.debug(f"Flushing {len(pending)} pending state changes.")
+            try:
+                with get_telemetry().io("flush", ops=len(pending)), self.store.transaction():
+                    for op, args in pending:
+                        getattr(self.store, op)(*args)
+            except Exception:
+                self._pending = pending + self._pending
+                raise
+            return len(pending)
+
+    def reset(self) -> None:
+        """Discard cached objects and pending writes and clear the StateStore."""
+        logger.debug("Resetting session state.")
+        with self.lock:
+            self._pending = []
+            self.store.reset()
+            self._pot = Pot()
+            self._graph = RecipeGraph()
+            self._mods_list = ModsList()
+
+    def start(self, flush_interval: float = default_flush_interval) -> None:
+        """Start the background write-behind thread."""
+        if self._flusher is not None:
+            return
+        logger.info(f"Starting state flusher with a {flush_interval}s interval.")
+        self._stop.clear()
+        self._flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,), name="state-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self, flush_interval: float) -> None:
+        while not self._stop.wait(flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush session state: {e}")
+
+    def close(self) -> None:
+        """Stop the background flusher and write out anything still pending."""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+_sessions: Dict[str, SessionState] = {}
+
+def get_session(filename: str = default_state_file) -> SessionState:
+    """Return the process-wide SessionState for the given state file, creating it on first use."""
+    if filename not in _sessions:
+        session = SessionState(get_store(filename))
+        atexit.register(session.close)
+        _sessions[filename] = session
+    return _sessions[filename]
+
+def fresh_session(filename: str = default_state_file, flush_interval: Optional[float] = default_flush_interval) -> SessionState:
+    logger.info("Creating a fresh session state.")
+    session = get_session(filename)
+    session.reset()
+    if flush_interval is not None:
+        session.start(flush_interval)
+    return session
@@ -0,0 +1,31 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+class NestedTransactions:
+    """Mixin for stores that share one autocommit SQLite connection between threads.
+
+    The class sets `_conn` (opened with isolation_level=None), `_lock` (an RLock) and `_depth = 0`.
+    """
+    _conn: sqlite3.Connection
+    _lock: threading.RLock
+    _depth: int
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Group writes into one atomic commit. Nested transactions join the outermost one."""
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield self._conn
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute("COMMIT")
@@ -0,0 +1,224 @@
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+from logging_util import logger
+from sqlite_util import NestedTransactions
+from class_defs import Recipe, RecipeModification, RecipeGraph, ModsList, Pot
+
+default_state_file = "caldron_state.db"
+schema_version = 2
+state_tables = ("pot_recipe", "pot_url", "graph_node", "graph_edge", "graph_meta", "mod")
+
+# Every Pot entry, graph node/edge and modification is its own row, so a tool call
+# only writes the records it touched instead of re-pickling the whole structure.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pot_recipe (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipe_id TEXT NOT NULL UNIQUE,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pot_url (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS graph_node (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    node_id TEXT NOT NULL UNIQUE,
+    parent TEXT,
+    depth INTEGER NOT NULL DEFAULT 0,
+    recipe TEXT,
+    mod TEXT
+);
+CREATE TABLE IF NOT EXISTS graph_edge (
+    src TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    PRIMARY KEY (src, dst)
+);
+CREATE TABLE IF NOT EXISTS graph_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS mod (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    mod_id TEXT NOT NULL UNIQUE,
+    priority INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+def _load_recipe(recipe_id: str, data: str) -> Recipe:
+    recipe = Recipe.parse_raw(data)
+    recipe._id = recipe_id
+    return recipe
+
+def _load_mod(mod_id: str, data: str) -> RecipeModification:
+    mod = RecipeModification.parse_raw(data)
+    mod._id = mod_id
+    return mod
+
+class StateStore(NestedTransactions):
+    """SQLite (WAL mode) store for the Pot, RecipeGraph and ModsList with per-record writes."""
+    def __init__(self, filename: str = default_state_file) -> None:
+        logger.info(f"Opening state store at {filename}.")
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != schema_version:
+            # Session state is rebuilt on every run, so an outdated layout is simply dropped
+            for table in state_tables:
+                self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._conn.execute(f"PRAGMA user_version = {schema_version}")
+        self._conn.executescript(SCHEMA)
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def reset(self) -> None:
+        logger.debug("Resetting state store.")
+        with self.transaction() as conn:
+            for table in state_tables:
+                conn.execute(f"DELETE FROM {table}")
+
+    def close(self) -> None:
+        logger.debug("Closing state store.")
+        with self._lock:
+            self._conn.close()
+
+    ## Pot Records
+    def save_pot_recipe(self, recipe: Recipe) -> None:
+        logger.debug("Saving recipe to state store.")
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO pot_recipe (recipe_id, data) VALUES (?, ?) "
+                "ON CONFLICT(recipe_id) DO UPDATE SET data = excluded.data",
+                (recipe.get_ID(), recipe.json()),
+            )
+
+    def delete_pot_recipe(self, recipe_id: str) -> None:
+        logger.debug("Deleting recipe from state store.")
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM pot_recipe WHERE recipe_id = ?", (recipe_id,))
+
+    def get_pot_recipe(self, recipe_id: str) -> Optional[Recipe]:
+        logger.debug("Getting recipe from state store.")
+        rows = self._query("SELECT recipe_id, data FROM pot_recipe WHERE recipe_id = ?", (recipe_id,))
+        return _load_recipe(*rows[0]) if rows else None
+
+    def save_pot_url(self, url: str) -> None:
+        logger.debug("Saving URL to state store.")
+        with self.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO pot_url (url) VALUES (?)", (url,))
+
+    def save_pot_urls(self, urls: List[str]) -> None:
+        logger.debug(f"Saving {len(urls)} URLs to state store.")
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO pot_url (url) VALUES (?)", [(url,) for url in urls])
+
+    def delete_pot_url(self, url: str) -> None:
+        logger.debug("Deleting URL from state store.")
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM pot_url WHERE url = ?", (url,))
+
+    def clear_pot(self) -> None:
+        logger.debug("Clearing pot in state store.")
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM pot_recipe")
+            conn.execute("DELETE FROM pot_url")
+
+    def load_pot(self) -> Pot:
+        logger.debug("Loading pot from state store.")
+        pot = Pot()
+        for recipe_id, data in self._query("SELECT recipe_id, data FROM pot_recipe ORDER BY seq"):
+            pot.add_recipe(_load_recipe(recipe_id, data))
+        pot.add_urls([url for url, in self._query("SELECT url FROM pot_url ORDER BY seq")])
+        return pot
+
+    ## Recipe Graph Records
+    def save_node(self, recipe_graph: RecipeGraph, node_id: str) -> None:
+        """Persist one node, the edges leading into it and the current foundational pointer.
+
+        Keyframe nodes are stored with their full recipe, delta nodes only with the
+        modification that produced them.
+        """
+        logger.debug(f"Saving node {node_id} to state store.")
+        data = recipe_graph.get_graph().nodes[node_id]
+        recipe = data['recipe'].json() if 'recipe' in data else None
+        mod = data['mod'].json() if 'mod' in data else None
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO graph_node (node_id, parent, depth, recipe, mod) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(node_id) DO UPDATE SET parent = excluded.parent, depth = excluded.depth, "
+                "recipe = excluded.recipe, mod = excluded.mod",
+                (node_id, data.get('parent'), data.get('depth', 0), recipe, mod),
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO graph_edge (src, dst) VALUES (?, ?)",
+                list(recipe_graph.get_graph().in_edges(node_id)),
+            )
+            self.save_foundational_node(recipe_graph)
+
+    def save_foundational_node(self, recipe_graph: RecipeGraph) -> None:
+        logger.debug("Saving foundational node to state store.")
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO graph_meta (key, value) VALUES ('foundational_recipe_node', ?)",
+                (recipe_graph.foundational_recipe_node,),
+            )
+
+    def get_foundational_node(self) -> Optional[str]:
+        rows = self._query("SELECT value FROM graph_meta WHERE key = 'foundational_recipe_node'")
+        return rows[0][0] if rows else None
+
+    def get_graph_size(self) -> int:
+        return self._query("SELECT COUNT(*) FROM graph_node")[0][0]
+
+    def load_graph(self) -> RecipeGraph:
+        logger.debug("Loading recipe graph from state store.")
+        recipe_graph = RecipeGraph()
+        for node_id, parent, depth, recipe, mod in self._query("SELECT node_id, parent, depth, recipe, mod FROM graph_node ORDER BY seq"):
+            if recipe is not None:
+                recipe_graph.graph.add_node(node_id, recipe=_load_recipe(node_id, recipe), depth=depth)
+            else:
+                recipe_graph.graph.add_node(node_id, mod=RecipeModification.parse_raw(mod), parent=parent, depth=depth)
+        recipe_graph.graph.add_edges_from(self._query("SELECT src, dst FROM graph_edge"))
+        recipe_graph.foundational_recipe_node = self.get_foundational_node()
+        return recipe_graph
+
+    ## Modification Records
+    def save_mod(self, mod: RecipeModification) -> None:
+        logger.debug("Saving modification to state store.")
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO mod (mod_id, priority, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(mod_id) DO UPDATE SET priority = excluded.priority, data = excluded.data",
+                (mod._id, mod.priority, mod.json()),
+            )
+
+    def delete_mod(self, mod_id: str) -> None:
+        logger.debug("Deleting modification from state store.")
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM mod WHERE mod_id = ?", (mod_id,))
+
+    def load_mods_list(self) -> ModsList:
+        logger.debug("Loading mods list from state store.")
+        mods_list = ModsList()
+        for mod_id, data in self._query("SELECT mod_id, data FROM mod ORDER BY seq"):
+            mods_list.suggest_mod(_load_mod(mod_id, data))
+        return mods_list
+
+_stores: Dict[str, StateStore] = {}
+
+def get_store(filename: str = default_state_file) -> StateStore:
+    """Return the process-wide StateStore for the given file, opening it on first use."""
+    if filename not in _stores:
+        _stores[filename] = StateStore(filename)
+    return _stores[filename]
+
+def fresh_store(filename: str = default_state_file) -> str:
+    logger.info("Creating a fresh state store.")
+    get_store(filename).reset()
+    return filename
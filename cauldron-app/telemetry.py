@@ -0,0 +1,219 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from logging_util import logger
+
+# The graph node currently executing in this context; copied into LangChain's worker threads
+_current_node: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("caldron_node", default=None)
+
+def _empty_stats() -> Dict[str, Any]:
+    return {
+        "calls": 0,
+        "wall": 0.0,
+        "llm_calls": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "tool_calls": 0,
+        "tools": {},
+        "io": 0.0,
+    }
+
+class TelemetryCallback(BaseCallbackHandler):
+    """LangChain callback that reports LLM token usage and tool latency to a Telemetry."""
+    def __init__(self, telemetry: 'Telemetry') -> None:
+        self.telemetry = telemetry
+        self._starts: Dict[UUID, Any] = {}
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        start = self._starts.pop(run_id, None)
+        if start is None:
+            return
+        # Cached responses carry no usage, so they count as zero tokens
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        self.telemetry.record_llm(start, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts.pop(run_id, None)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = (serialized.get("name", "tool"), time.perf_counter())
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._starts.pop(run_id, None)
+        if started is not None:
+            self.telemetry.record_tool(*started)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._starts.pop(run_id, None)
+        if started is not None:
+            self.telemetry.record_tool(*started, error=str(error))
+
+class Telemetry:
+    """Per-node timing, token, tool and state I/O metrics for the agent graph.
+
+    `node` wraps each agent invocation and `callback` is passed to LangChain to capture
+    LLM and tool events inside it. Metrics are aggregated for the current turn and for the
+    whole session, and every event is kept as a span for `export_jsonl` and
+    `export_chrome_trace` (viewable in chrome://tracing or Perfetto).
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.turn = 0
+        self.turn_stats: Dict[str, Dict[str, Any]] = defaultdict(_empty_stats)
+        self.session_stats: Dict[str, Dict[str, Any]] = defaultdict(_empty_stats)
+        self.last_node: Optional[str] = None
+        self.callback = TelemetryCallback(self)
+
+    def _record(self, name: str, cat: str, node: Optional[str], start: float, end: float, **args: Any) -> None:
+        # Callers hold self._lock
+        self.events.append({
+            "name": name,
+            "cat": cat,
+            "node": node,
+            "turn": self.turn,
+            "thread": threading.get_ident(),
+            "start": start - self._origin,
+            "dur": end - start,
+            "args": args,
+        })
+
+    def _add(self, node: Optional[str], **values: Any) -> None:
+        # Callers hold self._lock
+        node = node or "(none)"
+        for stats in (self.turn_stats[node], self.session_stats[node]):
+            for key, value in values.items():
+                stats[key] += value
+
+    def _add_tool(self, node: Optional[str], tool: str, seconds: float) -> None:
+        # Callers hold self._lock
+        node = node or "(none)"
+        for stats in (self.turn_stats[node], self.session_stats[node]):
+            calls, total = stats["tools"].get(tool, (0, 0.0))
+            stats["tools"][tool] = (calls + 1, total + seconds)
+
+    @contextmanager
+    def node(self, name: str) -> Iterator[None]:
+        """Time one graph node invocation and attribute nested LLM/tool events to it."""
+        token = _current_node.set(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            _current_node.reset(token)
+            with self._lock:
+                self.last_node = name
+                self._record(name, "node", name, start, end)
+                self._add(name, calls=1, wall=end - start)
+
+    @contextmanager
+    def io(self, name: str, **args: Any) -> Iterator[None]:
+        """Time a state store read or write.
+
+        Writes are flushed after a node finishes, so I/O outside a node is charged to the
+        node that ran last.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                node = _current_node.get() or self.last_node
+                self._record(name, "io", node, start, end, **args)
+                self._add(node, io=end - start)
+
+    def record_llm(self, start: float, prompt_tokens: int, completion_tokens: int) -> None:
+        end = time.perf_counter()
+        node = _current_node.get()
+        with self._lock:
+            self._record("llm", "llm", node, start, end, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            self._add(node, llm_calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def record_tool(self, tool: str, start: float, error: Optional[str] = None) -> None:
+        end = time.perf_counter()
+        node = _current_node.get()
+        with self._lock:
+            self._record(tool, "tool", node, start, end, **({"error": error} if error else {}))
+            self._add(node, tool_calls=1)
+            self._add_tool(node, tool, end - start)
+
+    def start_turn(self) -> None:
+        with self._lock:
+            self.turn += 1
+            self.turn_stats = defaultdict(_empty_stats)
+
+    def end_turn(self) -> Dict[str, Dict[str, Any]]:
+        """Return the metrics of the current turn, keyed by node."""
+        with self._lock:
+            stats = {node: dict(values, tools=dict(values["tools"])) for node, values in self.turn_stats.items()}
+        logger.info(f"Turn {self.turn} telemetry: {stats}")
+        return stats
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Return the metrics of the whole session, keyed by node."""
+        with self._lock:
+            return {node: dict(values, tools=dict(values["tools"])) for node, values in self.session_stats.items()}
+
+    def export_jsonl(self, filename: str) -> None:
+        """Write one JSON object per recorded span."""
+        with self._lock:
+            events = list(self.events)
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, 'w') as file:
+            for event in events:
+                file.write(json.dumps(event) + "\n")
+
+    def export_chrome_trace(self, filename: str) -> None:
+        """Write the recorded spans in Chrome trace-event format."""
+        with self._lock:
+            events = list(self.events)
+        trace = [
+            {
+                "name": event["name"],
+                "cat": event["cat"],
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["dur"] * 1e6,
+                "pid": os.getpid(),
+                "tid": event["thread"],
+                "args": dict(event["args"], node=event["node"], turn=event["turn"]),
+            }
+            for event in events
+        ]
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, 'w') as file:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, file)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.events = []
+            self.turn = 0
+            self.turn_stats = defaultdict(_empty_stats)
+            self.session_stats = defaultdict(_empty_stats)
+            self.last_node = None
+
+_telemetry: Optional[Telemetry] = None
+
+def get_telemetry() -> Telemetry:
+    """Return the process-wide Telemetry, creating it on first use."""
+    global _telemetry
+    if _telemetry is None:
+        _telemetry = Telemetry()
+    return _telemetry